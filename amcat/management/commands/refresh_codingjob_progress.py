@@ -16,27 +16,20 @@
 # You should have received a copy of the GNU Affero General Public        #
 # License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
-import tqdm
-import multiprocessing
-
-from multiprocessing.pool import Pool
 from django.core.management import BaseCommand
 
-from amcat.models import ArticleSet
-
-
-def refresh(aset_id):
-    ArticleSet.objects.get(aset_id)._refresh_property_cache()
+from amcat.models import CodingJob, CodingJobProgress
+from amcat.tools.toolkit import splitlist
 
 
 class Command(BaseCommand):
-    help = 'Recalculate all flexible properties caches.'
+    help = 'Recount the coded articles per status of all (or the given) codingjobs.'
 
     def add_arguments(self, parser):
-        parser.add_argument('--parallel', type=int, default=multiprocessing.cpu_count())
+        parser.add_argument('codingjob', type=int, nargs='*')
+        parser.add_argument('--batch-size', type=int, default=1000)
 
     def handle(self, *args, **options):
-        threads = options["parallel"]
-        articleset_ids = ArticleSet.objects.values_list("id", flat=True)
-        results = Pool(threads).imap_unordered(refresh, articleset_ids)
-        list(tqdm.tqdm(results, total=len(articleset_ids)))
+        codingjob_ids = options["codingjob"] or CodingJob.objects.values_list("id", flat=True)
+        for batch in splitlist(codingjob_ids, itemsperbatch=options["batch_size"]):
+            CodingJobProgress.refresh(batch)
@@ -0,0 +1,43 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+"""
+Split all articles in the given articlesets into sentences, so codingjobs on these sets
+do not need to split articles while coding.
+"""
+import multiprocessing
+
+from django.core.management import BaseCommand
+
+from amcat.models import ArticleSet
+from amcat.tools.sbd import create_sentences_bulk, BULK_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Split all articles in the given articlesets into sentences.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('articleset', type=int, nargs='+')
+        parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+        parser.add_argument('--batch-size', type=int, default=BULK_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        for aset in ArticleSet.objects.filter(pk__in=options["articleset"]):
+            article_ids = aset.articles.values_list("id", flat=True)
+            n = create_sentences_bulk(article_ids, processes=options["processes"], batch_size=options["batch_size"])
+            self.stdout.write("Created {} sentences for {}".format(n, aset))
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('amcat', '0008_merge'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CodingJobProgress',
+            fields=[
+                ('codingjob', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='progress', serialize=False, to='amcat.CodingJob')),
+                ('n_notstarted', models.IntegerField(default=0)),
+                ('n_inprogress', models.IntegerField(default=0)),
+                ('n_complete', models.IntegerField(default=0)),
+                ('n_irrelevant', models.IntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'codingjob_progress',
+            },
+        ),
+        migrations.RunSQL(
+            """
+            INSERT INTO codingjob_progress (codingjob_id, n_notstarted, n_inprogress, n_complete, n_irrelevant)
+            SELECT j.codingjob_id,
+                   COUNT(ca.id) FILTER (WHERE ca.status_id = 0), COUNT(ca.id) FILTER (WHERE ca.status_id = 1),
+                   COUNT(ca.id) FILTER (WHERE ca.status_id = 2), COUNT(ca.id) FILTER (WHERE ca.status_id = 9)
+            FROM codingjobs j
+            LEFT JOIN coded_articles ca ON ca.codingjob_id = j.codingjob_id
+            GROUP BY j.codingjob_id;
+            """,
+            migrations.RunSQL.noop
+        ),
+    ]
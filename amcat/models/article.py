@@ -408,7 +408,8 @@ class Article(AmcatModel):
                 yield aid
 
     @classmethod
-    def create_articles(cls, articles, articleset=None, articlesets=None, deduplicate=True, monitor=NullMonitor()):
+    def create_articles(cls, articles, articleset=None, articlesets=None, deduplicate=True, monitor=NullMonitor(),
+                        add_to_sets=True):
         """
         Add the given articles to the database, the index, and the given set
 
@@ -416,6 +417,9 @@ class Article(AmcatModel):
 
         @param articles: a collection of objects with the necessary properties (.title etc)
         @param articleset(s): articleset object(s), specify either or none
+        @param add_to_sets: if False, new articles are indexed as members of the articlesets, but
+                            no articles are added to them in the database. The caller should add new
+                            articles (with add_to_index=False) and duplicates later.
         """
         monitor = monitor.submonitor(total=6)
         if articlesets is None:
@@ -471,7 +475,7 @@ class Article(AmcatModel):
             if article.id is None and article._duplicate is not None:
                 article.id = article._duplicate.id
 
-        if not articlesets:
+        if not articlesets or not add_to_sets:
             monitor.update(3)
             return articles
 
@@ -490,14 +494,6 @@ class Article(AmcatModel):
             else:
                 monitor.update()
 
-        # Add to articleset caches
-        properties = set()
-        for article in articles:
-            properties.update(article.properties.keys())
-
-        for articleset in articlesets:
-            articleset._add_to_property_cache(properties)
-
         return articles
 
 
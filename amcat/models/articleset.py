@@ -26,29 +26,59 @@ import functools
 import itertools
 import json
 import logging
-from typing import Set, Iterable
+import os
+from typing import Set, Iterable, Dict
 
 import django_redis
 import redis
 from django import db
-from django.db import connection
+from django.db import connection, transaction
 from django.db import models
 
 from amcat.models.article import Article
-from amcat.models.coding.codedarticle import CodedArticle
+from amcat.models.coding.codedarticle import CodedArticle, CodingJobProgress
 from amcat.tools import amcates, toolkit
 from amcat.tools.amcates import ES
 from amcat.tools.model import AmcatModel
 from amcat.tools.progress import NullMonitor
+from amcat.tools.codingcolumns import codings_changed
+from amcat.tools.querycache import QueryCache
 
 log = logging.getLogger(__name__)
 stats_log = logging.getLogger("statistics:" + __name__)
 
 
+# The property cache of an articleset is a Redis hash of property -> number of articles in
+# the set using it. The empty field marks the hash as complete: counts are updated when articles
+# are added or removed, but a hash without this marker is rebuilt (from postgres) when read.
+PROPERTY_CACHE_COMPLETE = ""
+
+PROPERTY_COUNTS_SQL = """
+SELECT p.property, COUNT(*)
+FROM articles a, jsonb_object_keys(a.properties) p(property)
+WHERE a.article_id = ANY(%s)
+GROUP BY p.property
+"""
+
+SET_PROPERTY_COUNTS_SQL = """
+SELECT p.property, COUNT(*)
+FROM articlesets_articles aa
+INNER JOIN articles a ON a.article_id = aa.article_id, jsonb_object_keys(a.properties) p(property)
+WHERE aa.articleset_id = %s
+GROUP BY p.property
+"""
+
+
 @functools.lru_cache()
 def _get_property_cache_key(id):
     db_name = db.connections.databases['default']['NAME']
-    return "{}.articleset.{}.properties".format(db_name, id)
+    return "{}.articleset.{}.property-counts".format(db_name, id)
+
+
+def _get_property_counts(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return dict(cursor.fetchall())
 
 
 def create_new_articleset(name, project):
@@ -110,8 +140,12 @@ class ArticleSet(AmcatModel):
 
         article_ids = {(art if type(art) is int else art.id) for art in article_ids}
 
-        # Only use articles that exist
-        to_add = article_ids - self.get_article_ids()
+        # Only use articles that exist and are not yet in this set. Only the given articles are checked,
+        # so adding articles in chunks does not fetch the complete set each time.
+        to_add = set(article_ids)
+        for batch in toolkit.splitlist(article_ids, itemsperbatch=10000):
+            existing = ArticleSetArticle.objects.filter(articleset=self, article_id__in=batch)
+            to_add -= set(existing.values_list("article_id", flat=True))
         to_add = list(Article.exists(to_add))
 
         monitor.update(message="Adding {n} articles to {aset}..".format(n=len(to_add), aset=self))
@@ -121,8 +155,11 @@ class ArticleSet(AmcatModel):
         )
 
         monitor.update(message="{n} articleset articles added to database, adding to codingjobs..".format(n=len(to_add)))
-        cjarts = [CodedArticle(codingjob=c, article_id=a) for c, a in itertools.product(self.codingjob_set.all(), to_add)]
+        codingjobs = list(self.codingjob_set.all())
+        cjarts = [CodedArticle(codingjob=c, article_id=a) for c, a in itertools.product(codingjobs, to_add)]
         CodedArticle.objects.bulk_create(cjarts)
+        if cjarts:
+            CodingJobProgress.refresh(c.id for c in codingjobs)
 
         if add_to_index:
             monitor.update(message="{n} articles added to codingjobs, adding to index".format(n=len(cjarts)))
@@ -132,27 +169,37 @@ class ArticleSet(AmcatModel):
         else:
             monitor.update(2)
 
-        # Add to property cache
-        properties = ES().get_used_properties(article_ids=to_add)
-        self._add_to_property_cache(properties)
+        if to_add:
+            self._update_property_cache(PROPERTY_COUNTS_SQL, [to_add], sign=1)
+            QueryCache().invalidate_articlesets([self.id])
 
     def get_used_properties(self) -> Set[str]:
         cache = django_redis.get_redis_connection()  # type: redis.client.StrictRedis
-        properties = cache.smembers(_get_property_cache_key(self.id))
+        counts = cache.hgetall(_get_property_cache_key(self.id))
 
-        if not properties:
-            properties = self._refresh_property_cache()
+        if PROPERTY_CACHE_COMPLETE.encode() not in counts:
+            counts = self._refresh_property_cache()
         else:
-            properties = {p.decode() for p in properties}
+            counts = {p.decode(): int(n) for p, n in counts.items()}
+
+        return {p for p, n in counts.items() if p != PROPERTY_CACHE_COMPLETE and n > 0}
 
-        return {p for p in properties if p}
+    def _update_property_cache(self, sql, params, sign):
+        """
+        Add (or subtract, if sign is -1) the property counts of the given articles to the cache.
+        The counts are determined now, but only added after the current transaction commits, so
+        rolled back changes are not counted.
+        """
+        counts = _get_property_counts(sql, params)
+        if counts:
+            transaction.on_commit(functools.partial(self._increment_property_cache, counts, sign))
 
-    def _add_to_property_cache(self, properties: Iterable[str]) -> Set[str]:
-        """Add properties to property cache"""
-        properties = {p.encode() for p in properties}
+    def _increment_property_cache(self, counts, sign):
         cache = django_redis.get_redis_connection()  # type: redis.client.StrictRedis
-        cache.sadd(_get_property_cache_key(self.id), "", *properties)
-        return {p.decode() for p in properties}
+        pipe = cache.pipeline()
+        for prop, n in counts.items():
+            pipe.hincrby(_get_property_cache_key(self.id), prop, sign * n)
+        pipe.execute()
 
     def _reset_property_cache(self):
         """Completely discard property cache"""
@@ -169,14 +216,28 @@ class ArticleSet(AmcatModel):
         if cache_keys:
             cache.delete(*cache_keys)
 
-    def _refresh_property_cache(self) -> Set[str]:
-        """Discard property cache and recalculate properties"""
-        from amcat.tools.amcates import ES
-        es = ES()
-        es.refresh()
-        properties = es.get_used_properties([self.id])
-        self._reset_property_cache()
-        return self._add_to_property_cache(properties)
+    def _refresh_property_cache(self) -> Dict[str, int]:
+        """
+        Recount the properties used by the articles in this set. The counts are read while
+        watching the cache, so counts incremented in the meantime cause a recount instead of
+        being overwritten.
+        """
+        key = _get_property_cache_key(self.id)
+        cache = django_redis.get_redis_connection()  # type: redis.client.StrictRedis
+        with cache.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    counts = _get_property_counts(SET_PROPERTY_COUNTS_SQL, [self.id])
+                    counts[PROPERTY_CACHE_COMPLETE] = 0
+
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.hmset(key, counts)
+                    pipe.execute()
+                    return counts
+                except redis.WatchError:
+                    continue
 
     def add(self, *articles):
         """add(*a) is an alias for add_articles(a)"""
@@ -197,10 +258,17 @@ class ArticleSet(AmcatModel):
         to_remove = {(art if type(art) is int else art.id) for art in articles}
 
         monitor.update(message="Deleting articles from database")
-        ArticleSetArticle.objects.filter(articleset=self, article__in=articles).delete()
+        removed = list(ArticleSetArticle.objects.filter(articleset=self, article__in=to_remove)
+                       .values_list("article_id", flat=True))
+        if removed:
+            self._update_property_cache(PROPERTY_COUNTS_SQL, [removed], sign=-1)
+        ArticleSetArticle.objects.filter(articleset=self, article__in=removed).delete()
 
         monitor.update(message="Deleting coded articles from database")
         CodedArticle.objects.filter(codingjob__articleset=self, article__in=articles).delete()
+        codingjob_ids = list(self.codingjob_set.values_list("id", flat=True))
+        CodingJobProgress.refresh(codingjob_ids)
+        codings_changed(codingjob_ids)
 
         if remove_from_index:
             monitor.update(message="Deleting from index")
@@ -209,7 +277,7 @@ class ArticleSet(AmcatModel):
             monitor.update()
 
         monitor.update(message="Deleting from cache")
-        self._reset_property_cache()
+        QueryCache().invalidate_articlesets([self.id])
 
     def get_article_ids(self, use_elastic=False) -> Set[int]:
         """
@@ -247,7 +315,6 @@ class ArticleSet(AmcatModel):
         self.save()
 
         # Also make sure property cache checks out
-        self._reset_property_cache()
         self._refresh_property_cache()
 
     def save(self, *args, **kargs):
@@ -276,6 +343,24 @@ class ArticleSet(AmcatModel):
                 return name2
             name2 = "{name} {i}".format(**locals())
 
+    @classmethod
+    def get_unique_names(cls, project, names):
+        """Return a unique name (see get_unique_name) for each of the given names, which are
+        also unique amongst themselves, using a single query"""
+        names = list(names)
+        # All candidate names start with the common prefix of the given names
+        existing = cls.objects.filter(project=project, name__startswith=os.path.commonprefix(names))
+        existing = set(existing.values_list("name", flat=True)) if names else set()
+
+        for name in names:
+            name2 = name
+            for i in itertools.count():
+                if name2 not in existing:
+                    break
+                name2 = "{name} {i}".format(**locals())
+            existing.add(name2)
+            yield name2
+
     @classmethod
     def create_set(cls, project, name, articles=None, favourite=True):
         aset = cls.objects.create(project=project, name=cls.get_unique_name(project, name))
@@ -319,6 +404,7 @@ class ArticleSet(AmcatModel):
 
         log.warn("Deleting set (and articlesetarticle references)")
         super(ArticleSet, self).delete() # cascade deletes all article references
+        self._reset_property_cache()
         log.warn("Done!")
 
 # Legacy
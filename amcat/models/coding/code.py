@@ -30,7 +30,10 @@ import logging
 log = logging.getLogger(__name__)
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
+from amcat.tools.codebookcache import CodebookCache
 from amcat.tools.model import AmcatModel, PostgresNativeUUIDField
 from amcat.models.language import Language
 
@@ -132,3 +135,16 @@ class Label(AmcatModel):
         unique_together = ('code', 'language')
         ordering = ("language__id",)
 
+
+@receiver(post_save, sender=Code)
+def invalidate_code_codebooks(sender, instance=None, created=None, **kwargs):
+    """Invalidate the shared trees (see amcat.tools.codebookcache) of the codebooks
+    containing a changed code. New codes are not in any codebook yet."""
+    if not created:
+        CodebookCache().invalidate_codes([instance.id])
+
+
+@receiver([post_save, post_delete], sender=Label)
+def invalidate_label_codebooks(sender, instance=None, **kwargs):
+    """Invalidate the shared trees of the codebooks containing the code of a changed label"""
+    CodebookCache().invalidate_codes([instance.code_id])
@@ -34,7 +34,10 @@ from collections import OrderedDict
 
 from django.db import models
 from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
+from amcat.tools.codebookcache import CodebookCache
 from amcat.tools.model import AmcatModel
 from amcat.models.coding.code import Code, Label
 from amcat.models import Language
@@ -308,11 +311,6 @@ class Codebook(AmcatModel):
             for cid, pid in hierarchy.items()
         )
 
-    def _get_aggregation_mapping(self):
-        for root in self.get_tree():
-            for child in root.children:
-                yield (child.label, root.label)
-
     def get_aggregation_mapping(self):
         """Returns a mapping from label to label, to allow substantive analysis in codingjob
         export options. That is, with the codebook:
@@ -327,13 +325,10 @@ class Codebook(AmcatModel):
 
             {B.label: A.label, C.label: A.label, F.label: D.label}
 
-        Only nodes which descend directly from the root nodes will be considerd.
-
-        Note: make sure labels are cached with cache_labels; this method will perform very
-        poorly without the cache ready.
+        Only nodes which descend directly from the root nodes will be considerd. The mapping
+        is computed from the shared codebook tree (see amcat.tools.codebookcache).
         """
-        if not self.cached: raise ValueError("Codebook not cached. Use .cache().")
-        return dict(self._get_aggregation_mapping())
+        return CodebookCache().get(self.id).get_aggregation_mapping()
 
     def get_code_ids(self, include_hidden=False, include_parents=False):
         """Returns a set of code_ids that are in this hierarchy
@@ -412,6 +407,7 @@ class Codebook(AmcatModel):
                 ccodes[child.id].parent = parent
 
         CodebookCode.objects.bulk_create(ccodes.values())
+        CodebookCache().invalidate([self.id])
         self.invalidate_cache()
 
     def add_code(self, code, parent=None, update_label_cache=True, **kargs):
@@ -513,27 +509,10 @@ class Codebook(AmcatModel):
         """
         Return a sequence of ancestor ids for this code, from the code itself up to a root of the codeobok
         @parem code: a Code object in this codebook
+        @raises KeyError: if the code is not in the (non-hidden) hierarchy
+        @raises ValueError: if the code is part of a cycle
         """
-        hierarchy = self._get_hierarchy_ids()
-
-        def _get_parent(code):
-            for child, parent in hierarchy.items():
-                if child == code:
-                    return parent
-            raise ValueError("Code {code!r} not in hierarchy!")
-
-        seen = set()
-        while True:
-            yield code_id
-            seen.add(code_id)
-            parent = hierarchy[code_id]  #_get_parent(code_id)
-            if parent is None:
-                return
-            elif parent in seen:
-                raise ValueError("Cycle in hierarchy: parent {parent} already in seen {seen}".format(**locals()))
-            seen.add(parent)
-
-            code_id = parent
+        return CodebookCache().get(self.id).get_ancestor_ids(code_id)
 
     def get_language_ids(self):
         """
@@ -602,3 +581,9 @@ class CodebookCode(AmcatModel):
         #unique_together = ("codebook", "code", "validfrom")
         # TODO: does not really work since NULL!=NULL
 
+
+@receiver([post_save, post_delete], sender=CodebookCode)
+def invalidate_codebook_cache(sender, instance=None, **kwargs):
+    """Invalidate the shared tree (see amcat.tools.codebookcache) of the codebook of a
+    changed codebookcode"""
+    CodebookCache().invalidate([instance.codebook_id])
@@ -22,12 +22,15 @@ import itertools
 
 
 from django.db import models, transaction, connection
+from django.db.models import F
 
 from functools import partial
 from django.db.models import sql
 from amcat.models.coding.codingschemafield import CodingSchemaField
 from amcat.models.coding.coding import CodingValue, Coding
+from amcat.tools.codingcolumns import CodingColumnCache
 from amcat.tools.djangotoolkit import bulk_insert_returning_ids
+from amcat.tools.querycache import QueryCache
 from amcat.tools.model import AmcatModel
 
 log = logging.getLogger(__name__)
@@ -42,6 +45,97 @@ class CodedArticleStatus(AmcatModel):
         db_table = 'coded_article_status'
         app_label = 'amcat'
 
+
+# Counter column of CodingJobProgress for each status
+STATUS_COUNTERS = collections.OrderedDict([
+    (STATUS_NOTSTARTED, "n_notstarted"), (STATUS_INPROGRESS, "n_inprogress"),
+    (STATUS_COMPLETE, "n_complete"), (STATUS_IRRELEVANT, "n_irrelevant")
+])
+
+REFRESH_PROGRESS_SQL = """
+INSERT INTO codingjob_progress (codingjob_id, {columns})
+SELECT j.codingjob_id, {counts}
+FROM codingjobs j
+LEFT JOIN coded_articles ca ON ca.codingjob_id = j.codingjob_id
+WHERE j.codingjob_id = ANY(%s)
+GROUP BY j.codingjob_id
+ON CONFLICT (codingjob_id) DO UPDATE SET {updates}
+""".format(
+    columns=", ".join(STATUS_COUNTERS.values()),
+    counts=", ".join("COUNT(ca.id) FILTER (WHERE ca.status_id = {})".format(s) for s in STATUS_COUNTERS),
+    updates=", ".join("{c} = EXCLUDED.{c}".format(c=c) for c in STATUS_COUNTERS.values()),
+)
+
+
+class CodingJobProgress(models.Model):
+    """
+    Number of coded articles of a codingjob per status. These counters are updated when
+    coded articles are saved and refreshed (using a single query) when coded articles are
+    created or deleted in bulk. Use the refresh_codingjob_progress command to correct any
+    counters which got out of sync.
+    """
+    codingjob = models.OneToOneField("amcat.CodingJob", primary_key=True, related_name="progress")
+    n_notstarted = models.IntegerField(default=0)
+    n_inprogress = models.IntegerField(default=0)
+    n_complete = models.IntegerField(default=0)
+    n_irrelevant = models.IntegerField(default=0)
+
+    @property
+    def n_articles(self):
+        return sum(getattr(self, c) for c in STATUS_COUNTERS.values())
+
+    @property
+    def n_done(self):
+        return self.n_complete + self.n_irrelevant
+
+    @property
+    def n_todo(self):
+        return self.n_notstarted + self.n_inprogress
+
+    @classmethod
+    def refresh(cls, codingjob_ids):
+        """Recount the coded articles of the given codingjobs"""
+        codingjob_ids = list(map(int, codingjob_ids))
+        if codingjob_ids:
+            with connection.cursor() as cursor:
+                cursor.execute(REFRESH_PROGRESS_SQL, [codingjob_ids])
+
+    @classmethod
+    def increment(cls, codingjob_id, counts):
+        """
+        Add counts to the counters of the given codingjob.
+
+        @param counts: {status_id: int}
+        """
+        updates = {STATUS_COUNTERS[s]: F(STATUS_COUNTERS[s]) + n for s, n in counts.items() if s in STATUS_COUNTERS}
+        if updates and not cls.objects.filter(codingjob_id=codingjob_id).update(**updates):
+            cls.refresh([codingjob_id])
+
+    @classmethod
+    def get(cls, codingjobs):
+        """
+        Get the progress of the given codingjobs using a single query, counting jobs which
+        have no progress yet.
+
+        @param codingjobs: CodingJob queryset
+        @return: {codingjob_id: CodingJobProgress}
+        """
+        result, missing = {}, []
+        for codingjob in codingjobs.select_related("progress"):
+            if hasattr(codingjob, "progress"):
+                result[codingjob.id] = codingjob.progress
+            else:
+                missing.append(codingjob.id)
+
+        if missing:
+            cls.refresh(missing)
+            result.update((p.codingjob_id, p) for p in cls.objects.filter(codingjob_id__in=missing))
+        return result
+
+    class Meta():
+        db_table = 'codingjob_progress'
+        app_label = 'amcat'
+
 def _to_coding(coded_article, coding):
     """
     Takes a dictionary with keys 'sentence_id', 'start', 'end', and creates
@@ -79,6 +173,81 @@ def _to_codingvalues(coding, values):
     return map(partial(_to_codingvalue, coding), values)
 
 
+def _get_coding_key(coding):
+    """Codings are matched on sentence, start and end (see CodedArticle.update_codings)"""
+    if isinstance(coding, Coding):
+        return coding.sentence_id, coding.start, coding.end
+    return coding.get("sentence_id"), coding.get("start"), coding.get("end")
+
+
+def _get_values_dict(values):
+    """Returns {field_id: (intval, strval)} for CodingValues or CodingDicts"""
+    if all(isinstance(v, CodingValue) for v in values):
+        return {v.field_id: (v.intval, v.strval) for v in values}
+    return {v.get("codingschemafield_id"): (v.get("intval"), v.get("strval")) for v in values}
+
+
+# Number of rows touched by CodedArticle.update_codings
+CodingChanges = collections.namedtuple("CodingChanges", [
+    "codings_inserted", "codings_deleted", "values_inserted", "values_updated", "values_deleted"
+])
+
+UPDATE_CODINGS_SQL = """
+WITH
+  deleted_values AS (
+    DELETE FROM codings_values WHERE codingvalue_id = ANY(%(delete_values)s::int[]) RETURNING 1
+  ),
+  deleted_codings AS (
+    DELETE FROM codings WHERE coding_id = ANY(%(delete_codings)s::int[]) RETURNING 1
+  ),
+  updated_values AS (
+    UPDATE codings_values cv SET intval = u.intval, strval = u.strval
+    FROM unnest(%(update_ids)s::int[], %(update_intvals)s::int[], %(update_strvals)s::text[]) AS u(id, intval, strval)
+    WHERE cv.codingvalue_id = u.id RETURNING 1
+  ),
+  new_codings AS (
+    SELECT nextval(pg_get_serial_sequence('codings', 'coding_id')) AS coding_id, n.*
+    FROM unnest(%(new_codings)s::int[], %(new_sentences)s::int[], %(new_starts)s::int[], %(new_ends)s::int[])
+         AS n(nr, sentence_id, start, "end")
+  ),
+  inserted_codings AS (
+    INSERT INTO codings (coding_id, coded_article_id, sentence_id, start, "end")
+    SELECT coding_id, %(coded_article)s, sentence_id, start, "end" FROM new_codings RETURNING 1
+  ),
+  inserted_values AS (
+    INSERT INTO codings_values (coding_id, field_id, intval, strval)
+    SELECT COALESCE(v.coding_id, n.coding_id), v.field_id, v.intval, v.strval
+    FROM unnest(%(value_codings)s::int[], %(value_new_codings)s::int[], %(value_fields)s::int[],
+                %(value_intvals)s::int[], %(value_strvals)s::text[])
+         AS v(coding_id, nr, field_id, intval, strval)
+    LEFT JOIN new_codings n ON (n.nr = v.nr)
+    RETURNING 1
+  )
+SELECT (SELECT COUNT(*) FROM inserted_codings), (SELECT COUNT(*) FROM deleted_codings),
+       (SELECT COUNT(*) FROM inserted_values), (SELECT COUNT(*) FROM updated_values),
+       (SELECT COUNT(*) FROM deleted_values)
+"""
+
+UPDATE_CODINGS_PARAMETERS = (
+    "delete_values", "delete_codings", "update_ids", "update_intvals", "update_strvals",
+    "new_codings", "new_sentences", "new_starts", "new_ends", "value_codings",
+    "value_new_codings", "value_fields", "value_intvals", "value_strvals"
+)
+
+BULK_CODINGS_SQL = """
+SELECT c.coded_article_id, c.coding_id, c.sentence_id, c.start, c."end",
+       cv.codingvalue_id, cv.field_id, cv.intval, cv.strval
+FROM codings c
+LEFT JOIN codings_values cv ON cv.coding_id = c.coding_id
+WHERE c.coded_article_id = ANY(%s)
+ORDER BY c.coded_article_id, c.coding_id, cv.codingvalue_id
+"""
+
+# Columns of the (nested) arrays returned by CodedArticle.get_codings_bulk
+BULK_CODING_COLUMNS = ("id", "sentence", "start", "end", "values")
+BULK_VALUE_COLUMNS = ("id", "field", "intval", "strval")
+
+
 class CodedArticle(models.Model):
     """
     A CodedArticle is an article in a context of two other objects: a codingjob and an
@@ -92,9 +261,27 @@ class CodedArticle(models.Model):
     article = models.ForeignKey("amcat.Article", related_name="coded_articles")
     codingjob = models.ForeignKey("amcat.CodingJob", related_name="coded_articles")
 
+    def __init__(self, *args, **kwargs):
+        super(CodedArticle, self).__init__(*args, **kwargs)
+        # Status as stored in the database, used to update CodingJobProgress. Read from __dict__,
+        # as accessing a deferred status would cost a query per object.
+        self._saved_status_id = self.__dict__.get("status_id")
+
     def __str__(self):
         return "Article: {self.article}, Codingjob: {self.codingjob}".format(**locals())
 
+    def save(self, *args, **kwargs):
+        created = self.pk is None
+        with transaction.atomic():
+            super(CodedArticle, self).save(*args, **kwargs)
+            if created:
+                CodingJobProgress.increment(self.codingjob_id, {self.status_id: 1})
+            elif self._saved_status_id is None:
+                CodingJobProgress.refresh([self.codingjob_id])
+            elif self.status_id != self._saved_status_id:
+                CodingJobProgress.increment(self.codingjob_id, {self._saved_status_id: -1, self.status_id: 1})
+        self._saved_status_id = self.status_id
+
     def set_status(self, status):
         """Set the status of this coding, deserialising status as needed"""
         if type(status) == int:
@@ -114,6 +301,28 @@ class CodedArticle(models.Model):
         for coding in codings:
             yield (coding, values_dict[coding.id])
 
+    @classmethod
+    def get_codings_bulk(cls, coded_article_ids):
+        """
+        Fetch the codings and values of multiple coded articles in a single query, as compact
+        (JSON serialisable) arrays. Each coding is represented as a list ordered as
+        BULK_CODING_COLUMNS, of which the values are lists ordered as BULK_VALUE_COLUMNS.
+
+        @param coded_article_ids: sequence of ints
+        @return: OrderedDict {coded_article_id: [coding]}, in the order of coded_article_ids
+        """
+        result = collections.OrderedDict((int(ca_id), []) for ca_id in coded_article_ids)
+        with connection.cursor() as cursor:
+            cursor.execute(BULK_CODINGS_SQL, [list(result)])
+            rows = cursor.fetchall()
+
+        for (ca_id, coding_id), rows in itertools.groupby(rows, key=lambda row: row[:2]):
+            rows = list(rows)
+            values = [list(row[5:]) for row in rows if row[5] is not None]
+            result[ca_id].append([coding_id] + list(rows[0][2:5]) + [values])
+
+        return result
+
     def _replace_codings(self, new_codings):
         # Updating tactic: delete all existing codings and codingvalues, then insert
         # the new ones. This prevents calculating a delta, and confronting the
@@ -130,6 +339,118 @@ class CodedArticle(models.Model):
 
         return (new_coding_objects, CodingValue.objects.bulk_create(coding_values))
 
+    def _get_changes(self, new_codings):
+        """
+        Determine the changes needed to go from the current codings to new_codings. Existing
+        codings with identical values are matched first, other codings are matched in order.
+
+        @return: dictionary with parameters for UPDATE_CODINGS_SQL
+        """
+        old = collections.defaultdict(list)
+        for coding, values in sorted(self.get_codings(), key=lambda cv: cv[0].id):
+            old[_get_coding_key(coding)].append((coding, values))
+
+        new = collections.defaultdict(list)
+        for coding in new_codings:
+            new[_get_coding_key(coding)].append(coding)
+
+        changes = collections.defaultdict(list)
+
+        def insert_values(coding_id, new_nr, values):
+            for field_id, (intval, strval) in values.items():
+                changes["value_codings"].append(coding_id)
+                changes["value_new_codings"].append(new_nr)
+                changes["value_fields"].append(field_id)
+                changes["value_intvals"].append(intval)
+                changes["value_strvals"].append(strval)
+
+        for key in set(old) | set(new):
+            olds, news = list(old[key]), []
+
+            # Skip codings which did not change at all
+            for coding in new[key]:
+                values = _get_values_dict(coding["values"])
+                same = next((o for o in olds if _get_values_dict(o[1]) == values), None)
+                if same is None:
+                    news.append(values)
+                else:
+                    olds.remove(same)
+
+            for (coding, old_values), values in zip(olds, news):
+                old_values = {v.field_id: v for v in old_values}
+                for field_id, value in old_values.items():
+                    if field_id not in values:
+                        changes["delete_values"].append(value.id)
+                    elif (value.intval, value.strval) != values[field_id]:
+                        changes["update_ids"].append(value.id)
+                        changes["update_intvals"].append(values[field_id][0])
+                        changes["update_strvals"].append(values[field_id][1])
+                insert_values(coding.id, None, {f: v for f, v in values.items() if f not in old_values})
+
+            for coding, old_values in olds[len(news):]:
+                changes["delete_codings"].append(coding.id)
+                changes["delete_values"].extend(v.id for v in old_values)
+
+            for values in news[len(olds):]:
+                nr = len(changes["new_codings"])
+                sentence_id, start, end = key
+                changes["new_codings"].append(nr)
+                changes["new_sentences"].append(sentence_id)
+                changes["new_starts"].append(start)
+                changes["new_ends"].append(end)
+                insert_values(None, nr, values)
+
+        return changes
+
+    def _update_codings(self, new_codings):
+        changes = self._get_changes(new_codings)
+        if not any(changes.values()):
+            return CodingChanges(0, 0, 0, 0, 0)
+
+        params = {name: changes[name] for name in UPDATE_CODINGS_PARAMETERS}
+        params["coded_article"] = self.id
+        with connection.cursor() as cursor:
+            cursor.execute(UPDATE_CODINGS_SQL, params)
+            return CodingChanges(*cursor.fetchone())
+
+    def _check_coding_dicts(self, coding_dicts):
+        values = tuple(itertools.chain.from_iterable(cd["values"] for cd in coding_dicts))
+        if any(v.get("intval") == v.get("strval") is None for v in values):
+            raise ValueError("intval and strval cannot both be None")
+
+        if any(v.get("intval") is not None and v.get("strval") is not None for v in values):
+            raise ValueError("intval and strval cannot both be not None")
+
+        schemas = (self.codingjob.unitschema_id, self.codingjob.articleschema_id)
+        fields = CodingSchemaField.objects.filter(codingschema__id__in=schemas)
+        field_ids = set(fields.values_list("id", flat=True)) | {None}
+
+        if any(v.get("codingschemafield_id") not in field_ids for v in values):
+            raise ValueError("codingschemafield_id must be in codingjob")
+
+    def _codings_changed(self):
+        """Update the caches depending on the codings of this coded article"""
+        CodingColumnCache().update(self)
+        QueryCache().invalidate_codingjobs([self.codingjob_id])
+
+    def update_codings(self, coding_dicts):
+        """
+        Like replace_codings, but only writes what changed. New codings are matched to
+        existing ones on sentence, start and end, and the resulting inserts, updates and
+        deletes are executed in a single statement. This prevents rewriting all codings
+        (and bloating codings_values) every time a coder saves.
+
+        @raises: see replace_codings
+        @returns: CodingChanges with the number of rows touched
+        """
+        coding_dicts = tuple(coding_dicts)
+        self._check_coding_dicts(coding_dicts)
+
+        with transaction.atomic():
+            result = self._update_codings(coding_dicts)
+            transaction.on_commit(self._codings_changed)
+            return result
+
     def replace_codings(self, coding_dicts):
         """
         Creates codings and replace currently existing ones. It takes one parameter
@@ -157,23 +478,12 @@ class CodedArticle(models.Model):
         @returns: ([Coding], [CodingValue])
         """
         coding_dicts = tuple(coding_dicts)
-
-        values = tuple(itertools.chain.from_iterable(cd["values"] for cd in coding_dicts))
-        if any(v.get("intval") == v.get("strval") is None for v in values):
-            raise ValueError("intval and strval cannot both be None")
-
-        if any(v.get("intval") is not None and v.get("strval") is not None for v in values):
-            raise ValueError("intval and strval cannot both be not None")
-
-        schemas = (self.codingjob.unitschema_id, self.codingjob.articleschema_id)
-        fields = CodingSchemaField.objects.filter(codingschema__id__in=schemas)
-        field_ids = set(fields.values_list("id", flat=True)) | {None}
-
-        if any(v.get("codingschemafield_id") not in field_ids for v in values):
-            raise ValueError("codingschemafield_id must be in codingjob")
+        self._check_coding_dicts(coding_dicts)
 
         with transaction.atomic():
-            return self._replace_codings(coding_dicts)
+            result = self._replace_codings(coding_dicts)
+            transaction.on_commit(self._codings_changed)
+            return result
 
     class Meta():
         db_table = 'coded_articles'
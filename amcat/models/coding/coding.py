@@ -29,6 +29,7 @@ from django.db import transaction
 
 from django.db import models
 
+from amcat.tools.codingcolumns import codings_changed
 from amcat.tools.model import AmcatModel
 from amcat.models.coding.codingschemafield import CodingSchemaField
 from amcat.models.sentence import Sentence
@@ -118,13 +119,22 @@ class Coding(AmcatModel):
     def update_values(self, values_dict):
         self.values.all().delete()
         CodingValue.objects.bulk_create(self._get_coding_value(f, v) for f, v in values_dict.items())
+        codings_changed([self.coded_article.codingjob_id])
 
     def save(self, *args, **kwargs):
         # This is deprecated behaviour intended to # WvA???
         if self._coded_article_changed:
             self.coded_article.save(*args, **kwargs)
             self._coded_article_changed = False
-        return super(Coding, self).save(*args, **kwargs)
+        result = super(Coding, self).save(*args, **kwargs)
+        codings_changed([self.coded_article.codingjob_id])
+        return result
+
+    def delete(self, *args, **kwargs):
+        codingjob_id = self.coded_article.codingjob_id
+        result = super(Coding, self).delete(*args, **kwargs)
+        codings_changed([codingjob_id])
+        return result
 
     ##############################################################
     #                         DEPRECATED                         #
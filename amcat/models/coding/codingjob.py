@@ -24,9 +24,16 @@ Coding Jobs are sets of articles assigned to users for manual coding.
 Each codingjob has codingschemas for articles and/or sentences.
 """
 
+import collections
+
+from django.conf import settings
+from django.db import connection, transaction
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from amcat.models import CodedArticle, ArticleSet
+from amcat.models import CodedArticle, ArticleSet, Article
+from amcat.models.coding.codedarticle import STATUS_NOTSTARTED, CodingJobProgress
+from amcat.tools.amcates import ES
+from amcat.tools.progress import NullMonitor
 
 from amcat.tools.model import AmcatModel
 from amcat.tools.table import table3
@@ -89,21 +96,90 @@ class CodingJob(AmcatModel):
         return self.coded_articles.get(article=article)
 
 
-def _create_codingjob_batches(codingjob, article_ids, batch_size):
-    name = codingjob.name
+CREATE_SETS_SQL = """
+INSERT INTO articlesets (project_id, name, featured)
+SELECT %s, unnest(%s::text[]), false
+RETURNING articleset_id, name
+"""
+
+ADD_ARTICLES_SQL = """
+INSERT INTO articlesets_articles (articleset_id, article_id)
+SELECT unnest(%s::int[]), unnest(%s::int[])
+"""
+
+CREATE_CODINGJOBS_SQL = """
+INSERT INTO codingjobs (project_id, name, unitschema_id, articleschema_id, insertdate, insertuser_id,
+                        coder_id, articleset_id, archived)
+SELECT %(project)s, t.name, %(unitschema)s, %(articleschema)s, NOW(), %(insertuser)s,
+       %(coder)s, t.articleset_id, false
+FROM unnest(%(names)s::text[], %(articlesets)s::int[]) AS t(name, articleset_id)
+RETURNING codingjob_id
+"""
+
+CREATE_CODED_ARTICLES_SQL = """
+INSERT INTO coded_articles (codingjob_id, article_id, status_id)
+SELECT j.codingjob_id, aa.article_id, %(status)s
+FROM codingjobs j
+INNER JOIN articlesets_articles aa ON aa.articleset_id = j.articleset_id
+WHERE j.codingjob_id = ANY(%(codingjobs)s)
+"""
+
 
-    for i, batch in enumerate(splitlist(article_ids, batch_size)):
-        codingjob.pk = None
-        codingjob.name = "{name} - {i}".format(i=i+1, name=name)
-        codingjob.articleset = ArticleSet.create_set(
-            project=codingjob.project,
-            name=codingjob.name,
-            favourite=False,
-            articles=batch,
-        )
+def _create_codingjob_batches(codingjob, article_ids, batch_size, monitor=NullMonitor(), split_sentences=None):
+    """
+    Create a codingjob (and articleset) for each batch of articles, using a fixed number
+    of queries, a single elastic bulk request and a single refresh. Codingjobs are inserted
+    directly, so the post_save signal of CodingJob is not sent.
 
-        codingjob.save()
-        yield codingjob.pk
+    @param split_sentences: queue a task splitting the articles into sentences. Defaults
+                            to settings.CODINGJOB_SPLIT_SENTENCES.
+    @return: the ids of the created codingjobs
+    """
+    monitor = monitor.submonitor(total=4)
+
+    article_ids = [(aid if type(aid) is int else aid.id) for aid in article_ids]
+    existing = set(Article.exists(article_ids, batch_size=10000))
+    article_ids = [aid for aid in collections.OrderedDict.fromkeys(article_ids) if aid in existing]
+    batches = list(splitlist(article_ids, batch_size))
+    if not batches:
+        monitor.update(4)
+        return []
+
+    monitor.update(message="Creating {} articlesets..".format(len(batches)))
+    names = ["{name} - {i}".format(i=i + 1, name=codingjob.name) for i in range(len(batches))]
+    set_names = list(ArticleSet.get_unique_names(codingjob.project, names))
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(CREATE_SETS_SQL, [codingjob.project_id, set_names])
+        set_ids = {name: set_id for set_id, name in cursor.fetchall()}
+        set_ids = [set_ids[name] for name in set_names]
+
+        cursor.execute(ADD_ARTICLES_SQL, [
+            [set_id for set_id, batch in zip(set_ids, batches) for _ in batch],
+            [aid for batch in batches for aid in batch],
+        ])
+
+        monitor.update(message="Creating {} codingjobs..".format(len(batches)))
+        cursor.execute(CREATE_CODINGJOBS_SQL, {
+            "project": codingjob.project_id, "names": names, "articlesets": set_ids,
+            "unitschema": codingjob.unitschema_id, "articleschema": codingjob.articleschema_id,
+            "insertuser": codingjob.insertuser_id, "coder": codingjob.coder_id
+        })
+        codingjob_ids = sorted(row[0] for row in cursor.fetchall())
+        cursor.execute(CREATE_CODED_ARTICLES_SQL, {"codingjobs": codingjob_ids, "status": STATUS_NOTSTARTED})
+        CodingJobProgress.refresh(codingjob_ids)
+
+        monitor.update(message="Adding {} articles to index..".format(len(article_ids)))
+        es = ES()
+        es.add_to_sets(dict(zip(set_ids, batches)))
+        es.refresh()
+
+        if settings.CODINGJOB_SPLIT_SENTENCES if split_sentences is None else split_sentences:
+            from amcat.tools.sbd import split_codingjob_sentences
+            split_codingjob_sentences(codingjob_ids, codingjob.insertuser, codingjob.project)
+
+    monitor.update()
+    return codingjob_ids
 
 
 def create_codingjob_batches(codingjob, article_ids, batch_size):
@@ -135,6 +211,11 @@ def create_coded_articles(sender, instance=None, created=None, **kwargs):
     aids = instance.articleset.articles.all().values_list("id", flat=True)
     coded_articles = (CodedArticle(codingjob=instance, article_id=aid) for aid in aids)
     CodedArticle.objects.bulk_create(coded_articles)
+    CodingJobProgress.refresh([instance.id])
+
+    if settings.CODINGJOB_SPLIT_SENTENCES:
+        from amcat.tools.sbd import split_codingjob_sentences
+        split_codingjob_sentences([instance.id], instance.insertuser, instance.project)
 
 class SchemaFieldColumn(table3.ObjectColumn):
     def __init__(self, field):
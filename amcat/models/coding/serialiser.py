@@ -35,6 +35,7 @@ log = logging.getLogger(__name__)
 
 from amcat.models.coding.code import Code
 from amcat.models.coding.codebook import Codebook
+from amcat.tools.codebookcache import CodebookCache
 from django import forms
 import functools
 
@@ -202,14 +203,25 @@ class _CodebookSerialiser(BaseSerialiser):
         yield "labels", forms.BooleanField(initial=True, label="labels", required=False)
         yield "parents", forms.IntegerField(initial=0, required=False, label="# parents")
 
+    def _get_tree(self):
+        return CodebookCache().get(self.field.codebook_id)
+
+    def _get_label(self, value):
+        """Get the label of the code with id value, using the shared codebook tree if possible"""
+        tree = self._get_tree()
+        if value in tree:
+            return tree.get_label(value)
+        return self.value_label(self.deserialise(value))
+
     def _get_ancestor(self, value, i, label=False):
+        """Get the ancestor of value at depth i (or value itself, if it is not that deep)"""
         try:
-            ancestors = list(self.field.codebook.get_ancestor_ids(value))
+            index = self._get_tree().get_index()
+            ancestor_id = index.get_ancestor_id(value, min(i, index.get_depth(value)))
         except (KeyError, ValueError):
             log.exception("Error on getting ancestors for {value}".format(**locals()))
             return None
-        ancestor_id = ancestors[max(0, len(ancestors) - i - 1)]
-        return self.value_label(self.deserialise(ancestor_id)) if label else ancestor_id
+        return self._get_label(ancestor_id) if label else ancestor_id
 
     def get_export_columns(self, ids, labels, parents, **options):
         if parents:
@@ -221,4 +233,4 @@ class _CodebookSerialiser(BaseSerialiser):
         if ids:
             yield " (id)", lambda x: x
         if labels:
-            yield "", lambda x: self.value_label(self.deserialise(x))
+            yield "", self._get_label
@@ -380,11 +380,9 @@ class TestCodebook(amcattest.AmCATTestCase):
         D.add_code(b)
         D.add_code(c, b)
 
-        # Codebook not cached
-        self.assertRaises(ValueError, D.get_aggregation_mapping)
+        # The mapping is computed from the shared codebook tree, so D does not need to be cached
+        self.assertEqual({u'c': u'b', u'e': u'd', u'f': u'd'}, D.get_aggregation_mapping())
         D.cache()
-
-        # Codebook cached
         self.assertEqual({u'c': u'b', u'e': u'd', u'f': u'd'}, D.get_aggregation_mapping())
 
     def test_get_language_ids(self):
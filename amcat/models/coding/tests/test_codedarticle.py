@@ -18,7 +18,7 @@
 ###########################################################################
 from django.db.utils import IntegrityError
 from amcat.models import CodedArticleStatus, STATUS_NOTSTARTED, STATUS_INPROGRESS, STATUS_COMPLETE, \
-    STATUS_IRRELEVANT, CodedArticle
+    STATUS_IRRELEVANT, CodedArticle, CodingJob, CodingJobProgress
 
 from amcat.tools import amcattest
 
@@ -102,6 +102,79 @@ class TestCodedArticle(amcattest.AmCATTestCase):
         self.assertEqual(value.strval, "a")
         self.assertEqual(value.intval, None)
 
+    def test_update_codings(self):
+        schema, codebook, strf, intf, codef, _, _ = amcattest.create_test_schema_with_fields(isarticleschema=True)
+        sschema, _, sstrf, sintf, _, _, _ = amcattest.create_test_schema_with_fields(isarticleschema=False)
+        codingjob = amcattest.create_test_job(articleschema=schema, unitschema=sschema, narticles=1)
+        coded_article = CodedArticle.objects.get(codingjob=codingjob)
+        s1, s2 = [amcattest.create_test_sentence(article=coded_article.article) for _ in range(2)]
+
+        def get_codings():
+            return {(c.sentence_id, c.start, c.end, v.field_id, v.intval, v.strval)
+                    for c, values in coded_article.get_codings() for v in values}
+
+        article_coding = self._get_coding_dict(field_id=intf.id, intval=1)
+        article_coding["values"].append({"codingschemafield_id": strf.id, "strval": "a"})
+        sentence_coding = self._get_coding_dict(sentence_id=s1.id, field_id=sintf.id, intval=2)
+        codings = [article_coding, sentence_coding]
+
+        changes = coded_article.update_codings(codings)
+        self.assertEqual(changes, (2, 0, 3, 0, 0))
+        self.assertEqual(get_codings(), {
+            (None, None, None, intf.id, 1, None), (None, None, None, strf.id, None, "a"),
+            (s1.id, None, None, sintf.id, 2, None)
+        })
+        coding_ids = set(coded_article.codings.values_list("id", flat=True))
+
+        # Saving the same codings should not touch anything: only validate, read codings and
+        # create / release a savepoint
+        with self.checkMaxQueries(5):
+            self.assertEqual(coded_article.update_codings(codings), (0, 0, 0, 0, 0))
+
+        # Change a value, remove a value, add a sentence coding on another sentence
+        article_coding["values"] = [{"codingschemafield_id": intf.id, "intval": 3}]
+        codings.append(self._get_coding_dict(sentence_id=s2.id, start=1, end=2, field_id=sstrf.id, strval="b"))
+        self.assertEqual(coded_article.update_codings(codings), (1, 0, 1, 1, 1))
+        self.assertEqual(get_codings(), {
+            (None, None, None, intf.id, 3, None), (s1.id, None, None, sintf.id, 2, None),
+            (s2.id, 1, 2, sstrf.id, None, "b")
+        })
+
+        # Existing codings should have been kept
+        self.assertLess(coding_ids, set(coded_article.codings.values_list("id", flat=True)))
+
+        # Removing codings deletes them with their values
+        self.assertEqual(coded_article.update_codings(codings[:1]), (0, 2, 0, 0, 2))
+        self.assertEqual(get_codings(), {(None, None, None, intf.id, 3, None)})
+
+        # Same validation as replace_codings
+        self.assertRaises(ValueError, coded_article.update_codings, [self._get_coding_dict(field_id=intf.id)])
+        self.assertRaises(IntegrityError, coded_article.update_codings, [self._get_coding_dict(intval=1)])
+
+    def test_get_codings_bulk(self):
+        schema, codebook, strf, intf, codef, _, _ = amcattest.create_test_schema_with_fields(isarticleschema=True)
+        codingjob = amcattest.create_test_job(articleschema=schema, narticles=3)
+        ca1, ca2, ca3 = codingjob.coded_articles.order_by("id")
+
+        ca1.replace_codings([self._get_coding_dict(intval=10, field_id=intf.id),
+                             self._get_coding_dict(strval="bla", field_id=strf.id, start=1, end=2)])
+        ca2.replace_codings([dict(self._get_coding_dict(), values=[])])
+
+        with self.checkMaxQueries(1):
+            result = CodedArticle.get_codings_bulk([ca3.id, ca2.id, ca1.id])
+
+        self.assertEqual(list(result), [ca3.id, ca2.id, ca1.id])
+        self.assertEqual(result[ca3.id], [])
+
+        coding, = ca2.codings.all()
+        self.assertEqual(result[ca2.id], [[coding.id, None, None, None, []]])
+
+        codings = {c.start: c for c in ca1.codings.all()}
+        value1, value2 = codings[None].values.get(), codings[1].values.get()
+        self.assertEqual(sorted(result[ca1.id], key=lambda c: c[0]), sorted([
+            [codings[None].id, None, None, None, [[value1.id, intf.id, 10, None]]],
+            [codings[1].id, None, 1, 2, [[value2.id, strf.id, None, "bla"]]],
+        ], key=lambda c: c[0]))
 
 class TestCodedArticleStatus(amcattest.AmCATTestCase):
     def test_status(self):
@@ -119,3 +192,37 @@ class TestCodedArticleStatus(amcattest.AmCATTestCase):
         self.assertEqual(ca.status, CodedArticleStatus.objects.get(pk=0))
 
 
+class TestCodingJobProgress(amcattest.AmCATTestCase):
+    def _get_counts(self, job):
+        progress = CodingJobProgress.objects.get(codingjob=job)
+        return progress.n_notstarted, progress.n_inprogress, progress.n_complete, progress.n_irrelevant
+
+    def test_progress(self):
+        job = amcattest.create_test_job(narticles=3)
+        self.assertEqual(self._get_counts(job), (3, 0, 0, 0))
+
+        ca1, ca2, _ = job.coded_articles.all()
+        ca1.set_status(STATUS_INPROGRESS)
+        ca2.status_id = STATUS_COMPLETE
+        ca2.save()
+        ca2.save()
+        self.assertEqual(self._get_counts(job), (1, 1, 1, 0))
+
+        a = amcattest.create_test_article()
+        job.articleset.add_articles([a])
+        self.assertEqual(self._get_counts(job), (2, 1, 1, 0))
+
+        job.articleset.remove_articles([ca1.article])
+        self.assertEqual(self._get_counts(job), (2, 0, 1, 0))
+
+        progress = CodingJobProgress.get(CodingJob.objects.filter(id=job.id))[job.id]
+        self.assertEqual((progress.n_articles, progress.n_done, progress.n_todo), (3, 1, 2))
+
+    def test_get(self):
+        job = amcattest.create_test_job(narticles=2)
+        CodingJobProgress.objects.filter(codingjob=job).delete()
+
+        # Missing counters are recounted
+        progress = CodingJobProgress.get(CodingJob.objects.filter(id=job.id))
+        self.assertEqual(progress[job.id].n_notstarted, 2)
+        self.assertEqual(self._get_counts(job), (2, 0, 0, 0))
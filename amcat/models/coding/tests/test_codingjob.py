@@ -18,6 +18,7 @@
 ###########################################################################
 from amcat.models import CodedArticle, CodingJob, create_codingjob_batches
 from amcat.tools import amcattest
+from amcat.tools.amcates import ES
 
 class TestCodingJob(amcattest.AmCATTestCase):
     def test_create(self):
@@ -55,4 +56,25 @@ class TestCodingJob(amcattest.AmCATTestCase):
         cjs = create_codingjob_batches(cj, arts, 3)
         self.assertEqual(4, len(cjs))
 
+    def test_create_codingjob_batches_contents(self):
+        a = amcattest.create_test_set(10)
+        cj = CodingJob(project=a.project, name="foo", coder=amcattest.create_test_user(),
+                       insertuser=amcattest.create_test_user())
+        arts = list(a.articles.all().order_by("id").values_list("id", flat=True))
+
+        # Sets and codingjobs are created using a fixed number of queries
+        with self.checkMaxQueries(10, "Create codingjob batches"):
+            cjs = list(create_codingjob_batches(cj, arts + [arts[0]], 3).order_by("id"))
+
+        self.assertEqual([j.name for j in cjs], ["foo - 1", "foo - 2", "foo - 3", "foo - 4"])
+        self.assertEqual([j.articleset.name for j in cjs], ["foo - 1", "foo - 2", "foo - 3", "foo - 4"])
+        for j, batch in zip(cjs, [arts[0:3], arts[3:6], arts[6:9], arts[9:]]):
+            self.assertEqual(set(j.articleset.get_article_ids()), set(batch))
+            self.assertEqual(set(j.coded_articles.values_list("article_id", flat=True)), set(batch))
+            self.assertEqual(set(ES().query_ids(filters={"sets": [j.articleset.id]})), set(batch))
+
+        # Names of existing sets are not reused
+        cjs = create_codingjob_batches(cj, arts, 5)
+        self.assertEqual({j.articleset.name for j in cjs}, {"foo - 1 0", "foo - 2 0"})
+
 
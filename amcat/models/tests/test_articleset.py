@@ -22,6 +22,8 @@ from amcat.tools import amcattest
 from amcat.tools.amcates import ES
 
 import elasticsearch
+from django.db import transaction
+from unittest import mock
 
 
 class TestArticleSet(amcattest.AmCATTestCase):
@@ -107,7 +109,9 @@ class TestArticleSet(amcattest.AmCATTestCase):
         self.assertEqual(ES().get(arts[6].id)['id'], arts[6].id)
 
     @amcattest.use_elastic
-    def test_property_cache(self):
+    @mock.patch.object(transaction, "on_commit", side_effect=lambda func: func())
+    def test_property_cache(self, _):
+        # on_commit hooks do not fire in a test case, so run them immediately
         aset = amcattest.create_test_set()
 
         a1 = amcattest.create_test_article(properties={"aap": "noot", "jan": "mies"})
@@ -126,3 +130,37 @@ class TestArticleSet(amcattest.AmCATTestCase):
 
         aset.remove_articles([a2.id])
         self.assertEqual(aset.get_used_properties(), set())
+
+    @amcattest.use_elastic
+    @mock.patch.object(transaction, "on_commit", side_effect=lambda func: func())
+    def test_property_counts(self, on_commit):
+        aset = amcattest.create_test_set()
+        a1 = amcattest.create_test_article(properties={"aap": "noot", "jan": "mies"})
+        a2 = amcattest.create_test_article(properties={"aap": "noot2"})
+        aset.add_articles([a1.id, a2.id])
+
+        # Properties are counted, so they are only removed with the last article using them
+        aset.remove_articles([a1.id])
+        self.assertEqual(aset.get_used_properties(), {"aap"})
+
+        # Removing articles not in the set does not change counts
+        aset.remove_articles([a1.id])
+        self.assertEqual(aset.get_used_properties(), {"aap"})
+
+        # Counts are rebuilt from the database if lost
+        aset._reset_property_cache()
+        self.assertEqual(aset.get_used_properties(), {"aap"})
+        aset.add_articles([a1.id])
+        self.assertEqual(aset.get_used_properties(), {"aap", "jan"})
+
+        amcattest.create_test_article(properties={"vuur": "paal"}, articleset=aset)
+        self.assertEqual(aset.get_used_properties(), {"aap", "jan", "vuur"})
+
+        # Counts are only changed once the transaction commits
+        hooks = []
+        on_commit.side_effect = hooks.append
+        aset.remove_articles([a1.id])
+        self.assertEqual(aset.get_used_properties(), {"aap", "jan", "vuur"})
+        for hook in hooks:
+            hook()
+        self.assertEqual(aset.get_used_properties(), {"aap", "vuur"})
@@ -24,17 +24,15 @@ import logging; log = logging.getLogger(__name__)
 
 from amcat.scripts.script import Script
 from amcat.models import ArticleSet
-from hashlib import sha224 as hash_class
 from django import forms
-from amcat.tools import amcates
-import json
-import collections
-
-FIELDS = ["text", "title", "date", "creator", "medium", "byline", "section", "page", "addressee", "length"]
+from amcat.tools.deduplicate import Deduplicator, FIELDS
+from array import array
 
 class DeduplicateSet(Script):
     """
-    Deduplicate an articleset, optionally using a limited set of fields
+    Deduplicate an articleset, optionally using a limited set of fields. If near_duplicates
+    is set, articles with a similar title and text (such as syndicated copies with a different
+    byline) are removed as well; the skip_* options are ignored in that case.
     """
 
     class options_form(forms.Form):
@@ -62,27 +60,29 @@ class DeduplicateSet(Script):
         save_duplicates_to = forms.CharField(initial="", required=False, 
                                              help_text="If not empty, save duplicates to new set with this name.")
 
+        near_duplicates = forms.BooleanField(initial=False, required=False,
+                                             help_text="Also find articles with a similar title and text")
+        threshold = forms.FloatField(initial=0.9, min_value=0.0, max_value=1.0, required=False,
+                                     help_text="Similarity above which articles are near duplicates")
+
         dry_run = forms.BooleanField(initial=False, required=False,
                                      help_text="Prints all duplicates but doesn't remove them")
 
-    def _run(self, articleset, save_duplicates_to, dry_run, **_):
-        hashes = collections.defaultdict(set)
-        for i, (id, h) in enumerate(self.get_hashes()):
-            if not i%100000:
-                logging.info("Collecting hashes, n={i}, |hashes|={n}".format(n=len(hashes), **locals()))
-            hashes[h].add(id)
+    def _run(self, articleset, save_duplicates_to, dry_run, near_duplicates, threshold, **_):
+        fields = [f for f in FIELDS if not self.options.get("skip_{}".format(f))]
+        deduplicator = Deduplicator(fields=fields, near=near_duplicates,
+                                    threshold=0.9 if threshold is None else threshold)
 
-        hashes = {hash: ids for (hash, ids) in hashes.items() if len(ids)>1}
-        logging.info("Duplicates founds for {} articles".format(len(hashes)))
+        article_ids = array("q", articleset.articles.order_by("id").values_list("id", flat=True).iterator())
+        logging.info("Finding duplicates in {} articles".format(len(article_ids)))
+        groups = deduplicator.get_duplicates(article_ids, monitor=self.progress_monitor)
+        logging.info("Found {} groups of duplicates".format(len(groups)))
 
         to_remove = set()
-        logging.info("Iterating over hashes")
-        for i, (hash, ids) in enumerate(hashes.items()):
+        for ids in groups:
             if dry_run:
                 logging.info("Duplicates: {ids}".format(**locals()))
-            to_remove |= set(sorted(ids)[1:])
-            if not i % 100000:
-                logging.info("Iterating over hashes {i}/{n}, |to_remove|={m}".format(n=len(hashes), m=len(to_remove), **locals()))
+            to_remove.update(ids[1:])
 
         n = len(to_remove)
         if not to_remove:
@@ -97,24 +97,6 @@ class DeduplicateSet(Script):
                 dupes_article_set = ArticleSet.create_set(articleset.project, save_duplicates_to, to_remove)
         return n, dry_run
 
-    def get_hashes(self):
-        fields =  [f for f in FIELDS if not self.options.get("skip_{}".format(f))]
-        if fields == FIELDS:
-            fields = ["hash"]
-        setid = self.options['articleset'].id
-        for x in amcates.ES().scan(query={"query" : {"constant_score" : {"filter": {"term": {"sets": setid}}}}},
-                                   fields=fields):
-            if fields == ["hash"]:
-                hash = x['fields']['hash'][0]
-            else:
-                def get(flds, f):
-                    val = flds.get(f)
-                    return val[0] if val is not None else val
-                    
-                d = {f: get(x['fields'], f) for f in fields}
-                hash = hash_class(json.dumps(d)).hexdigest()
-            yield int(x['_id']), hash
-
 
 if __name__ == '__main__':
     from amcat.scripts.tools.cli import run_cli
@@ -26,6 +26,7 @@ from django import forms
 #from amcat.tools import dbtoolkit
 from amcat.scripts.script import Script
 from amcat.models import CodingJob, CodingValue, Code, Project, CodingSchemaField
+from amcat.tools.codingcolumns import codings_changed
 
 def get_fixed_code(labels, code_id):
     try:
@@ -58,6 +59,7 @@ def fix_field(job, field):
             else:
                 problems.add(cv.intval)
 
+    codings_changed([job.id])
     return problems
     
 class FixCodes(Script):
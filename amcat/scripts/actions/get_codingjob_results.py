@@ -20,21 +20,28 @@
 import csv
 import datetime
 import logging
+import uuid
 
 from io import StringIO
 
 from django import forms
+from django.db import connection, transaction
 from django.forms import ModelChoiceField, BooleanField
 from django.utils.datastructures import MultiValueDict
 from django.db.models import Q
 
 from amcat.scripts.forms import ModelMultipleChoiceFieldWithIdLabel
 from amcat.models import CodingJob, CodingSchemaField, CodingSchema, Project, Codebook, Language
-from amcat.models import Article, Sentence
+from amcat.models import Article, Sentence, CodedArticle
 from amcat.scripts.script import Script
 from amcat.tools.table import table3
+from amcat.tools.table.export import EXPORTERS
 from amcat.tools.table.tableoutput import table2csv
 from amcat.tools.progress import NullMonitor
+from amcat.tools import toolkit
+from amcat.tools.codebookcache import CodebookCache
+from amcat.tools.codingcolumns import CodingColumnCache
+from amcat.tools.exportfiles import create_export_file
 
 
 log = logging.getLogger(__name__)
@@ -63,17 +70,27 @@ CODING_LEVELS = [
     (CODING_LEVEL_BOTH, "Article and Sentence Codings"),
 ]
 
-ExportFormat = collections.namedtuple('ExportFormat', ["label", "function", "mimetype"])
+# Number of coded articles for which codings, articles and sentences are fetched at once
+CHUNK_SIZE = 1000
+
+# If to_file is given, the export is written incrementally to a file and a file-backed
+# download is returned. Otherwise, function should return the exported table.
+ExportFormat = collections.namedtuple('ExportFormat', ["label", "function", "mimetype", "to_file"])
 
 def _table_to_csv(table):
     buffer = StringIO()
     writer = csv.writer(buffer, delimiter=",")
     return table2csv(table, writer, buffer).getvalue()
 
+def _table_to_csv_file(table, filename):
+    with open(filename, "w", encoding="utf-8", newline="") as f:
+        table2csv(table, csv.writer(f, delimiter=","), f)
+
 EXPORT_FORMATS = (
-    ExportFormat(label="csv", function=_table_to_csv, mimetype="text/csv"),
-    ExportFormat(label="xlsx", function=lambda t: t.export(format='xlsx'), mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
-    ExportFormat(label="json", function=lambda t: json.dumps(list(t.to_list())), mimetype=None),
+    ExportFormat(label="csv", function=_table_to_csv, mimetype="text/csv", to_file=_table_to_csv_file),
+    ExportFormat(label="xlsx", function=lambda t: t.export(format='xlsx'), mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                 to_file=EXPORTERS["xlsx"].to_file),
+    ExportFormat(label="json", function=lambda t: json.dumps(list(t.to_list())), mimetype=None, to_file=None),
 )
 
 _MetaField = collections.namedtuple("MetaField", ["object", "attr", "label"])
@@ -246,76 +263,115 @@ CodingRow = collections.namedtuple('CodingRow',
                                    ['job', 'coded_article', 'article', 'sentence', 'article_coding', 'sentence_coding'])
 
 
-def _get_rows(jobs, include_sentences=False, include_multiple=True, include_uncoded_articles=False, include_uncoded_sentences=False,
-              progress_monitor=NullMonitor()):
+def _iter_server_side(queryset, itersize=CHUNK_SIZE):
     """
-    @param jobs: output rows for these jobs. Make sure this is a QuerySet object with .prefetch_related("codings__values")
-    @param include_sentences: include sentence level codings (if False, row.sentence and .sentence_coding are always None)
-    @param include_multiple: include multiple codedarticles per article
-    @param include_uncoded_articles: include articles without corresponding codings
+    Yield the rows of a values_list queryset using a server-side (named) cursor, so rows are
+    transferred from postgres in chunks of itersize instead of all at once.
     """
-    art_filter = Q(coded_articles__codingjob__in=jobs)
-    if include_uncoded_articles:
-        art_filter |= Q(articlesets_set__codingjob_set__in=jobs)
-
-    job_articles = {a.id: a for a in Article.objects.filter(art_filter)}
-    job_sentences = {s.id: s for s in Sentence.objects.filter(article__id__in=job_articles.keys())}
-
-    # Mapping of article -> sentences
-    article_sentences = collections.defaultdict(set)
-    for sentence_id, sentence in job_sentences.items():
-        article_sentences[sentence.article_id].add(sentence_id)
-
-    # Articles that have been seen in a codingjob already (so we can skip duplicate codings on the same article)
-    seen_articles = set()
+    sql, params = queryset.query.sql_with_params()
+    with transaction.atomic():
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(name="export_{}".format(uuid.uuid4().hex))
+        cursor.itersize = itersize
+        try:
+            cursor.execute(sql, params)
+            yield from cursor
+        finally:
+            cursor.close()
+
+
+def _get_chunk_rows(job, columns, chunk, include_sentences, include_multiple, include_uncoded_sentences, seen_articles):
+    """
+    Yield the rows for a chunk of (coded_article_id, article_id) tuples of the given job. Codings
+    (with their values) are taken from the coding columns of this chunk, articles and sentences
+    are fetched for this chunk only.
+    """
+    coded_articles = CodedArticle.objects.in_bulk([ca_id for ca_id, _ in chunk])
+    articles = Article.objects.in_bulk({aid for _, aid in chunk})
 
-    for i, job in enumerate(jobs):
-        # Get all codings in dicts for later lookup
-        coded_articles = set()
+    # {ca: coding}
+    article_codings = {}
 
-        # {ca: coding}
-        article_codings = {}
+    # {ca: {sentence_id : [codings]}}
+    sentence_codings = collections.defaultdict(lambda: collections.defaultdict(list))
 
-        # {ca: {sentence_id : [codings]}}
-        sentence_codings = collections.defaultdict(lambda: collections.defaultdict(list))
+    for c in columns.filter(coded_articles).get_codings():
+        if c.sentence_id is None:
+            if c.coded_article_id not in article_codings:  # HACK, take first entry of duplicate article codings (#79)
+                article_codings[c.coded_article_id] = c
+        elif include_sentences:
+            sentence_codings[c.coded_article_id][c.sentence_id].append(c)
 
-        for ca in job.coded_articles.order_by('id').prefetch_related("codings__values"):
-            coded_articles.add(ca)
-            for c in ca.codings.all():
-                if c.sentence_id is None:
-                    if ca not in article_codings:  # HACK, take first entry of duplicate article codings (#79)
-                        article_codings[ca.id] = c
-                else:
-                    sentence_codings[ca.id][c.sentence_id].append(c)
+    # Mapping of article -> sentences
+    sentences, article_sentences = {}, collections.defaultdict(set)
+    if include_sentences:
+        if include_uncoded_sentences:
+            sentences = Sentence.objects.filter(article_id__in=articles)
+        else:
+            sentences = Sentence.objects.filter(id__in={sid for sc in sentence_codings.values() for sid in sc})
+        sentences = {s.id: s for s in sentences}
+        for sentence in sentences.values():
+            article_sentences[sentence.article_id].add(sentence.id)
+
+    # output the rows for this chunk
+    for ca_id, aid in chunk:
+        ca, a = coded_articles[ca_id], articles[aid]
+        if aid in seen_articles and not include_multiple:
+            continue
+
+        article_coding = article_codings.get(ca_id)
+        sentence_ids = sentence_codings[ca_id]
+
+        if include_sentences and sentence_ids:
+            seen_articles.add(aid)
+            for sid in sentence_ids:
+                s = sentences[sid]
+                for sentence_coding in sentence_ids[sid]:
+                    yield CodingRow(job, ca, a, s, article_coding, sentence_coding)
+
+            if include_uncoded_sentences:
+                non_coded_sentences = article_sentences[aid] - set(sentence_ids)
+                for sentence in map(sentences.get, non_coded_sentences):
+                    yield CodingRow(job, ca, a, sentence, article_coding, None)
+
+        elif article_coding:
+            seen_articles.add(aid)
+            yield CodingRow(job, ca, a, None, article_coding, None)
 
-        # output the rows for this job
-        for ca in coded_articles:
-            a = job_articles[ca.article_id]
-            if a in seen_articles and not include_multiple:
-                continue
 
-            article_coding = article_codings.get(ca.id)
-            sentence_ids = sentence_codings[ca.id]
+def _get_rows(jobs, include_sentences=False, include_multiple=True, include_uncoded_articles=False, include_uncoded_sentences=False,
+              progress_monitor=NullMonitor()):
+    """
+    Lazily yield the rows for the given jobs. Coded articles are read using a server-side cursor and
+    processed in chunks of CHUNK_SIZE, so memory usage does not depend on the size of the jobs.
 
-            if include_sentences and sentence_ids:
-                seen_articles.add(a)
-                for sid in sentence_ids:
-                    s = job_sentences[sid]
-                    for sentence_coding in sentence_codings[ca.id][sid]:
-                        yield CodingRow(job, ca, a, s, article_coding, sentence_coding)
+    @param jobs: output rows for these jobs
+    @param include_sentences: include sentence level codings (if False, row.sentence and .sentence_coding are always None)
+    @param include_multiple: include multiple codedarticles per article
+    @param include_uncoded_articles: include articles without corresponding codings
+    """
+    # Ids of articles that have been seen in a codingjob already (so we can skip duplicate codings on the same article)
+    seen_articles = set()
 
-                if include_uncoded_sentences:
-                    non_coded_sentences = article_sentences[ca.article_id] - set(sentence_ids)
-                    for sentence in map(job_sentences.get, non_coded_sentences):
-                        yield CodingRow(job, ca, a, sentence, article_coding, None)
+    cache = CodingColumnCache()
 
-            elif article_coding:
-                seen_articles.add(a)
-                yield CodingRow(job, ca, a, None, article_coding, None)
+    job = None
+    for job in jobs:
+        coded_articles = job.coded_articles.order_by("id").values_list("id", "article_id")
+        for chunk in toolkit.splitlist(_iter_server_side(coded_articles), itemsperbatch=CHUNK_SIZE):
+            columns = cache.get_coded_articles(job.id, [ca_id for ca_id, _ in chunk])
+            yield from _get_chunk_rows(job, columns, chunk, include_sentences, include_multiple,
+                                       include_uncoded_sentences, seen_articles)
 
-    if include_uncoded_articles:
-        for article in set(job_articles.values()) - seen_articles:
-            yield CodingRow(job, job.get_coded_article(article), article, None, None, None)
+    if include_uncoded_articles and job is not None:
+        art_filter = Q(coded_articles__codingjob__in=jobs) | Q(articlesets_set__codingjob_set__in=jobs)
+        article_ids = Article.objects.filter(art_filter).order_by("id").distinct().values_list("id")
+        for chunk in toolkit.splitlist(_iter_server_side(article_ids), itemsperbatch=CHUNK_SIZE):
+            chunk = [aid for (aid,) in chunk if aid not in seen_articles]
+            articles = Article.objects.in_bulk(chunk)
+            coded_articles = {ca.article_id: ca for ca in job.coded_articles.filter(article_id__in=chunk)}
+            for aid in chunk:
+                yield CodingRow(job, coded_articles.get(aid), articles[aid], None, None, None)
 
 
 class CodingColumn(table3.ObjectColumn):
@@ -420,11 +476,11 @@ class GetCodingJobResults(Script):
 
     def get_table(self, codingjobs, export_level, include_uncoded_sentences=False,
                   include_uncoded_articles=False, **kargs):
-        codingjobs = CodingJob.objects.prefetch_related("coded_articles__codings__values").filter(pk__in=codingjobs)
+        codingjobs = CodingJob.objects.select_related("coder").filter(pk__in=codingjobs)
 
-        # Get all row of table
+        # Rows are generated lazily while exporting
         self.progress_monitor.update(5, "Preparing Jobs")
-        rows = list(_get_rows(
+        rows = (_get_rows(
             codingjobs, include_sentences=(int(export_level) != CODING_LEVEL_ARTICLE),
             include_multiple=True, include_uncoded_articles=include_uncoded_articles,
             include_uncoded_sentences=include_uncoded_sentences,
@@ -456,11 +512,9 @@ class GetCodingJobResults(Script):
             if not codebook:
                 continue
 
-            codebook.cache()
-     
             table.add_column(MappingMetaColumn(
                 _MetaField("article", field_name, field_name + " aggregation"),
-                codebook.get_aggregation_mapping(), not_found
+                CodebookCache().get(codebook.id).get_aggregation_mapping(), not_found
             ))
 
         # Build columns based on form schemafields
@@ -473,23 +527,40 @@ class GetCodingJobResults(Script):
                     table.add_column(CodingColumn(schemafield, label, function))
         return table
 
+    def _get_filename(self, codingjobs, format):
+        if len(codingjobs) > 3:
+            codingjobs = codingjobs[:3] + ["etc"]
+
+        return "Codingjobs {jobs} {now}.{ext}".format(
+            jobs=",".join(str(j) for j in codingjobs),
+            now=datetime.datetime.now(), ext=format.label
+        )
+
     def _run(self, export_format, codingjobs, **kargs):
         self.progress_monitor.update(5, "Starting Export")
         table = self.get_table(codingjobs, **kargs)
         self.progress_monitor.update(5, "Preparing Results File")
         format = {f.label: f for f in EXPORT_FORMATS}[export_format]
         table = ProgressTable(table, len(codingjobs), self.progress_monitor)
-        result = format.function(table)
-        self.progress_monitor.update(15, "Encoding result")
 
-        if format.mimetype:
-            if len(codingjobs) > 3:
-                codingjobs = codingjobs[:3] + ["etc"]
+        if format.to_file:
+            name, path = create_export_file(prefix="codingjob-export-", suffix="." + format.label)
+            format.to_file(table, path)
+            result = None
+        else:
+            result = format.function(table)
+        self.progress_monitor.update(15, "Encoding result")
 
-            filename = "Codingjobs {jobs} {now}.{ext}".format(
-                jobs=",".join(str(j) for j in codingjobs),
-                now=datetime.datetime.now(), ext=format.label
-            )
+        if format.to_file:
+            result = {
+                "type": "download",
+                "encoding": "file",
+                "content_type": format.mimetype,
+                "filename": self._get_filename(codingjobs, format),
+                "name": name
+            }
+        elif format.mimetype:
+            filename = self._get_filename(codingjobs, format)
 
             if isinstance(result, str):
                 # Results need to be encoded before passing it to b64encode. However, not all
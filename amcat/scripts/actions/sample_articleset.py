@@ -31,6 +31,7 @@ from django import forms
 
 from amcat.scripts.script import Script
 from amcat.models import ArticleSet, Project
+from amcat.tools.sampling import sample_articleset, INTERVALS
 
 PLUGINTYPE_PARSER = 1
 
@@ -41,6 +42,17 @@ class SampleSet(Script):
         sample = forms.CharField(help_text="Sample in absolute number or percentage")
         target_articleset_name = forms.CharField(help_text="Name for the new articleset")
         target_project = forms.ModelChoiceField(queryset=Project.objects.all())
+        method = forms.ChoiceField(choices=[
+            ("database", "Simple random sample"),
+            ("elastic", "Simple random sample (using elastic)"),
+            ("stratified", "Stratified sample"),
+        ], initial="database", required=False)
+        stratify_by = forms.CharField(initial="date", required=False,
+                                      help_text="For stratified samples: 'date' or a property such as 'medium'")
+        interval = forms.ChoiceField(choices=[(i, i) for i in INTERVALS], initial="month", required=False,
+                                     help_text="For stratified samples by date")
+        seed = forms.IntegerField(required=False, help_text="Seed for the random generator (optional)")
+
         def __init__(self, project=None, **kwargs):
             super(self.__class__, self).__init__(**kwargs)
 
@@ -61,15 +73,15 @@ class SampleSet(Script):
             self.cleaned_data["sample"] = result
             return result
 
-    def _run(self, articleset, sample, target_articleset_name, target_project):
-        log.info("Sampling {sample} from {articleset}".format(**locals()))
-        if not isinstance(sample, int):
-            n = articleset.articles.count()
-            sample = int(round(n * sample))
-            log.info("Sampling {sample} of {n} articles".format(**locals()))
+    def _run(self, articleset, sample, target_articleset_name, target_project,
+             method=None, stratify_by=None, interval=None, seed=None):
+        method = method or "database"
+        log.info("Sampling {sample} from {articleset} ({method})".format(**locals()))
 
-        selected = articleset.articles.order_by('?')[:sample]
-        ids = [x for (x,) in selected.values_list("pk")]
+        options = {}
+        if method == "stratified":
+            options = dict(stratify_by=stratify_by or "date", interval=interval or "month")
+        ids = sample_articleset(articleset.id, sample, method=method, seed=seed, **options)
 
         target_set = ArticleSet.objects.create(name=target_articleset_name, project=target_project)
         log.info(
@@ -1,7 +1,9 @@
-import base64
 import csv
 import json
+import os
 import unittest
+import zipfile
+from unittest import mock
 from io import StringIO
 
 from amcat.models import Language, CodingSchemaField, CodingJob
@@ -9,6 +11,7 @@ from amcat.scripts.actions.get_codingjob_results import _get_field_prefix, Codin
     GetCodingJobResults, _get_rows, CODING_LEVEL_BOTH, log
 from amcat.tools import amcattest
 from amcat.tools.amcattest import create_test_coding
+from amcat.tools.exportfiles import get_export_path
 from amcat.tools.sbd import get_or_create_sentences
 
 
@@ -82,6 +85,19 @@ class TestGetCodingJobResults(amcattest.AmCATTestCase):
         self.assertEqual(rows, {(job, ca, articles[0], s, c, sc), (job, ca, articles[0], s2, c, sc2),
                                 (job, job.get_coded_article(articles[1]), articles[1], None, c2, None)})
 
+    def test_get_rows_chunks(self):
+        """Rows should not depend on how coded articles are split into chunks"""
+        schema, codebook, strf, intf, codef, _, _ = amcattest.create_test_schema_with_fields()
+        job = amcattest.create_test_job(unitschema=schema, articleschema=schema, narticles=5)
+        articles = list(job.articleset.articles.all())
+        codings = [amcattest.create_test_coding(codingjob=job, article=a) for a in articles[:3]]
+        expected = {(job, job.get_coded_article(a), a, None, c, None) for (a, c) in zip(articles, codings)}
+        expected |= {(job, job.get_coded_article(a), a, None, None, None) for a in articles[3:]}
+
+        with mock.patch("amcat.scripts.actions.get_codingjob_results.CHUNK_SIZE", 2):
+            rows = list(_get_rows([job], include_sentences=True, include_uncoded_articles=True))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(set(rows), expected)
 
     def test_results(self):
         codebook, codes = amcattest.create_test_codebook_with_codes()
@@ -129,7 +145,11 @@ class TestGetCodingJobResults(amcattest.AmCATTestCase):
         # test csv
         s = self._get_results_script([job], {f: {}}, export_format='csv')
 
-        data = base64.b64decode(s.run()['data']).decode('utf-8')
+        result = s.run()
+        self.assertEqual(result['encoding'], 'file')
+        with open(get_export_path(result['name']), encoding='utf-8') as f:
+            data = f.read()
+        os.remove(get_export_path(result['name']))
         table = [[cell for cell in row] for row in csv.reader(StringIO(data))]
         self.assertEqual(table, [[s1], [s2]])
 
@@ -159,7 +179,9 @@ class TestGetCodingJobResults(amcattest.AmCATTestCase):
 
         # test excel, can't test content but we can test output and no error
         s = self._get_results_script([job], {f: {}}, export_format='xlsx')
-        self.assertTrue(s.run())
+        result = s.run()
+        self.assertTrue(zipfile.is_zipfile(get_export_path(result['name'])))
+        os.remove(get_export_path(result['name']))
 
     def test_nqueries_sentence_codings(self):
         aschema, acodebook, astrf, aintf, acodef, _, _ = amcattest.create_test_schema_with_fields(isarticleschema=True)
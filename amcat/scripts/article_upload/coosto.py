@@ -41,8 +41,7 @@ class CoostoUpload(UploadScript):
                     author=author, metastring=metastring)
         yield a 
 
-    def get_provenance(self, file, articles):
-        n = len(articles)
+    def get_provenance(self, file, n):
         filename = file and file.name
         timestamp = unicode(datetime.datetime.now())[:16]
         queries = "; ".join(self.queries)
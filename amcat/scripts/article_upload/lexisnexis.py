@@ -560,8 +560,8 @@ class LexisNexis(UploadScript):
                     art[field] = val
             yield Article(**art)
 
-    def get_provenance(self, file, articles):
-        provenance = super().get_provenance(file, articles)
+    def get_provenance(self, file, n):
+        provenance = super().get_provenance(file, n)
         if self.ln_query:
             provenance = "{provenance}; LexisNexis query: {self.ln_query!r}".format(**locals())
         return provenance
@@ -63,6 +63,22 @@ class TestCSV(amcattest.AmCATTestCase):
         self.assertEqual(len(articles), 1)
         self.assertEqual(articles[0].date.isoformat()[:10], "2016-12-12")
 
+    @amcattest.use_elastic
+    def test_chunks(self):
+        header = ('kop', 'datum', 'tekst')
+        data = [('kop{}'.format(i), '2001-01-01', 'text{}'.format(i % 4)) for i in range(7)]
+        data += [('kop1', '2001-01-01', 'text1')]  # duplicate of an article in an earlier chunk
+
+        chunk_size = CSV.chunk_size
+        CSV.chunk_size = 3
+        try:
+            articles = _run_test_csv(header, data, _get_field_map(text="tekst", title="kop", date="datum"))
+        finally:
+            CSV.chunk_size = chunk_size
+
+        self.assertEqual({a.title for a in articles}, {'kop{}'.format(i) for i in range(7)})
+        self.assertEqual(len(articles), 7)
+
     @unittest.skip("Behavior not specified.")
     def test_parents(self):
         self.fail()
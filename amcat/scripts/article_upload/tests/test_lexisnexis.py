@@ -1,6 +1,7 @@
 
 import datetime
 import json
+from unittest import mock
 
 from django.core.files import File
 
@@ -8,6 +9,7 @@ from amcat.models import ArticleSet
 from amcat.scripts.article_upload.lexisnexis import split_header, split_body, parse_header, \
     parse_article, get_query, LexisNexis
 from amcat.tools import amcattest
+from amcat.tools.amcates import ES
 
 
 class TestLexisNexis(amcattest.AmCATTestCase):
@@ -127,7 +129,13 @@ class TestLexisNexis(amcattest.AmCATTestCase):
                     field_map=json.dumps(field_map))
 
         form["articleset_name"] = "test set lexisnexis"
-        aset = LexisNexis(file=File(open(self.test_file, 'rb')), **form).run()
+        with mock.patch.object(ES, "add_to_set") as add_to_set:
+            aset = LexisNexis(file=File(open(self.test_file, 'rb')), **form).run()
+
+        # New articles are indexed with their set, instead of being updated afterwards
+        add_to_set.assert_not_called()
+        ES().refresh()
+        self.assertEqual(ES().count(filters={"sets": aset.id}), len(self.test_body_sols))
 
         # form["file"] = File(open(self.test_file)),
         # aset = LexisNexis(**form).run()
@@ -151,3 +159,58 @@ class TestLexisNexis(amcattest.AmCATTestCase):
 
         # no query so provenance is the 'standard' message
         self.assertTrue(articleset.provenance.endswith("test2.txt' using LexisNexis"))
+
+    def test_parallel_preprocess(self):
+        """Files in a zip are preprocessed in parallel, in order, and errors are reported per file"""
+        import os, shutil, tempfile, zipfile
+        from amcat.scripts.article_upload.upload import ParseError
+
+        tmpdir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(tmpdir)
+        try:
+            zipfn = os.path.join(tmpdir, "test.zip")
+            with zipfile.ZipFile(zipfn, "w") as zf:
+                zf.write(self.test_file, "a.txt")
+                zf.write(self.test_file2, "b.txt")
+                zf.writestr("c.txt", b"\xff\xfe\xfa")
+
+            errors = []
+            files = list(LexisNexis._get_files(zipfn, "UTF-8", errors=errors))
+            self.assertEqual([os.path.basename(f) for f, _, _ in files], ["a.txt", "b.txt"])
+            self.assertEqual(list(files[0][2]), list(LexisNexis._preprocess(self.test_file, "UTF-8")))
+            self.assertEqual(len(errors), 1)
+            self.assertIn("c.txt", errors[0])
+
+            self.assertRaises(ParseError, list, LexisNexis._get_files(zipfn, "UTF-8"))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmpdir)
+
+    @amcattest.use_elastic
+    def test_upload_failure(self):
+        """Uploads are all-or-nothing: created articles are removed if the upload fails"""
+        from amcat.models import Article
+
+        fields = ["date", "title", "text"]
+        field_map = {f: dict(type='field', value=f) for f in fields}
+        form = dict(project=amcattest.create_test_project().id, encoding="UTF-8",
+                    field_map=json.dumps(field_map), articleset_name="test set failure")
+
+        created = []
+        remove_articles = LexisNexis._remove_articles
+
+        def _remove_articles(upload, article_ids):
+            created.extend(article_ids)
+            remove_articles(upload, article_ids)
+
+        with mock.patch.object(ArticleSet, "add_articles", side_effect=RuntimeError("Failed")), \
+                mock.patch.object(LexisNexis, "_remove_articles", _remove_articles):
+            upload = LexisNexis(file=File(open(self.test_file, 'rb')), **form)
+            self.assertRaises(RuntimeError, upload.run)
+
+        ES().refresh()
+        self.assertEqual(len(created), len(self.test_body_sols))
+        self.assertFalse(Article.objects.filter(pk__in=created).exists())
+        self.assertEqual(list(ES().in_index(created)), [])
+        self.assertFalse(ArticleSet.objects.filter(name="test set failure").exists())
@@ -23,8 +23,10 @@ Base module for article upload scripts
 import datetime
 import json
 import logging
+import multiprocessing
 import os.path
 import zipfile
+from array import array
 import chardet
 
 from io import TextIOWrapper
@@ -39,7 +41,8 @@ from django.forms.widgets import HiddenInput
 
 from amcat.models import Article, ArticleSet, Project
 from amcat.models.articleset import create_new_articleset
-from amcat.tools import amcates
+from amcat.tools import amcates, toolkit
+from amcat.tools.amcates_bulk import bounded_imap
 from amcat.tools.progress import NullMonitor
 
 log = logging.getLogger(__name__)
@@ -143,6 +146,17 @@ def _read(file, encoding):
     return bytes.decode(encoding)
 
 
+def _preprocess_file(args):
+    """Run _get_preprocessed for a single file, catching errors so they can be reported per file.
+    This is a module level function, so it can be used on a process pool."""
+    cls, file, encoding = args
+    try:
+        return file, cls._get_preprocessed(file, encoding), None
+    except Exception as e:
+        log.exception("Error preprocessing {}".format(file))
+        return file, None, "{}: {}".format(e.__class__.__name__, e)
+
+
 class UploadScript(ActionForm):
     """Base class for Upload Scripts, which are scraper scripts driven by the
     the script input.
@@ -152,6 +166,12 @@ class UploadScript(ActionForm):
     """
     form_class = UploadForm
 
+    # Number of articles parsed and saved at once
+    chunk_size = 1000
+
+    # Number of processes preprocessing files, defaults to the number of cpus
+    preprocess_processes = None
+
     @classmethod
     def get_fields(cls, file, encoding):
         """
@@ -180,20 +200,54 @@ class UploadScript(ActionForm):
         return file, encoding, data
 
     @classmethod
-    def _get_files(cls, file: str, encoding: str):
+    def _list_files(cls, file: str):
         """
-        Get the files to upload, unpacking zip files if needed, and returning preprocessed data if applicable
+        Get the paths of the files to upload, unpacking zip files if needed
         :param file: full file path
-        :param encoding: the encoding
-        :return: a sequence of (file, encoding, preprocessed_data_or_None)
         """
         if file.endswith(".zip"):
             zf = zipfile.ZipFile(file)
-            for member in zf.namelist():
-                fn = zf.extract(member)
-                yield cls._get_preprocessed(fn, encoding)
+            return [zf.extract(member) for member in zf.infolist() if not member.filename.endswith("/")]
+        return [file]
+
+    @classmethod
+    def _get_files(cls, file: str, encoding: str, errors=None):
+        """
+        Get the files to upload, unpacking zip files if needed, and returning preprocessed data if applicable.
+        :param file: full file path
+        :param encoding: the encoding
+        :param errors: see _preprocess_files
+        :return: a sequence of (file, encoding, preprocessed_data_or_None)
+        """
+        return cls._preprocess_files(cls._list_files(file), encoding, errors)
+
+    @classmethod
+    def _preprocess_files(cls, files, encoding, errors=None):
+        """
+        Lazily preprocess the given files. Files are preprocessed in parallel on a process pool,
+        but yielded in order. Files are only preprocessed ahead of the consumer as far as there are
+        processes, so at most that many preprocessed files are held in memory.
+        :param errors: if given, a list to which errors preprocessing a file are appended. Otherwise,
+                       a ParseError is raised.
+        :return: a sequence of (file, encoding, preprocessed_data_or_None)
+        """
+        args = ((cls, fn, encoding) for fn in files)
+        processes = min(len(files), cls.preprocess_processes or multiprocessing.cpu_count())
+        if hasattr(cls, "_preprocess") and processes > 1 and not multiprocessing.current_process().daemon:
+            with multiprocessing.Pool(processes) as pool:
+                yield from cls._check_preprocessed(bounded_imap(pool, _preprocess_file, args, processes), errors)
         else:
-            yield cls._get_preprocessed(file, encoding)
+            yield from cls._check_preprocessed(map(_preprocess_file, args), errors)
+
+    @classmethod
+    def _check_preprocessed(cls, results, errors):
+        for fn, result, error in results:
+            if error is None:
+                yield result
+            elif errors is None:
+                raise ParseError("Error in file {}: {}".format(os.path.basename(fn), error))
+            else:
+                errors.append("Error in file {}: {}".format(os.path.basename(fn), error))
 
     def __init__(self, form=None, file=None, **kargs):
         if form is None:
@@ -220,50 +274,102 @@ class UploadScript(ActionForm):
         index = " {}".format(article) if article is not None else ""
         return "Error in element{}: {}".format(index, error)
 
-    def get_provenance(self, file, articles):
-        n = len(articles)
+    def get_provenance(self, file, n):
+        """
+        @param n: number of articles uploaded
+        """
         timestamp = str(datetime.datetime.now())[:16]
         return ("[{timestamp}] Uploaded {n} articles from file {file!r} "
                 "using {self.__class__.__name__}".format(**locals()))
 
+    def _parse_files(self, files, nfiles):
+        """Lazily yield the articles in all (preprocessed) files"""
+        monitor = self.progress_monitor
+        for i, (file, encoding, data) in enumerate(files):
+            monitor.update(60 / nfiles, "Parsing file {i}/{nfiles}: {file}".format(**locals()))
+            for article in self.parse_file(file, encoding, data):
+                _set_project(article, self.project)
+                yield article
+
+    def _save_articles(self, articles, aset, created_ids, duplicate_ids):
+        """
+        Save articles in chunks of self.chunk_size. New articles are indexed as members of aset,
+        but not added to it in the database. Yields the saved articles per chunk, and appends
+        the ids of newly created articles to created_ids and those of duplicates to duplicate_ids.
+        """
+        for chunk in toolkit.splitlist(articles, itemsperbatch=self.chunk_size):
+            if self.errors:
+                raise ParseError(" ".join(map(str, self.errors)))
+            Article.create_articles(chunk, articleset=aset, add_to_sets=False)
+            created_ids.extend(a.id for a in chunk if a._duplicate is None)
+            duplicate_ids.extend(a.id for a in chunk if a._duplicate is not None)
+            yield chunk
+
+    def _remove_articles(self, article_ids):
+        """Remove the given (newly created) articles from the database and index"""
+        log.warning("Upload failed, removing {} created articles".format(len(article_ids)))
+        for batch in toolkit.splitlist(article_ids, itemsperbatch=1000):
+            Article.objects.filter(pk__in=batch).delete()
+            amcates.ES().delete_articles(batch)
+
     def run(self):
+        """
+        Parse and save all articles. Files are preprocessed and parsed lazily and articles are
+        saved in chunks of chunk_size articles, so memory usage depends on the size of the
+        largest file rather than on the size of the upload.
+
+        Uploads are all-or-nothing: articles are only added to the articleset once all files
+        are parsed. If anything fails, the articles created are removed again, as well as the
+        articleset if it was created by this upload.
+        """
         monitor = self.progress_monitor
+        new_set = not self.options['articleset']
 
         filename = self.options['file']
         monitor.update(10, u"Importing {self.__class__.__name__} from {filename} into {self.project}"
                        .format(**locals()))
 
-        articles = []
         encoding = self.options['encoding']
-        files = list(self._get_files(filename, encoding))
-        nfiles = len(files)
-        for i, (file, encoding, data) in enumerate(files):
-            monitor.update(20 / nfiles, "Parsing file {i}/{nfiles}: {file}".format(**locals()))
-            articles += list(self.parse_file(file, encoding, data))
-
-        for article in articles:
-            _set_project(article, self.project)
-        
-        if self.errors:
-            raise ParseError(" ".join(map(str, self.errors)))
-        monitor.update(10, "All files parsed, saving {n} articles".format(n=len(articles)))
-        Article.create_articles(articles, articleset=self.get_or_create_articleset(),
-                                monitor=monitor.submonitor(40))
-
-        if not articles:
-            raise Exception("No articles were imported")
+        files = self._list_files(filename)
+        articles = self._parse_files(self._preprocess_files(files, encoding, errors=self.errors), len(files))
+
+        n, created_ids, duplicate_ids = 0, array("q"), array("q")
+        aset = self.get_or_create_articleset()
+        try:
+            for chunk in self._save_articles(articles, aset, created_ids, duplicate_ids):
+                n += len(chunk)
+                monitor.update(0, "Saved {n} articles".format(n=n))
+
+            if self.errors:
+                raise ParseError(" ".join(map(str, self.errors)))
+
+            if not n:
+                raise Exception("No articles were imported")
+
+            # New articles are already indexed as members of the set, only duplicates need updating
+            monitor.update(0, "Adding {n} articles to {aset}".format(**locals()))
+            aset.add_articles(created_ids, add_to_index=False, monitor=monitor.submonitor(1, weight=10))
+            if duplicate_ids:
+                aset.add_articles(duplicate_ids, add_to_index=True, monitor=monitor.submonitor(1, weight=10))
+            else:
+                monitor.update(10)
+        except Exception:
+            self._remove_articles(created_ids)
+            if new_set:
+                ArticleSet.objects.filter(pk=aset.pk).delete()
+                self.options['articleset'] = None
+            raise
 
-        monitor.update(10, "Uploaded {n} articles, post-processing".format(n=len(articles)))
+        monitor.update(0, "Uploaded {n} articles, post-processing".format(n=n))
 
-        aset = self.options["articleset"]
-        new_provenance = self.get_provenance(file, articles)
+        new_provenance = self.get_provenance(filename, n)
         aset.provenance = ("%s\n%s" % (aset.provenance or "", new_provenance)).strip()
         aset.save()
 
         if getattr(self, 'task', None):
-            self.task.log_usage("articles", "upload", n=len(articles))
+            self.task.log_usage("articles", "upload", n=n)
 
-        monitor.update(10, "Done! Uploaded articles".format(n=len(articles)))
+        monitor.update(10, "Done! Uploaded articles".format(n=n))
         return self.options["articleset"]
 
 
@@ -38,6 +38,7 @@ from django.forms import ChoiceField, BooleanField
 from amcat.models import ArticleSet, CodingSchemaField, Code, CodingJob
 from amcat.scripts.query import QueryAction, QueryActionForm
 from amcat.tools import aggregate_es
+from amcat.tools.aggregate_es.aggregate import DenseAggregation
 from amcat.tools.aggregate_es.categories import IntervalCategory, FieldCategory
 from amcat.tools.aggregate_orm import CountArticlesValue
 from amcat.tools.keywordsearch import SelectionSearch, SearchQuery, to_sortable_tuple
@@ -61,13 +62,16 @@ def aggregation_to_matrix(aggregation, categories):
     a matrix with the keys 'columns', 'rows', and 'data'. The result is guaranteed to be
     sorted.
 
-    @param aggregation: aggregation from either ES or ORM backend
+    @param aggregation: aggregation from either ES or ORM backend, or a DenseAggregation
     @param categories: list of instances of Category
     @return: matrix / dict
     """
     if not aggregation:
         return dict(EMPTY_MATRIX)
 
+    if isinstance(aggregation, DenseAggregation):
+        return dense_aggregation_to_matrix(aggregation)
+
     # No real "columns" exist if only one category is selected
     if len(categories) == 1:
         return {
@@ -96,6 +100,30 @@ def aggregation_to_matrix(aggregation, categories):
         "columns": cols
     }
 
+def dense_aggregation_to_matrix(aggregation):
+    """
+    Converts a (sorted) DenseAggregation to a matrix as returned by aggregation_to_matrix,
+    without constructing intermediate rows.
+    """
+    if len(aggregation.axes) == 1:
+        return {
+            "columns": ["Value"],
+            "rows": aggregation.axes[0],
+            "data": [((count,),) for count in aggregation.counts]
+        }
+
+    if len(aggregation.axes) > 2:
+        raise ValueError("More than two categories not yet supported by aggregation_to_matrix()")
+
+    rows, cols = aggregation.axes
+    counts = aggregation.counts
+    return {
+        "data": [[(count,) for count in counts[n:n+len(cols)]] for n in range(0, len(counts), len(cols))],
+        "rows": rows,
+        "columns": cols
+    }
+
+
 def aggregation_to_csv(aggregation, categories, values):
     aggregation = map(chain.from_iterable, aggregation)
 
@@ -256,7 +284,7 @@ class AggregationAction(QueryAction):
             primary = form.cleaned_data["primary"]
             secondary = form.cleaned_data["secondary"]
             categories = list(filter(None, [primary, secondary]))
-            aggregation = list(selection.get_aggregate(categories, flat=False))
+            aggregation = selection.get_aggregate(categories, flat=False, dense=True)
 
             self.set_cache([primary, secondary, categories, aggregation])
         else:
@@ -267,9 +295,10 @@ class AggregationAction(QueryAction):
         # be easier to render.
         if form.cleaned_data["output_type"] == "text/json+aggregation+table":
             aggregation = aggregation_to_matrix(aggregation, categories)
-
-        if form.cleaned_data["output_type"] == "text/csv":
-            return aggregation_to_csv(aggregation, categories, [CountArticlesValue()])
+        elif form.cleaned_data["output_type"] == "text/csv":
+            return aggregation_to_csv(aggregation.rows(flat=False), categories, [CountArticlesValue()])
+        else:
+            aggregation = list(aggregation.rows(flat=False))
 
         self.monitor.update(message="Serialising..".format(**locals()))
         return json.dumps(aggregation, cls=AggregationEncoder, check_circular=False)
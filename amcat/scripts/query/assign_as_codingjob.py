@@ -50,7 +50,6 @@ class AssignAsCodingjobAction(QueryAction):
     output_types = (("text/html", "Result"),)
 
     def run(self, form):
-        provenance = None#form.cleaned_data["provenance"] #TODO: is dit correct?
         job_size = form.cleaned_data["job_size"]
 
         self.monitor.update(10, "Executing query..")
@@ -67,21 +66,9 @@ class AssignAsCodingjobAction(QueryAction):
         self.monitor.update(50, "Creating codingjobs..")
 
         if job_size == 0:
-            job_size = len(article_ids)
+            job_size = len(article_ids) or 1
 
-        n_batches = len(article_ids) // job_size
-        n_batches += 1 if len(article_ids) % job_size else 0
-        
-        for i, cid in enumerate(_create_codingjob_batches(cj, article_ids, job_size)):
-            progress = int((i / float(n_batches)) * (100 // 2))
-            msg = "Creating codingjob {} of {}..".format(i+1, n_batches)
-            print(50 + progress)
-            self.monitor.update(50 + progress, msg)
-
-            if provenance:
-                cj = CodingJob.objects.get(id=cid)
-                cj.provenance = provenance
-                cj.save()
+        _create_codingjob_batches(cj, article_ids, job_size, monitor=self.monitor.submonitor(total=1, weight=40))
 
         return "Codingjob(s) created."
 
@@ -27,8 +27,7 @@ from django.core.exceptions import ValidationError
 from django.forms import ChoiceField, BooleanField, ModelChoiceField
 
 from .aggregation import AggregationEncoder, aggregation_to_matrix, aggregation_to_csv
-from amcat.models import CodedArticle
-from amcat.models import CodingSchemaField, Code, CodingValue, Coding
+from amcat.models import CodingSchemaField, Code, Coding
 from amcat.models import ArticleSet, CodingJob
 from amcat.models.coding.codingschemafield import  FIELDTYPE_IDS
 from amcat.scripts.forms.selection import get_all_schemafields
@@ -37,6 +36,7 @@ from amcat.scripts.query.aggregation import AGGREGATION_FIELDS
 from amcat.tools import aggregate_orm, aggregate_es
 from amcat.tools.aggregate_orm import ORMAggregate
 from amcat.tools.aggregate_orm.categories import POSTGRES_DATE_TRUNC_VALUES
+from amcat.tools.codingcolumns import CodingColumnCache
 from amcat.tools.keywordsearch import SelectionSearch, SearchQuery
 
 log = logging.getLogger(__name__)
@@ -232,14 +232,15 @@ class CodingAggregationAction(QueryAction):
             value1 = form.cleaned_data['value1']
             value2 = form.cleaned_data['value2']
 
-            article_ids = selection.get_article_ids()
+            article_ids = set(selection.get_article_ids())
 
-            # This should probably happen in SelectionForm?
-            coded_articles = CodedArticle.objects.all()
-            coded_articles = coded_articles.filter(article__id__in=article_ids)
-            coded_articles = coded_articles.filter(codingjob__id__in=codingjobs)
+            # Coded articles and their values are read from the coding columns cache, instead
+            # of joining them in postgres. This should probably happen in SelectionForm?
+            columns = CodingColumnCache().get(job.id for job in codingjobs)
+            coded_article_ids = set()
+            for job_columns in columns.values():
+                coded_article_ids |= job_columns.get_coded_article_ids(article_ids=article_ids)
 
-            coded_article_ids = set(coded_articles.values_list("id", flat=True))
             for field_name in ("1", "2", "3"):
                 if not coded_article_ids:
                     break
@@ -249,16 +250,17 @@ class CodingAggregationAction(QueryAction):
                 schemafield_include_descendants = form.cleaned_data["codingschemafield_include_descendants_{}".format(field_name)]
 
                 if schemafield and  schemafield_values:
-                    code_ids = get_code_filter(schemafield.codebook, schemafield_values, schemafield_include_descendants)
-                    coding_values = CodingValue.objects.filter(coding__coded_article__id__in=coded_article_ids)
-                    coding_values = coding_values.filter(field__id=schemafield.id)
-                    coding_values = coding_values.filter(intval__in=code_ids)
-                    coded_article_ids &= set(coding_values.values_list("coding__coded_article__id", flat=True))
+                    code_ids = set(get_code_filter(schemafield.codebook, schemafield_values, schemafield_include_descendants))
+                    coded_article_ids &= set(chain.from_iterable(
+                        job_columns.get_coded_article_ids(field_id=schemafield.id, intvals=code_ids)
+                        for job_columns in columns.values()
+                    ))
 
             codings = Coding.objects.filter(coded_article__id__in=coded_article_ids)
+            columns = [(job, columns[job.id].filter(coded_article_ids)) for job in codingjobs]
 
             terms = selection.get_article_ids_per_query()
-            orm_aggregate = ORMAggregate(codings, flat=False, terms=terms)
+            orm_aggregate = ORMAggregate(codings, flat=False, terms=terms, columns=columns)
             categories = list(filter(None, [primary, secondary]))
             values = list(filter(None, [value1, value2]))
             aggregation = orm_aggregate.get_aggregate(categories, values)
@@ -20,7 +20,6 @@ import datetime
 import pickle
 import zlib
 
-import dateutil.parser
 import functools
 import hashlib
 
@@ -29,10 +28,10 @@ from amcat.models.authorisation import ROLE_PROJECT_METAREADER
 from amcat.scripts.forms import SelectionForm
 from amcat.tools.caching import cached
 from amcat.tools.progress import ProgressMonitor
+from amcat.tools.querycache import QueryCache
 from django import forms
 from django.contrib.auth.models import User
 from django.contrib.humanize.templatetags.humanize import naturaltime
-from django.core.cache import cache
 from django.core.exceptions import ValidationError, PermissionDenied
 from django.core.urlresolvers import reverse
 from django.http import QueryDict, HttpResponse
@@ -112,6 +111,9 @@ class QueryActionHandler(TaskHandler):
             return cache_key, result
         except Exception as e:
             raise
+        finally:
+            # Pass on progress held back by the throttle
+            query_action.monitor.flush()
 
     def _get_content_type(self):
         """Returns content type of selected 'output_type'. This usually is a mimetype
@@ -140,8 +142,7 @@ class QueryActionHandler(TaskHandler):
         response["X-Query-Cache-Hit"] = int(cache_key is not None)
         if cache_key:
             response["X-Query-Cache-Key"] = cache_key
-            timestamp = cache.get("{}.timestamp".format(cache_key))
-            timestamp = dateutil.parser.parse(timestamp)
+            timestamp = QueryCache().get_timestamp(cache_key) or datetime.datetime.now()
             response["X-Query-Cache-Timestamp"] = timestamp.isoformat()
             response["X-Query-Cache-Natural-Timestamp"] = naturaltime(timestamp)
         response["Content-Disposition"] = "attachment"
@@ -208,19 +209,31 @@ class QueryAction(object):
         """Get cached value for this particular form+user. Raises NotInCacheError if not cached
         value is found."""
         cache_key = self.get_cache_key()
-        value = cache.get(cache_key)
+        value = QueryCache().get(cache_key)
         if value is None:
             raise NotInCacheError("Cache value for {} was not found".format(cache_key))
         self.cache_hit = True
         return self.desearialize_cache_value(value)
 
+    def get_cache_articlesets(self):
+        """Returns the ids of the articlesets a cached value depends on. If any of them changes,
+        the value is invalidated."""
+        articlesets = {aset.id for aset in self.articlesets}
+        if self.codingjobs:
+            articlesets |= {cj.articleset_id for cj in self.codingjobs}
+        return articlesets
+
+    def get_cache_codingjobs(self):
+        """Returns the ids of the codingjobs a cached value depends on. If codings of any of them
+        are saved, the value is invalidated."""
+        return {cj.id for cj in self.codingjobs or ()}
+
     def set_cache(self, value):
         """Sets cache for this particular form+user to 'value'. The value is serialized
-        with QueryAction.serialize_cache_value. Note that large values may not fit in
-        memcached."""
-        timestamp = datetime.datetime.now().isoformat()
-        cache.set("{}.timestamp".format(self.get_cache_key()), timestamp, timeout=7200+1)
-        cache.set(self.get_cache_key(), self.serialize_cache_value(value), timeout=7200)
+        with QueryAction.serialize_cache_value. See amcat.tools.querycache."""
+        value = self.serialize_cache_value(value)
+        QueryCache().set(self.get_cache_key(), value, articlesets=self.get_cache_articlesets(),
+                         codingjobs=self.get_cache_codingjobs())
 
     def get_form_kwargs(self, **kwargs):
         return dict({
@@ -70,3 +70,20 @@ class TestQueryAction(amcattest.AmCATTestCase):
             "output_type": "text/foo"
         })
         self.assertRaises(NotInCacheError, qa.get_cache)
+
+    def test_cache_invalidation(self):
+        project = amcattest.create_test_project()
+        aset = amcattest.create_test_set(project=project)
+        asets = ArticleSet.objects.filter(id__in=[aset.id])
+        qa = FooBarQueryAction(project.owner, project, asets, data={
+            "query": str(uuid.uuid4()),
+            "output_type": "text/foo"
+        })
+        qa.get_form().full_clean()
+
+        qa.set_cache("abc")
+        self.assertEqual(qa.get_cache(), "abc")
+
+        # Adding articles to one of the sets should invalidate the result
+        aset.add_articles([amcattest.create_test_article()])
+        self.assertRaises(NotInCacheError, qa.get_cache)
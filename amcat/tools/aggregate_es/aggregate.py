@@ -16,43 +16,95 @@
 # You should have received a copy of the GNU Affero General Public        #
 # License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
-import datetime
-from itertools import count, takewhile
-
-import itertools
-
-__all__ = ("aggregate",)
-
-
-def flatten(aggregation, categories, categories_values=()):
-    aggregation = iter(categories.pop(0).parse_aggregation_result(aggregation))
-
-    seen = set()
-    if not categories:
-        for key, aggr in aggregation:
-            if categories_values:
-                seen.add(key)
-            yield [key, aggr["doc_count"]]
-    else:
-        for key, sub in aggregation:
-            values = categories_values[1:] if categories_values else ()
-            flattened = flatten(sub, list(categories), list(values))
-
-            for row in flattened:
+from array import array
+from itertools import product
+
+__all__ = ("aggregate", "DenseAggregation")
+
+
+def flatten(aggregation, categories):
+    """
+    Lazily flatten a (nested) elastic aggregation result to rows [key1, .., keyn, count].
+    Only buckets returned by elastic are yielded; see DenseAggregation for zero filling.
+    """
+    category, categories = categories[0], categories[1:]
+    for key, sub in category.parse_aggregation_result(aggregation):
+        if not categories:
+            yield [key, sub["doc_count"]]
+        else:
+            for row in flatten(sub, categories):
                 yield [key] + row
 
-            if categories_values:
-                seen.add(key)
 
-    # Fill zeros
-    if categories_values:
-        not_seen = categories_values[0] - seen
-        missing = [not_seen]
-        missing.extend(categories_values[1:])
-        if missing:
-            for subvals in map(list, itertools.product(*missing)):
-                subvals.append(0)
-                yield subvals
+def get_axes(rows, ncategories):
+    """Determine the distinct keys per category, in order of appearance"""
+    axes = [dict() for _ in range(ncategories)]
+    for row in rows:
+        for axis, key in zip(axes, row):
+            axis.setdefault(key, len(axis))
+    return [list(axis) for axis in axes]
+
+
+class DenseAggregation(object):
+    """
+    Aggregation stored as a count matrix, indexed by the ordinals of the keys of each category
+    in axes. Counts are stored row-major in a single array, so memory usage is one machine
+    integer per combination of keys, rather than a Python list per row.
+    """
+    def __init__(self, axes, counts=None):
+        self.axes = [list(axis) for axis in axes]
+        self.shape = tuple(map(len, self.axes))
+        self.strides = tuple(_product(self.shape[i+1:]) for i in range(len(self.shape)))
+
+        if counts is None:
+            counts = array("q", bytes(8 * _product(self.shape))) if all(self.shape) else array("q")
+        self.counts = counts
+
+    @classmethod
+    def from_rows(cls, rows, ncategories):
+        """Construct from rows [key1, .., keyn, count], such as yielded by flatten"""
+        rows = list(rows)
+        self = cls(get_axes(rows, ncategories))
+        ordinals = [{key: n for n, key in enumerate(axis)} for axis in self.axes]
+        for row in rows:
+            self.counts[self._index(o[k] for o, k in zip(ordinals, row))] += row[-1]
+        return self
+
+    def _index(self, ordinals):
+        return sum(o * s for o, s in zip(ordinals, self.strides))
+
+    def __getitem__(self, ordinals):
+        return self.counts[self._index(ordinals)]
+
+    def __len__(self):
+        return len(self.counts)
+
+    def map_axes(self, funcs):
+        """Replace the keys of each axis by func(keys), which should return a list of equal length"""
+        return DenseAggregation([func(axis) for func, axis in zip(funcs, self.axes)], self.counts)
+
+    def sorted(self, key=None):
+        """Return a copy with the keys of every axis sorted"""
+        orders = [sorted(range(len(axis)), key=lambda n: key(axis[n]) if key else axis[n]) for axis in self.axes]
+        result = DenseAggregation([[axis[n] for n in order] for axis, order in zip(self.axes, orders)])
+        for i, ordinals in enumerate(product(*orders)):
+            result.counts[i] = self[ordinals]
+        return result
+
+    def rows(self, flat=True):
+        """Lazily yield all (zero filled) rows, in the order of the axes"""
+        for keys, count in zip(product(*self.axes), self.counts):
+            yield keys + (count,) if flat else (keys, (count,))
+
+    def __iter__(self):
+        return self.rows()
+
+
+def _product(numbers):
+    result = 1
+    for n in numbers:
+        result *= n
+    return result
 
 
 def build_aggregate(categories):
@@ -74,40 +126,54 @@ def build_query(query, filters, categories):
         yield "query", {"constant_score": dict(body)}
 
 
-def aggregate(query=None, filters=None, categories=(), objects=True, es=None, flat=True, filter_zeros=False):
-    from amcat.tools.amcates import ES
-
-    if not categories:
-        raise ValueError("You need to specify at least one category.")
-
-    body = dict(build_query(query, filters, categories))
-    raw_result = (es or ES()).search(body, search_type="count")
-    aggregation = list(flatten(raw_result["aggregations"], list(categories)))
+def _get_key_converters(categories, objects):
+    """Yield functions converting a list of raw keys of each category to Python values / objects"""
+    for category in categories:
+        def convert(keys, category=category):
+            keys = [category.postprocess(k) for k in keys]
+            if objects:
+                objs = category.get_objects(keys)
+                keys = [category.get_object(objs, k) for k in keys]
+            return keys
+        yield convert
 
-    if not filter_zeros:
-        values = list(map(set, zip(*aggregation)))[:-1]
-        aggregation = list(flatten(raw_result["aggregations"], list(categories), values))
 
-    # Convert to suitable Python value
-    for i, category in enumerate(categories):
-        for row in aggregation:
-            row[i] = category.postprocess(row[i])
+def _convert_rows(aggregation, categories, objects, flat):
+    """Lazily convert rows given the complete raw elastic result"""
+    rows = lambda: flatten(aggregation, categories)
+    converters = _get_key_converters(categories, objects)
+    mappings = [dict(zip(axis, convert(axis))) for convert, axis in zip(converters, get_axes(rows(), len(categories)))]
 
-    # Replace ids with model objects
-    if objects:
-        for i, category in enumerate(categories):
-            pks = [row[i] for row in aggregation]
-            objs = category.get_objects(pks)
-            for row in aggregation:
-                row[i] = category.get_object(objs, row[i])
+    for row in rows():
+        keys = tuple(m[k] for m, k in zip(mappings, row))
+        yield keys + (row[-1],) if flat else (keys, (row[-1],))
 
-    aggregation = map(tuple, aggregation)
 
-    if not flat:
-        aggregation = ((row[:-1], row[-1:]) for row in aggregation)
+def aggregate(query=None, filters=None, categories=(), objects=True, es=None, flat=True, filter_zeros=False,
+              dense=False, lazy=False):
+    """
+    Aggregate articles in elastic on the given categories.
 
+    @param filter_zeros: only return the rows elastic returned, instead of all combinations of keys
+    @param dense: return a DenseAggregation (always zero filled) instead of rows
+    @param lazy: return an iterator of rows instead of a list
+    """
+    from amcat.tools.amcates import ES
 
-    aggregation = list(aggregation)
+    if not categories:
+        raise ValueError("You need to specify at least one category.")
 
-    return aggregation
+    categories = list(categories)
+    body = dict(build_query(query, filters, categories))
+    raw_result = (es or ES()).search(body, search_type="count")["aggregations"]
+
+    if dense or not filter_zeros:
+        aggregation = DenseAggregation.from_rows(flatten(raw_result, categories), len(categories))
+        aggregation = aggregation.map_axes(list(_get_key_converters(categories, objects)))
+        if dense:
+            return aggregation
+        aggregation = aggregation.rows(flat=flat)
+    else:
+        aggregation = _convert_rows(raw_result, categories, objects, flat)
 
+    return aggregation if lazy else list(aggregation)
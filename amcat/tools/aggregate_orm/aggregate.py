@@ -27,13 +27,14 @@ import itertools
 
 from django.db import connection
 
-from amcat.models import Coding
+from amcat.models import Coding, CodingJob
 from amcat.tools.aggregate_orm.categories import TermCategory, SchemafieldCategory
 from amcat.tools.aggregate_orm.sqlobj import JOINS
+from amcat.tools.codingcolumns import CodingColumnCache
 
 log = logging.getLogger(__name__)
 
-__all__ = ("ORMAggregate",)
+__all__ = ("ORMAggregate", "get_columns")
 
 def merge_aggregations(results):
     results = [{tuple(row[:-1]): row[-1] for row in aggr} for aggr in results]
@@ -41,29 +42,62 @@ def merge_aggregations(results):
     return [list(key) + list(a.get(key) for a in results) for key in keys]
 
 
+def get_columns(codingjob_ids, article_ids=None, coded_article_ids=None):
+    """
+    Get coding columns for use in ORMAggregate, optionally restricted to the given
+    articles and / or coded articles.
+
+    @return: [(CodingJob, CodingColumns)]
+    """
+    codingjobs = CodingJob.objects.in_bulk(codingjob_ids)
+    columns = CodingColumnCache().get(codingjobs.keys())
+    if article_ids is not None:
+        article_ids = set(article_ids)
+    if coded_article_ids is not None:
+        coded_article_ids = set(coded_article_ids)
+
+    result = []
+    for codingjob_id, job_columns in sorted(columns.items()):
+        if article_ids is not None or coded_article_ids is not None:
+            ids = job_columns.get_coded_article_ids(article_ids=article_ids)
+            if coded_article_ids is not None:
+                ids &= coded_article_ids
+            job_columns = job_columns.filter(ids)
+        result.append((codingjobs[codingjob_id], job_columns))
+    return result
+
+
 class ORMAggregate(object):
-    def __init__(self, codings, terms=None, flat=False, threaded=True):
+    def __init__(self, codings, terms=None, flat=False, threaded=True, columns=None):
         """
         @type codings: QuerySet
         @param terms: mapping of label to list of article ids. This will be used
                       by TermCategory. Ideally, we would instantiate TermCategory
                       with this, but the article ids are often only known at the time
                       of instantiating ORMAggregate.
+        @param columns: sequence of (codingjob, CodingColumns) tuples containing the same
+                        codings as codings. If given, aggregations are computed from these
+                        columns instead of in postgres, if all categories and values
+                        support it. See amcat.tools.codingcolumns.
         """
         self.codings = codings
         self.flat = flat
         self.threaded = threaded
         self.terms = OrderedDict(terms if terms else {})
+        self.columns = columns
 
 
     @classmethod
-    def from_articles(self, article_ids, codingjob_ids, **kwargs):
+    def from_articles(self, article_ids, codingjob_ids, use_columns=False, **kwargs):
         """
         @type article_ids: sequence of ints
         @type codingjob_ids: sequence of ints
+        @param use_columns: read codings from the coding columns cache
         """
         codings = Coding.objects.filter(coded_article__article__id__in=article_ids)
         codings = codings.filter(coded_article__codingjob__id__in=codingjob_ids)
+        if use_columns:
+            kwargs["columns"] = get_columns(codingjob_ids, article_ids=article_ids)
         return ORMAggregate(codings, **kwargs)
 
     def _get_aggregate_sql(self, categories, value):
@@ -74,14 +108,9 @@ class ORMAggregate(object):
         else:
             sql += ";"
 
-        # Instantiate TermCategory with terms (HACK)
-        for i, category in enumerate(categories):
-            if isinstance(category, TermCategory):
-                categories[i] = category.copy(self.terms)
-
-        # Add global codings filter
-        codings_ids = tuple(self.codings.values_list("id", flat=True)) + (-1,)
-        wheres = ['codings_values.coding_id IN {}'.format(codings_ids)]
+        # Add global codings filter as a subquery, so its size does not depend on the number of codings
+        codings_sql, codings_params = self.codings.values_list("id", flat=True).query.sql_with_params()
+        wheres = ['codings_values.coding_id IN ({})'.format(codings_sql)]
 
         # Gather all separate sql statements
         joins_needed = set()
@@ -105,12 +134,12 @@ class ORMAggregate(object):
             yield False, setup_statement
 
         # Build sql statement
-        yield True, sql.format(
+        yield True, (sql.format(
             selects=",".join(filter(None, selects)),
             joins=" ".join(filter(None, joins)),
             wheres="({})".format(") AND (".join(filter(None, wheres))),
             groups=",".join(filter(None, groups))
-        )
+        ), codings_params)
 
         for teardown_statement in teardowns:
             yield False, teardown_statement
@@ -119,7 +148,10 @@ class ORMAggregate(object):
         results = []
         with connection.cursor() as c:
             for collect_results, query in queries:
-                c.execute(query)
+                if isinstance(query, str):
+                    c.execute(query)
+                else:
+                    c.execute(*query)
                 if collect_results:
                     results.extend(map(list, c.fetchall()))
             return results
@@ -135,14 +167,43 @@ class ORMAggregate(object):
         finally:
             threadpool.close()
 
+    def _use_columns(self, categories, values):
+        if self.columns is None:
+            return False
+        return all(obj.supports_columns() for obj in itertools.chain(categories, values))
+
+    def _get_column_aggregate(self, categories, value):
+        """Compute the rows the aggregation sql of value would yield, using self.columns"""
+        groups = OrderedDict()
+        for codingjob, columns in self.columns:
+            context = value.prepare_columns(columns)
+            for row in columns:
+                if row.field is None:
+                    # Coding without values
+                    continue
+                keys = itertools.product(*(c.get_column_keys(row, codingjob) for c in categories))
+                for key in keys:
+                    accumulator = groups[key] if key in groups else value.get_column_accumulator()
+                    if value.add_column_row(accumulator, row, context):
+                        groups[key] = accumulator
+        return [list(key) + value.get_column_result(acc) for key, acc in groups.items()]
+
     def _get_aggregate(self, categories, values):
         # HACK: Determine last field category. See _set_last_field_aggregation() for info.
         last_field_category = ([None] + [c for c in categories if isinstance(c, SchemafieldCategory)])[-1]
         for value in values:
             value._set_last_field_aggregation(last_field_category)
 
-        queries = [self._get_aggregate_sql(categories, value) for value in values]
-        aggregations = list(self._execute_sqls(queries))
+        # Instantiate TermCategory with terms (HACK)
+        for i, category in enumerate(categories):
+            if isinstance(category, TermCategory):
+                categories[i] = category.copy(self.terms)
+
+        if self._use_columns(categories, values):
+            aggregations = [self._get_column_aggregate(categories, value) for value in values]
+        else:
+            queries = [self._get_aggregate_sql(categories, value) for value in values]
+            aggregations = list(self._execute_sqls(queries))
 
         # Aggregate further in Python code
         for n, (value, rows) in enumerate(zip(values, aggregations)):
@@ -175,7 +236,10 @@ class ORMAggregate(object):
         @type categories: iterable of Category
         @type values: iterable of Value
         """
-        if not self.codings.count():
+        if self.columns is not None:
+            if not any(len(columns) for _, columns in self.columns):
+                return iter([])
+        elif not self.codings.count():
             return iter([])
 
         if not values:
@@ -25,6 +25,7 @@ from operator import itemgetter
 from amcat.models import ArticleSet, Code, Article
 from amcat.tools.aggregate_orm.sqlobj import SQLObject, JOINS
 from amcat.tools.amcates import get_property_primitive_type
+from amcat.tools.codebookcache import CodebookCache
 
 log = logging.getLogger(__name__)
 
@@ -45,6 +46,28 @@ POSTGRES_DATE_TRUNC_VALUES = [
 ]
 
 DATE_TRUNC_SQL = 'date_trunc(\'{interval}\', T_articles.{field_name})'
+
+
+def _trunc(date, **replace):
+    return date.replace(microsecond=0, **replace)
+
+
+def _trunc_week(date):
+    date = _trunc(date, hour=0, minute=0, second=0)
+    return date - datetime.timedelta(days=date.weekday())
+
+
+# Python equivalents of date_trunc, used when aggregating coding columns
+DATE_TRUNC_FUNCTIONS = {
+    "second": lambda d: _trunc(d),
+    "minute": lambda d: _trunc(d, second=0),
+    "hour": lambda d: _trunc(d, minute=0, second=0),
+    "day": lambda d: _trunc(d, hour=0, minute=0, second=0),
+    "week": _trunc_week,
+    "month": lambda d: _trunc(d, day=1, hour=0, minute=0, second=0),
+    "quarter": lambda d: _trunc(d, month=d.month - (d.month - 1) % 3, day=1, hour=0, minute=0, second=0),
+    "year": lambda d: _trunc(d, month=1, day=1, hour=0, minute=0, second=0),
+}
 DATE_TRUNC_JSON_SQL = 'date_trunc(\'{interval}\', T_articles.properties->>\'{field_name}\')'
 
 __all__ = (
@@ -73,6 +96,21 @@ class Category(SQLObject):
     def get_group_by(self):
         return next(iter(self.get_selects()))
 
+    def supports_columns(self):
+        """Whether this category can be computed from coding columns. See get_column_keys()."""
+        return False
+
+    def get_column_keys(self, row, codingjob):
+        """
+        Returns the values the aggregation sql would select for a row of coding columns (see
+        amcat.tools.codingcolumns). An empty sequence excludes the row, multiple values
+        include it once for each value.
+
+        @type row: amcat.tools.codingcolumns.Row
+        @type codingjob: CodingJob
+        """
+        raise NotImplementedError("get_column_keys() should be implemented by subclasses supporting columns.")
+
     def get_column_names(self):
         """Returns names of columns when serializing to a flat format (csv)."""
         raise NotImplementedError("get_column_names() should be implemented by subclasses.")
@@ -142,6 +180,12 @@ class IntervalCategory(ArticleFieldCategory):
         """@type obj: datetime.datetime"""
         yield obj.isoformat()
 
+    def supports_columns(self):
+        return not self.is_json_field and self.field_name == "date" and self.interval in DATE_TRUNC_FUNCTIONS
+
+    def get_column_keys(self, row, codingjob):
+        return [DATE_TRUNC_FUNCTIONS[self.interval](row.date)]
+
     def __repr__(self):
         return "<IntervalCategory: %s>" % self.interval
 
@@ -181,6 +225,12 @@ class ArticleSetCategory(ModelCategory):
     def get_selects(self):
         yield "T_codingjobs.articleset_id"
 
+    def supports_columns(self):
+        return True
+
+    def get_column_keys(self, row, codingjob):
+        return [codingjob.articleset_id]
+
 
 class TermCategory(Category):
     joins_needed = ("codings", "coded_articles", "articles")
@@ -189,21 +239,34 @@ class TermCategory(Category):
         # Force random prefix
         super(TermCategory, self).__init__(prefix=None)
         self.terms = terms
+        self._article_terms = None
 
     def _get_values(self):
         for term, article_ids in enumerate(self.terms.values()):
             for article_id in article_ids:
                 yield article_id, term
 
+    def supports_columns(self):
+        return True
+
+    def get_column_keys(self, row, codingjob):
+        if self._article_terms is None:
+            self._article_terms = defaultdict(list)
+            for article_id, term in self._get_values():
+                self._article_terms[article_id].append(term)
+        return self._article_terms.get(row.article, ())
+
     def get_setup_statements(self):
         # Create table
         sql = "CREATE TEMPORARY TABLE T_{prefix}_terms (article_id int, term int);"
         yield sql.format(prefix=self.prefix)
 
+        # Pass values as two array parameters, to keep the statement small
         values = tuple(self._get_values())
         if values:
-            sql = "INSERT INTO T_{prefix}_terms (article_id, term) VALUES {values};"
-            yield sql.format(prefix=self.prefix, values=str(values)[1:-1])
+            article_ids, terms = map(list, zip(*values))
+            sql = "INSERT INTO T_{prefix}_terms (article_id, term) SELECT * FROM unnest(%s::int[], %s::int[]);"
+            yield sql.format(prefix=self.prefix), (article_ids, terms)
 
         # Create index
         sql = "CREATE INDEX T_{prefix}_article_id_index ON T_{prefix}_terms (article_id);"
@@ -252,12 +315,12 @@ class SchemafieldCategory(ModelCategory):
         self.codebook = codebook
         self.aggregation_map = {}
 
+        self.tree = None
         if self.codebook is not None:
-            self.codebook.cache()
-            for root_node in self.codebook.get_tree():
-                self.aggregation_map[root_node.code_id] = root_node.code_id
-                for descendant in root_node.get_descendants():
-                    self.aggregation_map[descendant.code_id] = root_node.code_id
+            self.tree = CodebookCache().get(self.codebook.id)
+            index = self.tree.get_index(include_hidden=True)
+            for root_id in index.get_root_ids():
+                self.aggregation_map.update(dict.fromkeys(index.get_subtree_ids(root_id), root_id))
 
     def _aggregate(self, categories, value, rows):
         num_categories = len(categories)
@@ -266,7 +329,7 @@ class SchemafieldCategory(ModelCategory):
         # First do a sanity check. If a coding specifies a code which is
         # NOT present in the given codebook, raise an error.
         coded_codes = set(map(itemgetter(self_index), rows))
-        codebook_codes = set(self.codebook.get_code_ids())
+        codebook_codes = set(self.tree.get_code_ids())
         invalid_codes = coded_codes - codebook_codes
 
         if invalid_codes:
@@ -295,6 +358,12 @@ class SchemafieldCategory(ModelCategory):
         where_sql = 'codings_values.field_id = {field.id}'
         yield where_sql.format(field=self.field)
 
+    def supports_columns(self):
+        return True
+
+    def get_column_keys(self, row, codingjob):
+        return [row.intval] if row.field == self.field.id else ()
+
     def __repr__(self):
         return "<SchemafieldCategory: %s>" % self.field
 
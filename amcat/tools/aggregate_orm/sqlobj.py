@@ -29,7 +29,7 @@ class SQLObject(object):
     def get_setup_statements(self):
         """Yield sql statements which should be executed before the aggregation
         begins. This could be used to create and populate temporary tables and
-        indices."""
+        indices. Statements are either sql strings, or (sql, params) tuples."""
         return ()
 
     def get_teardown_statements(self):
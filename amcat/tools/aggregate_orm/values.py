@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU Affero General Public        #
 # License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
+from collections import defaultdict
 from decimal import Decimal
 from operator import itemgetter
 from amcat.models import CodingSchemaField, FIELDTYPE_IDS, Coding, CodedArticle, CodingValue
@@ -60,6 +61,29 @@ class Value(SQLObject):
         """
         return value
 
+    def supports_columns(self):
+        """Whether this value can be computed from coding columns (see amcat.tools.codingcolumns)"""
+        return False
+
+    def prepare_columns(self, columns):
+        """Returns a context passed to add_column_row() for the rows of the given columns"""
+        return None
+
+    def get_column_accumulator(self):
+        """Returns a new (mutable) accumulator for a group of rows"""
+        raise NotImplementedError("Subclasses supporting columns should implement get_column_accumulator()")
+
+    def add_column_row(self, accumulator, row, context):
+        """
+        Add a row of coding columns to accumulator. Returns whether the row is included, i.e.
+        whether the joins of the aggregation sql would yield any rows for it.
+        """
+        raise NotImplementedError("Subclasses supporting columns should implement add_column_row()")
+
+    def get_column_result(self, accumulator):
+        """Returns the values the aggregation sql would select for the accumulated rows"""
+        raise NotImplementedError("Subclasses supporting columns should implement get_column_result()")
+
     def get_column_names(self):
         yield "Value"
 
@@ -148,19 +172,77 @@ class AverageValue(Value):
         weight, value = value
         return float(value)
 
+    def supports_columns(self):
+        return True
+
+    def prepare_columns(self, columns):
+        # Values of this field per coding, or per coded article if extra joins are needed
+        by_coded_article = self.need_extra_joins
+        is_article_field = self.field.codingschema.isarticleschema
+        values = defaultdict(list)
+        for row in columns:
+            if row.field != self.field.id:
+                continue
+            if by_coded_article:
+                if (row.sentence is None) is is_article_field:
+                    values[row.coded_article].append(row.intval)
+            else:
+                values[row.coding].append(row.intval)
+        return by_coded_article, values
+
+    def get_column_accumulator(self):
+        return [0, 0]
+
+    def add_column_row(self, accumulator, row, context):
+        by_coded_article, values = context
+        matches = values.get(row.coded_article if by_coded_article else row.coding)
+        if not matches:
+            return False
+        for intval in matches:
+            if intval is not None:
+                accumulator[0] += 1
+                accumulator[1] += intval
+        return True
+
+    def get_column_result(self, accumulator):
+        count, total = accumulator
+        if not count:
+            return [0, None]
+        average = Decimal(total) / count
+        if self.field.fieldtype_id == FIELDTYPE_IDS.QUALITY:
+            average /= 10
+        return [count, average]
+
     def __repr__(self):
         return "<AverageValue: %s>" % self.field
 
 class CountValue(Value):
+    # Column of coding columns of which distinct values are counted
+    column = None
+
     def postprocess(self, value):
         return int(value[0])
 
     def aggregate(self, values):
         return [sum(map(itemgetter(0), values))]
 
+    def supports_columns(self):
+        return self.column is not None
+
+    def get_column_accumulator(self):
+        return set()
+
+    def add_column_row(self, accumulator, row, context):
+        accumulator.add(getattr(row, self.column))
+        return True
+
+    def get_column_result(self, accumulator):
+        return [len(accumulator)]
+
 
 class CountArticlesValue(CountValue):
     joins_needed = ("codings", "coded_articles", "articles")
+    column = "article"
 
     def get_selects(self):
         return ['COUNT(DISTINCT(T_articles.article_id))']
@@ -171,6 +253,7 @@ class CountArticlesValue(CountValue):
 
 class CountCodingsValue(CountValue):
     joins_needed = ("codings",)
+    column = "coded_article"
 
     def get_selects(self):
         return ['COUNT(DISTINCT(T_coded_articles.id))']
@@ -180,6 +263,8 @@ class CountCodingsValue(CountValue):
 
 
 class CountCodingValuesValue(CountValue):
+    column = "codingvalue"
+
     def get_selects(self):
         return ['COUNT(codings_values.codingvalue_id)']
 
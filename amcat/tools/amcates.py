@@ -16,7 +16,6 @@
 # You should have received a copy of the GNU Affero General Public        #
 # License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
-import copy
 import datetime
 import functools
 import logging
@@ -26,7 +25,6 @@ import re
 from collections import namedtuple
 from hashlib import sha224 as hash_class
 from json import dumps as serialize
-from multiprocessing.pool import ThreadPool
 from types import MappingProxyType
 from typing import Union
 
@@ -38,7 +36,7 @@ import amcat.models
 from amcat.tools import queryparser, toolkit
 from amcat.tools.caching import cached
 from amcat.tools.progress import NullMonitor
-from amcat.tools.toolkit import multidict, splitlist
+from amcat.tools.toolkit import splitlist
 
 log = logging.getLogger(__name__)
 
@@ -404,6 +402,22 @@ class _ES(object):
         """
         return scan(self.es, index=self.index, doc_type=self.doc_type, query=query, **kargs)
 
+    def scroll(self, body, size=1000, scroll="1m", **options):
+        """
+        Iterate over all hits of the given search body using the scroll api. As opposed to scan,
+        this keeps sorting and scoring intact.
+        """
+        result = self.search(body, size=size, scroll=scroll, **options)
+        try:
+            while result["hits"]["hits"]:
+                yield from result["hits"]["hits"]
+                result = self.es.scroll(scroll_id=result["_scroll_id"], scroll=scroll)
+        finally:
+            try:
+                self.es.clear_scroll(scroll_id=result["_scroll_id"])
+            except NotFoundError:
+                pass
+
     def query_ids(self, query=None, filters=EMPTY_RO_DICT, body=None, limit=None, **kwargs):
         """
         Query the index returning a sequence of article ids for the mathced articles
@@ -461,14 +475,64 @@ class _ES(object):
 
         return result
 
-    def _get_used_properties(self, body__prop):
-        body, prop = body__prop
-        body["query"]["bool"]["must"][1]["exists"]["field"] = prop
-        return bool(self.es.count(index=self.index, doc_type=self.doc_type, body=body)['count'])
+    def multi_query(self, queries, filters=EMPTY_RO_DICT, size=10000):
+        """
+        Execute a batch of queries with the same filters in a single _msearch round trip
+
+        @param queries: a sequence of elastic query strings (lucene syntax)
+        @param filters: field filters as accepted by build_body, applied to every query
+        @param size: maximum number of hits returned per query
+        @return: a list containing an {article_id: score} dict per query, in order of queries
+        """
+        queries = list(queries)
+        if not queries:
+            return []
+
+        header = {"index": self.index, "type": self.doc_type}
+        body = []
+        for query in queries:
+            body.append(header)
+            body.append(dict(build_body(query, filters), size=size, fields=[]))
+
+        results = []
+        for response in self.es.msearch(body=body)["responses"]:
+            if "error" in response:
+                raise ElasticSearchError(response["error"])
+            results.append({int(hit["_id"]): int(hit["_score"]) for hit in response["hits"]["hits"]})
+        return results
+
+    def multi_query_ids(self, queries, filters=EMPTY_RO_DICT):
+        """
+        Determine the matching article ids for each of a batch of queries with a single scan. Each
+        query is named, and the names of the queries matching a document are read from its hit.
+
+        @param queries: a sequence of elastic query strings (lucene syntax)
+        @param filters: field filters as accepted by build_filter, applied to every query
+        @return: a list containing a set of article ids per query, in order of queries
+        """
+        queries = list(queries)
+        results = [set() for _ in queries]
+        if not queries:
+            return results
+
+        named = [{"bool": {"must": [queryparser.parse_to_terms(query).get_dsl()], "_name": str(i)}}
+                 for i, query in enumerate(queries)]
+        filtered = {"query": {"bool": {"should": named, "minimum_should_match": 1}}}
+
+        filter = build_filter(**filters)
+        if filter:
+            filtered["filter"] = filter
+
+        for hit in self.scan({"query": {"filtered": filtered}}, size=1000, fields=""):
+            for name in hit.get("matched_queries", ()):
+                results[int(name)].add(int(hit["_id"]))
+        return results
 
     def get_used_properties(self, set_ids=None, article_ids=None, **filters):
         """
-        Returns a sequency of property names in use in the specified set(s) (or setids)
+        Returns a sequency of property names in use in the specified set(s) (or setids). All
+        properties are checked in a single request, using a filters aggregation with a bucket
+        per flexible property.
         """
         if set_ids is not None:
             filters["sets"] = set_ids
@@ -477,41 +541,32 @@ class _ES(object):
             filters["ids"] = article_ids
 
         all_properties = self.get_properties()
-        flexible_properties = set(all_properties) - set(ALL_FIELDS)
+        flexible_properties = sorted(set(all_properties) - set(ALL_FIELDS))
+        if not flexible_properties:
+            return
 
-        body = {"query": {"bool": {"must": [
-            build_filter(**filters),
-            {"exists": {"field": "fakeprop"}}
-        ]}}}
+        body = {
+            "query": {"bool": {"must": [build_filter(**filters)]}},
+            "aggs": {"properties": {"filters": {"filters": {
+                prop: {"exists": {"field": prop}} for prop in flexible_properties
+            }}}}
+        }
 
-        bodies = (copy.deepcopy(body) for _ in range(len(flexible_properties)))
-        pool = ThreadPool()
-        results = pool.imap(self._get_used_properties, zip(bodies, flexible_properties))
+        result = self.search(body, size=0, search_type="count")
+        buckets = result["aggregations"]["properties"]["buckets"]
+        for prop in flexible_properties:
+            if buckets[prop]["doc_count"]:
+                yield prop
 
-        try:
-            for found, prop in zip(results, flexible_properties):
-                if found:
-                    yield prop
-        finally:
-            pool.close()
-
-    def add_articles(self, article_ids, batch_size=1000):
+    def add_articles(self, article_ids, batch_size=1000, monitor=NullMonitor(), **options):
         """
-        Add the given article_ids to the index. This is done in batches, so there
-        is no limit on the length of article_ids (which can be a generator).
+        Add the given article_ids to the index. Fetching articles, building documents and
+        sending them to elastic is pipelined (see amcates_bulk.BulkIndexer for options), so
+        there is no limit on the length of article_ids (which can be a generator).
         """
-        #WvA: remove redundancy with create_articles
+        from amcat.tools.amcates_bulk import BulkIndexer
         if not article_ids: return
-        from amcat.models import Article, ArticleSetArticle
-
-        n = len(article_ids) / batch_size
-        for i, batch in enumerate(splitlist(article_ids, itemsperbatch=batch_size)):
-            log.info("Adding batch {i}/{n}".format(**locals()))
-            all_sets = multidict((aa.article_id, aa.articleset_id)
-                                 for aa in ArticleSetArticle.objects.filter(article__in=batch))
-            dicts = (get_article_dict(article, list(all_sets.get(article.id, [])))
-                     for article in Article.objects.filter(pk__in=batch))
-            self.bulk_insert(dicts, batch_size=None)
+        BulkIndexer(self, batch_size=batch_size, **options).index_articles(article_ids, monitor=monitor)
 
     def remove_from_set(self, setid, article_ids, flush=True):
         """Remove the given articles from the given set. This is done in batches, so there
@@ -537,6 +592,26 @@ class _ES(object):
             monitor.update(message="Adding batch {iplus}/{nbatches}..".format(iplus=i+1, nbatches=nbatches))
             self.bulk_update(batch, UPDATE_SCRIPT_ADD_TO_SET, params={'set' : setid})
 
+    def add_to_sets(self, memberships, batch_size=None):
+        """
+        Add articles to (possibly many) sets using a single bulk request, or one bulk
+        request per batch_size articles if given.
+
+        @param memberships: a dictionary {setid: article_ids}
+        """
+        actions = [(aid, setid) for setid, article_ids in memberships.items() for aid in article_ids]
+        if not actions:
+            return
+
+        for batch in splitlist(actions, itemsperbatch=batch_size or len(actions)):
+            body = "".join("{}\n{}\n".format(
+                serialize({"update": {"_id": aid}}),
+                serialize({"script": {"file": UPDATE_SCRIPT_ADD_TO_SET, "params": {"set": setid}}})
+            ) for aid, setid in batch)
+            resp = self.es.bulk(body=body, index=self.index, doc_type=settings.ES_ARTICLE_DOCTYPE)
+            if resp["errors"]:
+                raise ElasticSearchError(resp)
+
     def get_tokens(self, aid: int, fields=["text", "title"]):
         """
         Get a list of all tokens (words and their positions) in the given document
@@ -552,24 +627,16 @@ class _ES(object):
                     for token in info['tokens']:
                         yield field, token['position'], term
 
-    def bulk_insert(self, dicts, batch_size=1000, monitor=NullMonitor()):
+    def bulk_insert(self, dicts, batch_size=1000, monitor=NullMonitor(), **options):
         """
-        Bulk insert the given articles in batches of batch_size
+        Bulk insert the given articles in batches of batch_size. Batches are sent concurrently
+        and failing documents are retried, see amcates_bulk.BulkIndexer for options.
         """
-        batches = list(toolkit.splitlist(dicts, itemsperbatch=batch_size)) if batch_size else [dicts]
-        monitor = monitor.submonitor(total=len(batches))
-        nbatches = len(batches)
-        for i, batch in enumerate(batches):
-            monitor.update(1, "Adding batch {iplus}/{nbatches}".format(iplus=i+1, **locals()))
-            props, articles = set(), {}
-            for d in batch:
-                props |= (set(d.keys()) - ALL_FIELDS)
-                articles[d["id"]] = serialize(d)
-            self.check_properties(props)
-            body = get_bulk_body(articles)
-            resp = self.es.bulk(body=body, index=self.index, doc_type=settings.ES_ARTICLE_DOCTYPE)
-            if resp["errors"]:
-                raise ElasticSearchError(resp)
+        from amcat.tools.amcates_bulk import BulkIndexer
+        if not batch_size:
+            dicts = list(dicts)
+            batch_size = max(len(dicts), 1)
+        BulkIndexer(self, batch_size=batch_size, **options).index_documents(dicts, monitor=monitor)
 
     def update_values(self, article_id, values):
         """Update properties of existing article.
@@ -821,8 +888,8 @@ class _ES(object):
         hash = get_article_dict(article).hash
         return self.query(filters={'hashes': hash}, fields=["sets"], score=False)
 
-    def _get_purge_actions(self, query):
-        for id in self.query_ids(body=query):
+    def _get_delete_actions(self, article_ids):
+        for id in article_ids:
             yield {
                 "_op_type": "delete",
                 "_id": id,
@@ -830,10 +897,14 @@ class _ES(object):
                 "_type": settings.ES_ARTICLE_DOCTYPE
             }
 
+    def delete_articles(self, article_ids):
+        """Remove the given articles from the index. Articles not in the index are ignored."""
+        return bulk(self.es, self._get_delete_actions(article_ids), raise_on_error=False)
+
     def purge_orphans(self):
         """Remove all articles without set from the index"""
         query =  {"query": {"constant_score": {"filter": {"missing": {"field": "sets"}}}}}
-        return bulk(self.es, self._get_purge_actions(query))
+        return bulk(self.es, self._get_delete_actions(self.query_ids(body=query)))
 
     def get_child_type_counts(self, **filters):
         """Get the number of child documents per type"""
@@ -0,0 +1,281 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+"""
+Pipelined bulk indexing of articles into elastic.
+
+Indexing consists of three steps: fetching articles from the database, converting
+them to (serialised) elastic documents and sending bulk requests to elastic. The
+BulkIndexer runs these steps concurrently: rows are fetched in the calling thread,
+documents are built on a process pool and bulk requests are sent by a pool of
+threads. Every stage keeps a bounded number of batches in flight, so memory usage
+does not depend on the number of articles being indexed.
+"""
+import collections
+import logging
+import math
+import multiprocessing
+import threading
+import time
+from multiprocessing.pool import Pool, ThreadPool
+
+from django.conf import settings
+from django.db import connection
+from elasticsearch import ConnectionError, TransportError
+
+from amcat.tools.amcates import ALL_FIELDS, ElasticSearchError, get_article_dict, get_bulk_body, serialize
+from amcat.tools.progress import NullMonitor
+from amcat.tools.toolkit import splitlist
+
+log = logging.getLogger(__name__)
+
+# Number of threads sending bulk requests, and number of requests waiting / in flight
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_IN_FLIGHT = 8
+
+# Documents (or requests) failing with these statuses are retried with exponential backoff
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+DEFAULT_MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+
+# Number of articles fetched from the database per query
+FETCH_SIZE = 10000
+
+ARTICLE_ROWS_SQL = """
+SELECT a.article_id, a.title, a.url, a.date, a.text, a.parent_hash, a.properties,
+       array_remove(array_agg(aa.articleset_id), NULL)
+FROM articles a
+LEFT JOIN articlesets_articles aa ON aa.article_id = a.article_id
+WHERE a.article_id = ANY(%s)
+GROUP BY a.article_id
+"""
+
+
+def iter_article_rows(article_ids, fetch_size=FETCH_SIZE):
+    """
+    Yield (id, title, url, date, text, parent_hash, properties, sets) tuples for the given
+    article ids. Articles and their set memberships are fetched using a single query per
+    fetch_size articles.
+    """
+    for batch in splitlist(article_ids, itemsperbatch=fetch_size):
+        with connection.cursor() as cursor:
+            cursor.execute(ARTICLE_ROWS_SQL, [list(batch)])
+            yield from cursor.fetchall()
+
+
+def build_documents(rows):
+    """
+    Convert rows as yielded by iter_article_rows to elastic documents. This function is
+    run on worker processes, so it should not touch the database.
+
+    @return: ({id: serialised document}, set of flexible properties used)
+    """
+    from amcat.models.article import Article, PropertyMapping
+
+    documents, properties = collections.OrderedDict(), set()
+    for aid, title, url, date, text, parent_hash, props, sets in rows:
+        if not isinstance(props, PropertyMapping):
+            props = PropertyMapping.fromdb(props)
+        article = Article(id=aid, title=title, url=url, date=date, text=text,
+                          parent_hash=parent_hash, properties=props)
+        document = get_article_dict(article, sets=list(sets))
+        properties |= set(document) - ALL_FIELDS
+        documents[aid] = serialize(document)
+    return documents, properties
+
+
+def serialize_documents(dicts):
+    """Serialise already built article dicts, see build_documents"""
+    documents, properties = collections.OrderedDict(), set()
+    for d in dicts:
+        properties |= set(d) - ALL_FIELDS
+        documents[d["id"]] = serialize(d)
+    return documents, properties
+
+
+def bounded_imap(pool, func, iterable, max_pending):
+    """
+    Like pool.imap, but never submits more than max_pending tasks at once. The iterable
+    is only consumed as fast as the pool processes it, which provides backpressure to
+    the stages before it. If pool is None, func is called in the current thread.
+    """
+    if pool is None:
+        yield from map(func, iterable)
+        return
+
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _can_fork():
+    # Daemonic processes (e.g. multiprocessing workers) are not allowed to have children
+    return not multiprocessing.current_process().daemon
+
+
+class BulkIndexer(object):
+    """
+    Index documents in elastic using concurrent bulk requests. Documents failing with a
+    transient error (see RETRY_STATUSES) are retried individually. Documents which still
+    fail are collected in .errors; index_* raises an ElasticSearchError at the end if
+    any document failed, after all other documents have been indexed.
+    """
+    def __init__(self, es, batch_size=1000, workers=DEFAULT_WORKERS, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 processes=None, max_retries=DEFAULT_MAX_RETRIES):
+        """
+        @param es: amcates._ES object to index into
+        @param batch_size: number of documents per bulk request
+        @param workers: number of threads sending bulk requests
+        @param max_in_flight: maximum number of bulk requests queued or being sent
+        @param processes: number of processes building documents. Defaults to the number
+                          of cpus; use 0 to build documents in the calling thread.
+        @param max_retries: number of times a failing document is retried
+        """
+        self.es = es
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_in_flight = max(max_in_flight, workers)
+        self.processes = multiprocessing.cpu_count() if processes is None else processes
+        self.max_retries = max_retries
+        self.errors = {}
+
+        self._known_properties = None
+        self._properties_lock = threading.Lock()
+
+    def index_documents(self, dicts, monitor=NullMonitor()):
+        """
+        Index the given article dicts (see amcates.get_article_dict)
+        """
+        if not hasattr(dicts, "__len__"):
+            dicts = list(dicts)
+        batches = splitlist(dicts, itemsperbatch=self.batch_size)
+        self._run(batches, serialize_documents, math.ceil(len(dicts) / self.batch_size), monitor)
+
+    def index_articles(self, article_ids, monitor=NullMonitor()):
+        """
+        Fetch the given articles from the database and index them. Set memberships
+        are taken from the database as well.
+        """
+        article_ids = list(article_ids)
+        rows = iter_article_rows(article_ids, fetch_size=max(FETCH_SIZE, self.batch_size))
+        batches = splitlist(rows, itemsperbatch=self.batch_size)
+        nbatches = math.ceil(len(article_ids) / self.batch_size)
+
+        if self.processes and _can_fork():
+            pool = Pool(self.processes)
+            try:
+                documents = bounded_imap(pool, build_documents, batches, max_pending=2 * self.processes)
+                self._run(documents, None, nbatches, monitor)
+            finally:
+                pool.terminate()
+        else:
+            self._run(batches, build_documents, nbatches, monitor)
+
+    def _run(self, batches, convert, nbatches, monitor):
+        """Send all batches using the thread pool, optionally converting them (in the sending
+        thread) using the convert function first."""
+        self.errors = {}
+        if not nbatches:
+            return
+
+        monitor = monitor.submonitor(total=nbatches)
+
+        def send(batch):
+            return self._send(*(convert(batch) if convert else batch))
+
+        pool = ThreadPool(self.workers)
+        done = 0
+        try:
+            for i, errors in enumerate(bounded_imap(pool, send, batches, self.max_in_flight)):
+                self.errors.update(errors)
+                if done < nbatches:
+                    done += 1
+                    monitor.update(1, "Indexed batch {}/{}".format(i + 1, nbatches))
+        finally:
+            pool.terminate()
+
+        if done < nbatches:
+            # Some articles did not exist, so we saw less batches than expected
+            monitor.update(nbatches - done)
+
+        if self.errors:
+            raise ElasticSearchError(self.errors)
+
+    def _check_properties(self, properties):
+        """Make sure mappings exist for the given properties. Mappings are checked only once
+        per indexer, instead of once per batch."""
+        with self._properties_lock:
+            if self._known_properties is None:
+                self._known_properties = self.es.get_properties()
+            to_add = properties - self._known_properties
+            if to_add:
+                self.es.add_properties(to_add)
+                self._known_properties |= to_add
+
+    def _bulk(self, documents):
+        body = get_bulk_body(documents)
+        return self.es.es.bulk(body=body, index=self.es.index, doc_type=settings.ES_ARTICLE_DOCTYPE)
+
+    def _send(self, documents, properties):
+        """
+        Send a batch of serialised documents, retrying failed documents.
+        @return: a dictionary {id: error} of documents that could not be indexed
+        """
+        self._check_properties(properties)
+
+        failed, transient = {}, {}
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+
+            try:
+                resp = self._bulk(documents)
+            except TransportError as e:
+                if not (isinstance(e, ConnectionError) or e.status_code in RETRY_STATUSES):
+                    raise
+                log.warning("Bulk request failed ({}), retrying {} documents".format(e, len(documents)))
+                transient = {aid: str(e) for aid in documents}
+                continue
+
+            if not resp["errors"]:
+                return failed
+
+            retry, transient = collections.OrderedDict(), {}
+            for item in resp["items"]:
+                (result,) = item.values()
+                if "error" not in result:
+                    continue
+                aid = int(result["_id"])
+                if result.get("status") in RETRY_STATUSES:
+                    retry[aid] = documents[aid]
+                    transient[aid] = result["error"]
+                else:
+                    failed[aid] = result["error"]
+
+            if not retry:
+                return failed
+
+            log.warning("{} documents failed, retrying {}".format(len(failed) + len(retry), len(retry)))
+            documents = retry
+
+        failed.update(transient)
+        return failed
@@ -17,7 +17,6 @@
 # License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
 import datetime
-import functools
 import random
 import collections
 import regex
@@ -31,6 +30,7 @@ from typing import Optional
 from django.conf import settings
 from django.db.models import QuerySet
 from django.http import QueryDict
+from elasticsearch import NotFoundError
 
 from amcat.models import get_used_properties_by_articlesets, ArticleSet, Project
 from amcat.tools import queryparser
@@ -39,6 +39,12 @@ from amcat.tools.amcates import ALL_FIELDS, ES, get_property_primitive_type
 from amcat.tools.queryparser import Term
 
 
+# Largest window elastic allows us to page through using from / size (index.max_result_window).
+# Larger windows, or windows without a size, are streamed using the scroll api.
+MAX_RESULT_WINDOW = 10000
+SCROLL_SIZE = 1000
+SCROLL_TIMEOUT = "1m"
+
 TOKEN_START = toolkit.random_alphanum(16)
 TOKENIZER_PATTERN = settings.ES_SETTINGS["analysis"]["tokenizer"]["unicode_letters_digits"]["pattern"]
 TOKENIZER_INV = regex.compile(TOKENIZER_PATTERN.replace("^", "") + "+")
@@ -347,101 +353,121 @@ class ESQuerySet:
         self._query = None
         self._count_cache = None
 
-        # HACK: Set size to default max of elastic. We should think about pagination..
-        self.size = 10000
+        # Window of results to fetch. A size of None means 'all results'.
+        self.size = None
         self.offset = 0
 
-    def _do_query(self, query):
-        result = ES().search(query)
-
-        if len(result["hits"]["hits"]) == self.size:
-            raise NotImplementedError("Returned 10000 articles exactly. Time to implement scroll :)")
-
-        return result
+    def _iter_hits(self, query: dict) -> Iterable[List[dict]]:
+        """
+        Yield pages of raw hits for the given query, taking offset and size into account. Small
+        windows are fetched with a single from / size request. All others are streamed through
+        the scroll api, so only a single page is kept in memory.
+        """
+        if self.size == 0:
+            return
+
+        es = ES()
+        query = dict(query)
+        if self.size is not None and self.offset + self.size <= MAX_RESULT_WINDOW:
+            query.update({"from": self.offset, "size": self.size})
+            yield es.search(query)["hits"]["hits"]
+            return
+
+        query.pop("from", None)
+        query["size"] = SCROLL_SIZE
+        skip, remaining = self.offset, self.size
+
+        result = es.search(query, scroll=SCROLL_TIMEOUT)
+        try:
+            while result["hits"]["hits"]:
+                hits = result["hits"]["hits"]
+                if skip:
+                    hits, skip = hits[skip:], max(0, skip - len(hits))
+                if remaining is not None:
+                    hits, remaining = hits[:remaining], remaining - len(hits[:remaining])
+                if hits:
+                    yield hits
+                if remaining == 0:
+                    break
+                result = es.es.scroll(scroll_id=result["_scroll_id"], scroll=SCROLL_TIMEOUT)
+        finally:
+            try:
+                es.es.clear_scroll(scroll_id=result["_scroll_id"])
+            except NotFoundError:
+                pass
+
+    def _highlight_hits(self, hits: List[dict]) -> Iterable[HighlightedESArticle]:
+        """Highlight a page of hits. We need to execute a query for every highlighter, restricted
+        to the articles in this page."""
+        for hit in hits:
+            _to_flat_dict(hit["fields"])
+
+        # Order might be unreliable, so we make mappings
+        ids = [int(hit["_id"]) for hit in hits]
+        page = self._copy(ordering=(), offset=0, size=len(ids), filters=self.filters + ({"ids": {"values": ids}},))
+
+        highlighted_texts = []
+        for highlight in self.highlights:
+            highlighted_hits = ES().search(page.get_query(highlight))["hits"]["hits"]
+            for hit in highlighted_hits:
+                _to_flat_dict(hit["highlight"])
+            highlighted_texts.append({d["_id"]: d["highlight"] for d in highlighted_hits})
+
+        markers = [h.mark for h in self.highlights]
+        for text in hits:
+            highlighted = [h.get(text["_id"], text["fields"]) for h in highlighted_texts]
+            merged = dict(merge_highlighted_document(text["fields"], highlighted, markers))
+            yield HighlightedESArticle(self.fields, ChainMap(merged, text["fields"]))
 
     def __iter__(self) -> Iterable[ESArticle]:
-        if not self.highlights:
-            # Case 1: no highlighters
-            hits = ES().search(self.get_query())["hits"]["hits"]
-            for hit in hits:
-                _to_flat_dict(hit["fields"])
-                yield ESArticle(self.fields, hit["fields"])
-        else:
-            # Case 2: at least one highlighter present. We need to execute a query for every
-            # highlighter plus one for the original text.
-            original_texts = self._do_query(self.get_query())["hits"]["hits"]
-            for hit in original_texts:
-                _to_flat_dict(hit["fields"])
-
-            # Order might be unreliable, so we make mappings
-            unordered = self.order_by(None)
-            highlighted_texts = []
-            for highlight in self.highlights:
-                unordered.get_query(highlight)
-                result = self._do_query(self.get_query(highlight))
-                for hit in result["hits"]["hits"]:
-                    _to_flat_dict(hit["highlight"])
-                highlighted_texts.append({d["_id"]: d["highlight"] for d in result["hits"]["hits"]})
-
-            markers = [h.mark for h in self.highlights]
-            for text in original_texts:
-                highlighted = [h.get(text["_id"], text["fields"]) for h in highlighted_texts]
-                merged = dict(merge_highlighted_document(text["fields"], highlighted, markers))
-                yield HighlightedESArticle(self.fields, ChainMap(merged, text["fields"]))
-
-    @functools.lru_cache()
-    def __len__(self):
-        """For a more efficient way of determining this size of this set use count(). This
-        method will execute the query (which includes fetching all documents) and count
-        the size of that set.
-
-        This method is left 'inefficient' due to the following common pattern:
-
-            qs = list(ESQuerySet(...))
+        for hits in self._iter_hits(self.get_query()):
+            if self.highlights:
+                yield from self._highlight_hits(hits)
+            else:
+                for hit in hits:
+                    _to_flat_dict(hit["fields"])
+                    yield ESArticle(self.fields, hit["fields"])
 
-        list() will first determine the size of its given argument (if it detects __len__)
-        to allocate a sufficient amount of memory. Therefore; if we would call count() we
-        would execute the query twice which is clearly undesirable.
+    def __len__(self):
+        """
+        Return the number of articles in this (sliced) queryset. The total number of matching
+        articles is determined by a count request, and cached on this queryset.
         """
-        if self._count_cache:
-            return self._count_cache
-        return sum(1 for _ in self)
+        if self._count_cache is None:
+            self._count_cache = self.count()
+        n = max(0, self._count_cache - self.offset)
+        return n if self.size is None else min(n, self.size)
 
     def __bool__(self):
         return bool(len(self))
 
+    def _slice(self, start: int, stop: Optional[int]) -> "ESQuerySet":
+        """Return a copy of this queryset restricted to [start:stop] of the current window"""
+        size = None if stop is None else max(0, stop - start)
+        if self.size is not None:
+            size = max(0, self.size - start) if size is None else min(size, max(0, self.size - start))
+        return self._copy(offset=self.offset + start, size=size)
+
     def __getitem__(self, item: Union[int, slice]):
-        # TODO: Query elastic for pagination
+        """Index or slice this queryset. Only the requested articles are fetched from elastic."""
         if isinstance(item, int):
             if item < 0:
                 raise TypeError("Negative indexing not supported")
 
-            for i, article in enumerate(self):
-                if i == item:
-                    return article
+            for article in self._slice(item, item + 1):
+                return article
             raise IndexError("IndexError: list index out of range")
 
-        start, stop, step = item
-        start = start or 0
-        stop = len(self) if stop is None else stop
-        step = 1 if step is None else step
+        start = item.start or 0
+        step = 1 if item.step is None else item.step
 
-        if start < 0 or stop < 0:
+        if start < 0 or (item.stop is not None and item.stop < 0):
             raise TypeError("Negative indexing not supported")
 
         if step <= 0:
             raise TypeError("Step can't be negative or zero")
 
-        articles = []
-        for i, article in enumerate(self):
-            if i >= stop:
-                break
-            elif len(articles) % step != 0:
-                continue
-            elif i >= start:
-                articles.append(article)
-
-        return articles
+        return list(self._slice(start, item.stop))[::step]
 
     def _check_fields(self, fields):
         for field in fields:
@@ -478,7 +504,7 @@ class ESQuerySet:
         query = {
             "track_scores": True if "?" in self.ordering else self.track_scores,
             "fields": tuple(set(self.fields) | {"_doc"}),
-            "size": self.size,
+            "size": MAX_RESULT_WINDOW if self.size is None else self.size,
             "from": self.offset,
             "query": {
                 "function_score": {
@@ -594,10 +620,11 @@ class ESQuerySet:
 
         # Parse result
         articles = collections.OrderedDict()
-        for hit in new._do_query(dsl)["hits"]["hits"]:
-            articles[hit["fields"]["id"][0]] = {
-                field: hit["highlight"][field] for field in fields
-            }
+        for hits in new._iter_hits(dsl):
+            for hit in hits:
+                articles[hit["fields"]["id"][0]] = {
+                    field: hit["highlight"][field] for field in fields
+                }
 
         # HACK: Elastic does not escape html tags *in the article*. We therefore pass a random
         # marker and use it to escape ourselves.
@@ -743,13 +770,18 @@ class ESQuerySet:
         return self._copy(ordering=tuple(ordering), seed=seed)
 
     def count(self):
-        return ES()._count(self.get_query())["count"]
+        """Return the number of matching articles, regardless of slicing"""
+        return ES()._count({"query": self.get_query()["query"]})["count"]
 
     def _copy(self, **kwargs):
         new = ESQuerySet(ArticleSet.objects.none())
         for slot in self.__slots__:
             setattr(new, slot, getattr(self, slot))
 
+        # The cached count remains valid if only the window changes
+        if set(kwargs) - {"offset", "size"}:
+            new._count_cache = None
+
         for attr, value in kwargs.items():
             setattr(new, attr, value)
 
@@ -22,10 +22,11 @@ An association represents a table of conditional probabilities for a set
 of SearchQuery objects.
 """
 import datetime
+import heapq
 
 from collections import namedtuple, defaultdict
 from functools import partial
-from itertools import product
+from itertools import product, groupby
 
 from amcat.tools import amcates
 from amcat.tools.caching import cached
@@ -129,32 +130,90 @@ class Association(object):
         if weighted:
             self.score_func = get_asymptotic_weight
 
-    def _get_query_arguments(self, query):
+    def _get_cooccurrence_aggregation(self):
+        """Nested filters aggregation counting the articles matching each query (per interval),
+        and within those the articles matching each other query."""
+        filters = {str(i): dict(amcates.build_body(q.query, query_as_filter=True))["filter"]
+                   for i, q in enumerate(self.queries)}
+
+        aggregation = {
+            "filters": {"filters": filters},
+            "aggregations": {"pairs": {"filters": {"filters": filters}}}
+        }
+
+        if self.interval is None:
+            return aggregation
+
         return {
-            "score": self.weighted,
-            "fields": self.fields,
-            "filters": self.filters,
-            "query": query.query
+            "date_histogram": {"field": "date", "interval": self.interval, "min_doc_count": 1},
+            "aggregations": {"queries": aggregation}
         }
 
-    def _get_query(self, query):
-        return self.elastic_api.query_all(**self._get_query_arguments(query))
+    def _get_aggregated_cooccurrences(self):
+        """Get (unweighted) co-occurrence counts directly from elastic"""
+        result = self.elastic_api.search_aggregate(self._get_cooccurrence_aggregation(), filters=self.filters)
+
+        if self.interval is None:
+            intervals = [(None, result)]
+        else:
+            intervals = ((self.interval_func(amcates.get_date(b["key"])), b["queries"]) for b in result["buckets"])
+
+        totals = defaultdict(dict)
+        joint = defaultdict(dict)
+        for interval, aggregation in intervals:
+            for i, query1 in enumerate(self.queries):
+                bucket = aggregation["buckets"][str(i)]
+                if not bucket["doc_count"]:
+                    continue
+
+                totals[interval][query1] = bucket["doc_count"]
+                for j, query2 in enumerate(self.queries):
+                    joint[interval][query1, query2] = bucket["pairs"]["buckets"][str(j)]["doc_count"]
+
+        return totals, joint
 
-    def _get_scores(self):
-        # Ideally, we would like to use elastic aggregations for the
-        # intervals, but we need scores simultaneously so we can't.
-        for query in self.queries:
-            for a in self._get_query(query):
-                interval = self.interval_func(getattr(a, "date", None))
-                yield ArticleScore(a.id, query, interval, self.score_func(a))
+    def _get_scores(self, query):
+        """Stream the article scores for query, ordered by article id"""
+        body = dict(amcates.build_body(query.query, self.filters))
+        body.update({"sort": ["id"], "track_scores": True})
+
+        for hit in self.elastic_api.scroll(body, fields=self.fields):
+            a = amcates.Result.from_hit(None, hit, self.fields)
+            interval = self.interval_func(getattr(a, "date", None))
+            yield ArticleScore(a.id, query, interval, self.score_func(a))
+
+    def _get_weighted_cooccurrences(self):
+        """Compute weighted co-occurrences by merging the (id ordered) score streams of all
+        queries. Only the articles matched by a query are considered for that query, and only
+        one page of each stream is kept in memory."""
+        totals = defaultdict(partial(defaultdict, float))
+        joint = defaultdict(partial(defaultdict, float))
+
+        streams = [self._get_scores(q) for q in self.queries]
+        for aid, scores in groupby(heapq.merge(*streams, key=lambda s: s.id), key=lambda s: s.id):
+            scores = list(scores)
+            for _, query1, interval, score1 in scores:
+                totals[interval][query1] += score1
+                for _, query2, _, score2 in scores:
+                    joint[interval][query1, query2] += score1 * score2
+
+        return totals, joint
 
     @cached
-    def get_scores(self):
-        return tuple(self._get_scores())
+    def get_cooccurrences(self):
+        """
+        @return: (totals, joint), where totals[interval][query] is the (weighted) number of articles
+                 matching query, and joint[interval][query1, query2] the (weighted) number of
+                 articles matching both.
+        """
+        if self.weighted:
+            return self._get_weighted_cooccurrences()
+        return self._get_aggregated_cooccurrences()
 
     @cached
     def get_intervals(self):
-        return sorted(set(s.interval for s in self.get_scores()))
+        totals, _ = self.get_cooccurrences()
+        return sorted(totals)
 
     @cached
     def get_queries(self):
@@ -164,13 +223,11 @@ class Association(object):
         """
         @return: [ArticleAssociation]
         """
-        probs = defaultdict(partial(defaultdict, dict))
-        for aid, query, interval, score in self.get_scores():
-            probs[interval][query][aid] = score
+        totals, joint = self.get_cooccurrences()
 
-        for interval, queries in probs.items():
+        for interval, queries in totals.items():
             for query1, query2 in product(queries, queries):
-                sumprob1 = sum(queries[query1].values())
+                sumprob1 = queries[query1]
 
                 if query1 == query2:
                     yield ArticleAssociation(interval, 1.0, query1, query2)
@@ -180,12 +237,7 @@ class Association(object):
                     yield ArticleAssociation(interval, "-", query1, query2)
                     continue
 
-                sumprob2 = 0
-                for aid, p1 in queries[query1].items():
-                    try:
-                        sumprob2 += p1 * queries[query2][aid]
-                    except KeyError:
-                        continue
+                sumprob2 = joint[interval].get((query1, query2), 0)
 
                 #                                  probability          of      given
                 yield ArticleAssociation(interval, sumprob2 / sumprob1, query1, query2)
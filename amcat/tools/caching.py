@@ -32,12 +32,16 @@ Use reset and set_cache to manually clear and set the cache
 import logging
 
 log = logging.getLogger(__name__)
+from collections import OrderedDict
 from functools import wraps, partial
 
 from django.conf import settings
 
 SIMPLE_CACHE_SECONDS = getattr(settings, 'SIMPLE_CACHE_SECONDS', 2592000)
 
+# Maximum number of objects per model kept by get_object
+OBJECT_CACHE_SIZE = getattr(settings, 'OBJECT_CACHE_SIZE', 1000)
+
 
 ###########################################################################
 #                       M E T H O D   C A C H I N G                       #
@@ -124,6 +128,31 @@ def set_cache(obj, name, value, cache_attr=""):
 #                       O B J E C T   C A C H I N G                       #
 ###########################################################################
 
+class LRUCache(OrderedDict):
+    """Dictionary holding at most max_size items. If full, the least recently
+    used (read or written) item is evicted. Not thread-safe."""
+    def __init__(self, max_size):
+        super(LRUCache, self).__init__()
+        self.max_size = max_size
+
+    def __getitem__(self, key):
+        value = super(LRUCache, self).__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        super(LRUCache, self).__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.max_size:
+            self.popitem(last=False)
+
+
 # Setup thread-local cache for codebooks
 import threading
 
@@ -135,7 +164,7 @@ def _get_object_cache(model):
     try:
         return getattr(_object_cache, key)
     except AttributeError:
-        cache = {}
+        cache = LRUCache(OBJECT_CACHE_SIZE)
         setattr(_object_cache, key, cache)
         return cache
 
@@ -173,7 +202,7 @@ def get_objects(model, pks):
 def clear_cache(model):
     """Clear the local codebook cache manually, ie in between test runs"""
     key = CACHE_PREFIX + model.__name__
-    setattr(_object_cache, key, {})
+    setattr(_object_cache, key, LRUCache(OBJECT_CACHE_SIZE))
 
 
 ###########################################################################
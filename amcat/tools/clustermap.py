@@ -28,7 +28,7 @@ visualisation software such as:
 import os
 import subprocess
 
-from collections import defaultdict, OrderedDict
+from collections import defaultdict
 from itertools import chain
 from tempfile import NamedTemporaryFile
 
@@ -59,19 +59,26 @@ ADUNA_MEMORY = "1000m"
 HTML_TEMPLATE = get_template("query/clustermap/clustermap.html")
 
 ### CLUSTER LOGIC ###
-def combinations(iterable):
+def get_cluster_masks(queries, order) -> dict:
     """
-    Returns a generator yielding all combinations of all lengths of `iterable` as tuples.
-    Care should be taken, as there are 2^n of these combinations.
+    Represent the cluster of each article as a bitmask, in which bit i is set if the
+    article matched order[i]. Time and memory are linear in the number of hits, rather
+    than exponential in the number of queries.
+
+    @param queries: mapping {query: ids}
+    @param order: sequence of all queries in queries, determining the bit of each query
+    @returns: mapping of bitmask to a set of article ids
     """
-    all = tuple(iterable)
-    if len(all) == 0:
-        yield ()
-        return
-    head, tail = all[0], all[1:]
-    for result in combinations(tail):
-        yield (head,) + result
-        yield result
+    masks = defaultdict(int)
+    for bit, query in enumerate(order):
+        for aid in queries[query]:
+            masks[aid] |= 1 << bit
+
+    clusters = defaultdict(set)
+    for aid, mask in masks.items():
+        clusters[mask].add(aid)
+    return clusters
+
 
 def get_clusters(queries) -> dict:
     """Based on a mapping {query: ids} determine a mapping {[query] -> [ids]}, thus
@@ -81,40 +88,26 @@ def get_clusters(queries) -> dict:
     @param queries.values(): List of ids
     @returns: mapping of cluster (frozenset of queries) to a set of article ids
     """
-    queries = {q: set(ids) for q, ids in queries.items()}
-
-    article_clusters = defaultdict(set)
-    for query, aids in queries.items():
-        for aid in aids:
-            article_clusters[aid].add(query)
-
-    clusters = defaultdict(set)
-    for aid, queries in article_clusters.items():
-        clusters[frozenset(queries)].add(aid)
-
-    return clusters
+    order = list(queries)
+    clusters = get_cluster_masks(queries, order)
+    return {
+        frozenset(q for bit, q in enumerate(order) if mask & (1 << bit)): aids
+        for mask, aids in clusters.items()
+    }
 
 
 def get_clustermap_table(queries):
     """
-    Given a mapping of query to ids, return a table with the #hits for each boolean combination
+    Given a mapping of query to ids, return a table with the #hits for each boolean combination.
+    Only non-empty combinations are returned.
     """
-    queries = OrderedDict((k, set(v)) for (k,v) in queries.items())
     header = sorted(queries.keys(), key=lambda q: str(q))
+    clusters = get_cluster_masks(queries, header)
+
     rows = []
-    allids = set(chain.from_iterable(queries.values()))
-    for c in combinations(header):
-        ids = allids.copy()
-        row = []
-        for q in header:
-            row.append(int(q in c))
-            if q in c:
-                ids &= queries[q]
-            else:
-                ids -= queries[q]
-        n = len(ids)
-        if n:
-            rows.append(tuple(row + [n]))
+    for mask in sorted(clusters, reverse=True):
+        row = [int(bool(mask & (1 << bit))) for bit in range(len(header))]
+        rows.append(tuple(row + [len(clusters[mask])]))
 
     return [h.label for h in header] + ["Total"], rows
 
@@ -0,0 +1,350 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+"""
+Process-wide cache of codebook trees.
+
+Codebook.cache() and cache_labels() build a Code object per code in the codebook, which is
+slow for large codebooks and repeated for every request. Code which only needs the hierarchy
+and labels can use CodebookCache().get(codebook_id) instead, which returns an immutable
+CodebookTree stored in arrays. Trees are kept in a (process-local) LRU cache and in Redis:
+
+ - {prefix}.version.{codebook_id}: version of the codebook, incremented on every change
+ - {prefix}.tree.{codebook_id}.{version}: pickled tree of the codebook at that version
+
+Changes to codebook codes, codes and labels increment the version (see the signal handlers
+in amcat.models.coding.codebook and amcat.models.coding.code). Bulk operations bypassing
+signals should call CodebookCache().invalidate(...) or invalidate_codes(...) themselves.
+"""
+import bisect
+import collections
+import datetime
+import logging
+import pickle
+import threading
+import time
+from array import array
+from functools import partial
+
+import django_redis
+from django import db
+from django.conf import settings
+from django.db import transaction
+from redis.exceptions import ConnectionError
+
+from amcat.tools.caching import LRUCache
+from amcat.tools.tree import HierarchyIndex
+
+log = logging.getLogger(__name__)
+
+# Number of trees kept in memory by each process
+CODEBOOK_CACHE_SIZE = getattr(settings, 'CODEBOOK_CACHE_SIZE', 32)
+
+# Seconds after which unused trees are removed from Redis
+MAX_AGE = 7 * 24 * 60 * 60
+
+# Represents None in integer arrays
+NULL = -2 ** 63
+ROOT = -1
+
+# Dates are stored as microseconds since EPOCH
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+_local_trees = LRUCache(CODEBOOK_CACHE_SIZE)
+_local_lock = threading.Lock()
+
+
+def _to_microseconds(date):
+    if date is None:
+        return NULL
+    if date.tzinfo is not None:
+        date = date.replace(tzinfo=None)
+    return (date - EPOCH) // MICROSECOND
+
+
+def _get_language_id(language):
+    return language if language is None or isinstance(language, int) else language.id
+
+
+class CodebookTree(object):
+    """
+    Immutable representation of the hierarchy and labels of a codebook.
+
+    Codes are numbered in order of their (first) codebook code. Each codebook code is a row
+    in the arrays codes, parents, hide, ordernr, validfrom and validto, in which codes and
+    parents are indices into code_ids (parents is ROOT for roots and for parents not in this
+    codebook). Labels are stored per language as a tuple ordered like code_ids.
+    """
+    def __init__(self, codebook_id, version, code_ids, codes, parents, hide, ordernr, validfrom, validto,
+                 default_labels, labels):
+        self.codebook_id = codebook_id
+        self.version = version
+        self.code_ids = code_ids
+        self.codes = codes
+        self.parents = parents
+        self.hide = hide
+        self.ordernr = ordernr
+        self.validfrom = validfrom
+        self.validto = validto
+        self.default_labels = default_labels
+        self.labels = labels
+        self._index = {code_id: i for i, code_id in enumerate(code_ids)}
+        self._validity_dates = sorted((set(validfrom) | set(validto)) - {NULL})
+        self._indices = {}
+
+    @classmethod
+    def from_db(cls, codebook_id, version=None):
+        from amcat.models import CodebookCode, Code, Label
+
+        ccodes = (CodebookCode.objects.filter(codebook_id=codebook_id).order_by("ordernr", "id")
+                  .values_list("code_id", "parent_id", "hide", "ordernr", "validfrom", "validto"))
+        ccodes = list(ccodes)
+
+        index = collections.OrderedDict()
+        for ccode in ccodes:
+            index.setdefault(ccode[0], len(index))
+
+        code_ids = array("q", index.keys())
+        codes, parents, ordernr = array("l"), array("l"), array("l")
+        validfrom, validto, hide = array("q"), array("q"), bytearray()
+        for code_id, parent_id, hidden, nr, vfrom, vto in ccodes:
+            codes.append(index[code_id])
+            parents.append(index.get(parent_id, ROOT))
+            hide.append(hidden)
+            ordernr.append(nr)
+            validfrom.append(_to_microseconds(vfrom))
+            validto.append(_to_microseconds(vto))
+
+        default_labels = [None] * len(code_ids)
+        codes_in_codebook = Code.objects.filter(codebook_codes__codebook_id=codebook_id)
+        for code_id, label in codes_in_codebook.values_list("id", "label"):
+            default_labels[index[code_id]] = label
+
+        labels = collections.defaultdict(lambda: [None] * len(code_ids))
+        labels_in_codebook = Label.objects.filter(code__codebook_codes__codebook_id=codebook_id).order_by()
+        for code_id, language_id, label in labels_in_codebook.values_list("code_id", "language_id", "label"):
+            labels[language_id][index[code_id]] = label
+
+        return cls(codebook_id, version, code_ids, codes, parents, bytes(hide), ordernr, validfrom, validto,
+                   tuple(default_labels), {lang: tuple(lbls) for lang, lbls in labels.items()})
+
+    def __len__(self):
+        return len(self.code_ids)
+
+    def __contains__(self, code_id):
+        return code_id in self._index
+
+    def get_label(self, code_id, language=None):
+        """
+        Return the label of the given code in the given language, or the label of the code
+        itself (Code.label) if language is None.
+
+        @return: a string, or None if the code has no label in that language
+        @raises KeyError: if code is not in this codebook
+        """
+        i = self._index[code_id]
+        language = _get_language_id(language)
+        if language is None:
+            return self.default_labels[i]
+        labels = self.labels.get(language)
+        return None if labels is None else labels[i]
+
+    def get_language_ids(self):
+        return set(self.labels)
+
+    def get_code_ids(self, include_hidden=False):
+        """Returns the ids of the codes in this codebook, see Codebook.get_code_ids"""
+        if include_hidden:
+            return list(self.code_ids)
+        visible = {self.codes[row] for row in range(len(self.codes)) if not self.hide[row]}
+        return [self.code_ids[i] for i in sorted(visible)]
+
+    def _get_rows(self, date=None, include_hidden=False):
+        """Yield the rows valid on the given date (default: now)"""
+        date = _to_microseconds(datetime.datetime.now() if date is None else date)
+        for row in range(len(self.codes)):
+            if self.validfrom[row] != NULL and date < self.validfrom[row]:
+                continue
+            if self.validto[row] != NULL and date >= self.validto[row]:
+                continue
+            if include_hidden or not self.hide[row]:
+                yield row
+
+    def get_hierarchy_ids(self, date=None, include_hidden=False):
+        """Returns an ordered {code_id: parent_id} mapping, see Codebook._get_hierarchy_ids"""
+        result = collections.OrderedDict()
+        for row in self._get_rows(date, include_hidden):
+            parent = self.parents[row]
+            result[self.code_ids[self.codes[row]]] = None if parent == ROOT else self.code_ids[parent]
+        return result
+
+    def get_index(self, date=None, include_hidden=False):
+        """
+        Returns a HierarchyIndex of the hierarchy on the given date. Indices are kept on
+        this tree; as the hierarchy only changes when the date passes a validfrom or validto
+        of a codebook code, they are keyed by the number of those dates before date.
+
+        @rtype: amcat.tools.tree.HierarchyIndex
+        """
+        if date is None:
+            date = datetime.datetime.now()
+        key = (include_hidden, bisect.bisect_right(self._validity_dates, _to_microseconds(date)))
+        try:
+            return self._indices[key]
+        except KeyError:
+            index = HierarchyIndex(self.get_hierarchy_ids(date, include_hidden))
+            self._indices[key] = index
+            return index
+
+    def get_root_ids(self, date=None, include_hidden=False):
+        """Returns the ids of the roots of the hierarchy, ordered as in Codebook.get_roots"""
+        return self.get_index(date, include_hidden).get_root_ids()
+
+    def get_descendant_ids(self, code_id, date=None, include_hidden=True):
+        """
+        Returns the id of the given code and those of its descendants (depth first, in the
+        order of Codebook.get_tree).
+
+        @raises KeyError: if code_id is not in the hierarchy
+        @raises ValueError: if code_id is part of a cycle
+        """
+        return self.get_index(date, include_hidden).get_subtree_ids(code_id)
+
+    def get_ancestor_ids(self, code_id, date=None):
+        """
+        Yield the ids of the given code and its ancestors, up to a root of the codebook.
+        Like Codebook.get_ancestor_ids, hidden codes are not part of the hierarchy.
+
+        @raises KeyError: if code_id is not in the hierarchy
+        @raises ValueError: if code_id is part of a cycle
+        """
+        return self.get_index(date).get_ancestor_ids(code_id)
+
+    def get_aggregation_mapping(self, language=None):
+        """Returns a mapping from the label of each child of a root to the label of that root,
+        see Codebook.get_aggregation_mapping"""
+        index = self.get_index(include_hidden=True)
+        return {self.get_label(code_id, language): self.get_label(index.get_parent_id(code_id), language)
+                for code_id, depth in zip(index.ids, index.depths) if depth == 1}
+
+    def to_bytes(self):
+        state = {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
+        return pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def from_bytes(cls, bytes):
+        return cls(**pickle.loads(bytes))
+
+
+def _get_prefix():
+    db_name = db.connections.databases['default']['NAME']
+    return "{}.codebook-cache".format(db_name)
+
+
+class CodebookCache(object):
+    def __init__(self):
+        self.prefix = _get_prefix()
+
+    @property
+    def redis(self):
+        return django_redis.get_redis_connection()  # type: redis.client.StrictRedis
+
+    def _key(self, *parts):
+        return ".".join(map(str, (self.prefix,) + parts))
+
+    def _get_version(self, codebook_id):
+        key = self._key("version", codebook_id)
+        version = self.redis.get(key)
+        if version is None:
+            # Start at the current time, so versions are not reused if Redis lost the counter
+            self.redis.setnx(key, int(time.time() * 1000))
+            version = self.redis.get(key)
+        return int(version)
+
+    def get(self, codebook_id):
+        """
+        Get the tree of the given codebook, from memory, Redis or (if neither has its
+        current version) the database.
+
+        @type codebook_id: int
+        @rtype: CodebookTree
+        """
+        codebook_id = int(codebook_id)
+        try:
+            version = self._get_version(codebook_id)
+        except ConnectionError:
+            log.exception("Could not get version of codebook {}".format(codebook_id))
+            return CodebookTree.from_db(codebook_id)
+
+        local_key = (self.prefix, codebook_id, version)
+        with _local_lock:
+            tree = _local_trees.get(local_key)
+        if tree is not None:
+            return tree
+
+        key = self._key("tree", codebook_id, version)
+        try:
+            value = self.redis.get(key)
+        except ConnectionError:
+            log.exception("Could not get tree of codebook {}".format(codebook_id))
+            value = None
+
+        if value is not None:
+            tree = CodebookTree.from_bytes(value)
+        else:
+            log.info("Building tree of codebook {} (version {})".format(codebook_id, version))
+            tree = CodebookTree.from_db(codebook_id, version)
+            try:
+                self.redis.set(key, tree.to_bytes(), ex=MAX_AGE)
+            except ConnectionError:
+                log.exception("Could not store tree of codebook {}".format(codebook_id))
+
+        with _local_lock:
+            _local_trees[local_key] = tree
+        return tree
+
+    def invalidate(self, codebook_ids):
+        """
+        Increment the version of the given codebooks. The version is incremented again after
+        the current transaction commits, as other processes might have stored a tree built
+        from the data before the commit under the first new version.
+        """
+        codebook_ids = sorted(set(map(int, codebook_ids)))
+        if codebook_ids:
+            self._increment(codebook_ids)
+            transaction.on_commit(partial(self._increment, codebook_ids))
+
+    def invalidate_codes(self, code_ids):
+        """Invalidate all codebooks containing any of the given codes"""
+        from amcat.models import CodebookCode
+        code_ids = list(map(int, code_ids))
+        if code_ids:
+            ccodes = CodebookCode.objects.filter(code_id__in=code_ids).order_by()
+            self.invalidate(ccodes.values_list("codebook_id", flat=True).distinct())
+
+    def _increment(self, codebook_ids):
+        try:
+            pipe = self.redis.pipeline()
+            for codebook_id in codebook_ids:
+                key = self._key("version", codebook_id)
+                pipe.setnx(key, int(time.time() * 1000))
+                pipe.incr(key)
+            pipe.execute()
+        except ConnectionError:
+            log.exception("Could not invalidate codebooks {}".format(codebook_ids))
@@ -0,0 +1,363 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+"""
+Columnar cache of the coding values of codingjobs.
+
+Aggregating and exporting codings requires joining codings_values, codings, coded_articles
+and articles. Instead of repeating this join for every request, the result is kept per
+codingjob in Redis, stored column-wise in arrays:
+
+ - {prefix}.{codingjob_id}: hash with the version of the job the columns were built for and,
+   for each coded article, its (pickled) columns
+ - {prefix}.{codingjob_id}.version: version counter of the codings of the job
+
+Stored columns are current if their version equals the version counter, which is a single
+Redis lookup. CodedArticle.replace_codings and update_codings update the columns of a coded
+article after they commit, incrementing both versions. Other writes to codings should call
+codings_changed, which increments the counter, so the job is rebuilt lazily.
+"""
+import collections
+import datetime
+import functools
+import itertools
+import logging
+import pickle
+from array import array
+
+import django_redis
+from django import db
+from django.db import connection, transaction
+from redis.exceptions import ConnectionError, WatchError
+
+log = logging.getLogger(__name__)
+
+COLUMNS = ("coded_article", "article", "sentence", "coding", "start", "end",
+           "codingvalue", "field", "intval", "strval", "date")
+
+# Represents None in integer columns
+NULL = -2 ** 63
+
+# Dates are stored as microseconds since EPOCH
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+# Seconds after which unused jobs are removed from Redis
+MAX_AGE = 7 * 24 * 60 * 60
+
+Row = collections.namedtuple("Row", COLUMNS)
+
+ROWS_SQL = """
+SELECT c.coded_article_id, ca.article_id, c.sentence_id, c.coding_id, c.start, c."end",
+       cv.codingvalue_id, cv.field_id, cv.intval, cv.strval, a.date
+FROM codings c
+INNER JOIN coded_articles ca ON ca.id = c.coded_article_id
+INNER JOIN articles a ON a.article_id = ca.article_id
+LEFT JOIN codings_values cv ON cv.coding_id = c.coding_id
+WHERE {where}
+ORDER BY c.coded_article_id, c.coding_id, cv.codingvalue_id
+"""
+
+
+class CodingColumns(object):
+    """
+    Coding values stored column-wise. Each row represents a coding value, or a coding without
+    values (in which case codingvalue, field, intval and strval are None). Rows are ordered by
+    coded article, coding and coding value.
+    """
+    def __init__(self, columns=None):
+        if columns is None:
+            columns = {column: array("q") for column in COLUMNS}
+            columns["strval"] = []
+        self.columns = columns
+        self._index = None
+
+    def __len__(self):
+        return len(self.columns["coding"])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def append(self, row):
+        """Append a row of (database) values, ordered as COLUMNS"""
+        for column, value in zip(COLUMNS, row):
+            if column == "strval":
+                pass
+            elif value is None:
+                value = NULL
+            elif column == "date":
+                value = (value - EPOCH) // MICROSECOND
+            self.columns[column].append(value)
+
+    def extend(self, other):
+        for column in COLUMNS:
+            self.columns[column].extend(other.columns[column])
+        self._index = None
+
+    @classmethod
+    def concatenate(cls, columns):
+        result = cls()
+        for c in columns:
+            result.extend(c)
+        return result
+
+    def __iter__(self):
+        columns = [self.columns[c] for c in COLUMNS]
+        for values in zip(*columns):
+            yield Row(*(_to_python(c, v) for c, v in zip(COLUMNS, values)))
+
+    def filter(self, coded_article_ids):
+        """Return the rows of the given coded articles as a new CodingColumns object"""
+        result = type(self)()
+        index = self._get_index()
+        for ca_id in sorted(set(coded_article_ids) & index.keys()):
+            start, end = index[ca_id]
+            for column in COLUMNS:
+                result.columns[column].extend(self.columns[column][start:end])
+        return result
+
+    def get_coded_article_ids(self, article_ids=None, field_id=None, intvals=None):
+        """Returns the ids of coded articles having a row matching all given criteria"""
+        if article_ids is None and field_id is None and intvals is None:
+            return set(self._get_index())
+
+        rows = zip(*(self.columns[c] for c in ("coded_article", "article", "field", "intval")))
+        return {ca_id for ca_id, article_id, fid, intval in rows
+                if (article_ids is None or article_id in article_ids)
+                and (field_id is None or fid == field_id)
+                and (intvals is None or intval in intvals)}
+
+    def _get_index(self):
+        """Returns {coded_article_id: (start, end)}"""
+        if self._index is None:
+            self._index = {}
+            for i, ca_id in enumerate(self.columns["coded_article"]):
+                start, _ = self._index.get(ca_id, (i, None))
+                self._index[ca_id] = (start, i + 1)
+        return self._index
+
+    def get_codings(self):
+        """
+        Yield Coding objects for these rows, with their values prefetched, as if
+        they were fetched using Coding.objects.prefetch_related("values").
+        """
+        from amcat.models import Coding, CodingValue
+
+        coding, values = None, []
+        for row in itertools.chain(self, [None]):
+            if coding is not None and (row is None or row.coding != coding.id):
+                _set_prefetched_values(coding, values)
+                yield coding
+                coding, values = None, []
+            if row is None:
+                break
+            if coding is None:
+                coding = Coding(id=row.coding, coded_article_id=row.coded_article, sentence_id=row.sentence,
+                                start=row.start, end=row.end)
+            if row.codingvalue is not None:
+                values.append(CodingValue(id=row.codingvalue, coding_id=row.coding, field_id=row.field,
+                                          intval=row.intval, strval=row.strval))
+
+    def to_bytes(self):
+        return pickle.dumps(self.columns, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def from_bytes(cls, bytes):
+        return cls(pickle.loads(bytes))
+
+
+def _to_python(column, value):
+    if column == "strval" or value is None:
+        return value
+    if value == NULL:
+        return None
+    if column == "date":
+        return EPOCH + value * MICROSECOND
+    return value
+
+
+def _set_prefetched_values(coding, values):
+    # Mimic prefetch_related, so coding.values.all() does not hit the database
+    queryset = coding.values.all()
+    queryset._result_cache = values
+    queryset._prefetch_done = True
+    coding._prefetched_objects_cache = {"values": queryset}
+
+
+def _get_prefix():
+    db_name = db.connections.databases['default']['NAME']
+    return "{}.coding-columns".format(db_name)
+
+
+class CodingColumnCache(object):
+    def __init__(self):
+        self.prefix = _get_prefix()
+
+    @property
+    def redis(self):
+        return django_redis.get_redis_connection()  # type: redis.client.StrictRedis
+
+    def _key(self, codingjob_id):
+        return "{}.{}".format(self.prefix, codingjob_id)
+
+    def _version_key(self, codingjob_id):
+        return "{}.{}.version".format(self.prefix, codingjob_id)
+
+    def _get_versions(self, codingjob_ids):
+        pipe = self.redis.pipeline()
+        for codingjob_id in codingjob_ids:
+            pipe.get(self._version_key(codingjob_id))
+        return {cj: int(v or 0) for cj, v in zip(codingjob_ids, pipe.execute())}
+
+    def _get_rows(self, where, params):
+        """Returns an ordered dict {coded_article_id: CodingColumns}"""
+        result = collections.OrderedDict()
+        with connection.cursor() as cursor:
+            cursor.execute(ROWS_SQL.format(where=where), params)
+            for row in cursor.fetchall():
+                if row[0] not in result:
+                    result[row[0]] = CodingColumns()
+                result[row[0]].append(row)
+        return result
+
+    def get(self, codingjob_ids):
+        """
+        Get the columns of the given codingjobs, building (and storing) them if needed.
+
+        @param codingjob_ids: sequence of ints
+        @return: {codingjob_id: CodingColumns}
+        """
+        codingjob_ids = list(set(map(int, codingjob_ids)))
+        versions = self._get_versions(codingjob_ids)
+
+        result = {}
+        for codingjob_id in codingjob_ids:
+            key = self._key(codingjob_id)
+            entries = self.redis.hgetall(key)
+            stored = entries.pop(b"version", None)
+            if stored is not None and int(stored) == versions[codingjob_id]:
+                self.redis.expire(key, MAX_AGE)
+                entries = sorted((int(ca_id), value) for ca_id, value in entries.items())
+                result[codingjob_id] = CodingColumns.concatenate(CodingColumns.from_bytes(v) for _, v in entries)
+            else:
+                result[codingjob_id] = self._build(codingjob_id, versions[codingjob_id])
+        return result
+
+    def get_coded_articles(self, codingjob_id, coded_article_ids):
+        """
+        Get the columns of some coded articles of a codingjob. They are read from the stored
+        columns if these are current, or from the database otherwise. Unlike get, this never
+        builds the complete job, so memory usage only depends on the number of coded articles.
+
+        @return: CodingColumns, ordered by coded article
+        """
+        coded_article_ids = sorted(set(map(int, coded_article_ids)))
+        if not coded_article_ids:
+            return CodingColumns()
+
+        pipe = self.redis.pipeline()
+        pipe.get(self._version_key(codingjob_id))
+        pipe.hmget(self._key(codingjob_id), ["version"] + [str(ca_id) for ca_id in coded_article_ids])
+        version, (stored, *values) = pipe.execute()
+
+        if stored is not None and int(stored) == int(version or 0):
+            return CodingColumns.concatenate(CodingColumns.from_bytes(v) for v in values if v is not None)
+
+        rows = self._get_rows("c.coded_article_id = ANY(%s)", [coded_article_ids])
+        return CodingColumns.concatenate(rows.values())
+
+    def _build(self, codingjob_id, version):
+        """Build and store the columns of the given codingjob. The version should be determined
+        before calling this, so changes made while building are detected on the next read."""
+        log.info("Building coding columns of codingjob {}".format(codingjob_id))
+        rows = self._get_rows("ca.codingjob_id = %s", [codingjob_id])
+
+        key = self._key(codingjob_id)
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
+        if rows:
+            pipe.hmset(key, {str(ca_id): columns.to_bytes() for ca_id, columns in rows.items()})
+        pipe.hset(key, "version", version)
+        pipe.expire(key, MAX_AGE)
+        pipe.execute()
+
+        return CodingColumns.concatenate(rows.values())
+
+    def invalidate(self, codingjob_ids):
+        """Increment the version counters of the given codingjobs, so they are rebuilt when needed"""
+        try:
+            pipe = self.redis.pipeline()
+            for codingjob_id in codingjob_ids:
+                pipe.incr(self._version_key(codingjob_id))
+            pipe.execute()
+        except ConnectionError:
+            log.exception("Could not invalidate coding columns of {}".format(codingjob_ids))
+
+    def update(self, coded_article):
+        """
+        Update the columns of the given coded article, if its codingjob is stored. This should
+        be called after the codings of the coded article are committed.
+        """
+        try:
+            self._update(coded_article)
+        except ConnectionError:
+            log.exception("Could not update coding columns of {}".format(coded_article))
+
+    def _update(self, coded_article):
+        key, field = self._key(coded_article.codingjob_id), str(coded_article.id)
+        version_key = self._version_key(coded_article.codingjob_id)
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key, version_key)
+                    stored = pipe.hget(key, "version")
+                    version = int(pipe.get(version_key) or 0)
+                    if stored is None or int(stored) != version:
+                        # Job not stored or stale. It will be built when needed, but columns being
+                        # built right now might not include these codings.
+                        pipe.multi()
+                        pipe.incr(version_key)
+                        pipe.execute()
+                        return
+
+                    # Read the codings while watching, so a concurrent update stored in between
+                    # aborts this one and we retry with the latest codings
+                    columns = self._get_rows("c.coded_article_id = %s", [coded_article.id])
+                    columns = columns.get(coded_article.id, CodingColumns())
+
+                    pipe.multi()
+                    pipe.hset(key, field, columns.to_bytes())
+                    pipe.hset(key, "version", version + 1)
+                    pipe.incr(version_key)
+                    pipe.execute()
+                    return
+                except WatchError:
+                    continue
+
+
+def codings_changed(codingjob_ids):
+    """
+    Invalidate the stored columns of the given codingjobs. This should be called when codings
+    are changed other than through CodedArticle.replace_codings or update_codings. Columns are
+    invalidated both now and after the current transaction commits, so columns built from the
+    database in between are not considered current.
+    """
+    codingjob_ids = list(codingjob_ids)
+    cache = CodingColumnCache()
+    cache.invalidate(codingjob_ids)
+    transaction.on_commit(functools.partial(cache.invalidate, codingjob_ids))
@@ -0,0 +1,380 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+"""
+Memory-bounded detection of (near) duplicate articles.
+
+Each article is reduced to one or more fixed-width keys, which are sorted together with the
+article id using an external sort: sorted runs are spilled to disk when the buffer is full,
+and merged afterwards. Articles sharing a key are duplicate candidates.
+
+ - Exact mode: the key is a digest of the compared fields (or the article hash)
+ - Near mode: the key is a digest of a band of the MinHash signature of the title and text
+   (locality sensitive hashing). Articles sharing any band are candidates, which are only
+   grouped if the similarity estimated from their signatures (stored on disk, see
+   SignatureStore) is at least the threshold. Bands are chosen to favour recall, so articles
+   with a (word shingle) Jaccard similarity above the threshold are very likely found.
+
+Articles are scanned from elastic in slices on a thread pool, keys are computed on a pool of
+processes (see amcates_bulk.bounded_imap).
+"""
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import multiprocessing
+import random
+import re
+import struct
+import tempfile
+from array import array
+from multiprocessing.pool import Pool, ThreadPool
+
+from amcat.tools import amcates
+from amcat.tools.amcates_bulk import bounded_imap
+from amcat.tools.progress import NullMonitor
+from amcat.tools.toolkit import splitlist
+
+log = logging.getLogger(__name__)
+
+FIELDS = ["text", "title", "date", "creator", "medium", "byline", "section", "page", "addressee", "length"]
+NEAR_FIELDS = ["title", "text"]
+
+# Records are (md5 sized key, article id) pairs, which sort as (key, id) when sorted as bytes
+KEY_WIDTH = 16
+RECORD = struct.Struct(">{}sQ".format(KEY_WIDTH))
+
+# Number of records kept in memory before a sorted run is spilled to disk
+DEFAULT_MAX_RECORDS = 1000000
+
+# Number of articles scanned from elastic per slice
+DEFAULT_SLICE_SIZE = 10000
+
+MERSENNE_PRIME = (1 << 61) - 1
+
+# Weights of false positives and false negatives when choosing LSH bands. Candidates are
+# checked against the threshold, so false positives only cost time.
+FALSE_POSITIVE_WEIGHT = 0.05
+FALSE_NEGATIVE_WEIGHT = 0.95
+WORD_RE = re.compile(r"\w+")
+
+
+class ExternalSorter(object):
+    """
+    Sort (key, id) records using bounded memory. Keys should be KEY_WIDTH bytes.
+    """
+    def __init__(self, max_records=DEFAULT_MAX_RECORDS, directory=None):
+        self.max_records = max_records
+        self.directory = directory
+        self._buffer = []
+        self._runs = []
+
+    def add(self, key, id):
+        self._buffer.append(RECORD.pack(key, id))
+        if len(self._buffer) >= self.max_records:
+            self._spill()
+
+    def _spill(self):
+        self._buffer.sort()
+        run = tempfile.TemporaryFile(dir=self.directory)
+        run.write(b"".join(self._buffer))
+        self._runs.append(run)
+        self._buffer = []
+
+    def _read_run(self, run, records_per_read=4096):
+        run.seek(0)
+        while True:
+            data = run.read(RECORD.size * records_per_read)
+            if not data:
+                break
+            for offset in range(0, len(data), RECORD.size):
+                yield data[offset:offset + RECORD.size]
+
+    def __iter__(self):
+        """Yield all (key, id) records, sorted"""
+        self._buffer.sort()
+        runs = [self._read_run(run) for run in self._runs]
+        for record in heapq.merge(self._buffer, *runs):
+            yield RECORD.unpack(record)
+
+    def get_groups(self):
+        """Yield the (sorted) lists of ids sharing a key, for keys shared by more than one id"""
+        for _, records in itertools.groupby(self, key=lambda record: record[0]):
+            ids = [id for _, id in records]
+            if len(ids) > 1:
+                yield ids
+
+    def close(self):
+        for run in self._runs:
+            run.close()
+        self._runs = []
+        self._buffer = []
+
+
+class SignatureStore(object):
+    """
+    Fixed-width MinHash signatures, written to a temporary file. Signatures are referred to
+    by their position, the order in which they were added.
+    """
+    def __init__(self, num_perm, directory=None):
+        self.record = struct.Struct(">{}Q".format(num_perm))
+        self.ids = array("Q")
+        self._file = tempfile.TemporaryFile(dir=directory)
+
+    def add(self, id, signature):
+        """Add a (packed) signature, and return its position"""
+        self.ids.append(id)
+        self._file.write(signature)
+        return len(self.ids) - 1
+
+    def get(self, position):
+        self._file.seek(position * self.record.size)
+        return self.record.unpack(self._file.read(self.record.size))
+
+    def close(self):
+        self._file.close()
+        self.ids = array("Q")
+
+
+def get_similarity(signature, other):
+    """Estimate the Jaccard similarity of two MinHash signatures"""
+    return sum(a == b for a, b in zip(signature, other)) / len(signature)
+
+
+def get_similar_pairs(positions, signatures, threshold):
+    """
+    Yield [position, position] pairs of the given candidates (sharing a band) whose estimated
+    similarity is at least the threshold. Candidates already known to be similar, directly or
+    through other candidates, are not compared again.
+
+    @type signatures: SignatureStore
+    """
+    signature = {position: signatures.get(position) for position in positions}
+    clusters = []
+    for position in positions:
+        similar, other = [position], []
+        for cluster in clusters:
+            match = next((p for p in cluster if get_similarity(signature[position], signature[p]) >= threshold), None)
+            if match is None:
+                other.append(cluster)
+            else:
+                yield [position, match]
+                similar.extend(cluster)
+        clusters = other + [similar]
+
+
+def get_lsh_parameters(threshold, num_perm, false_positive_weight=0.5, false_negative_weight=0.5):
+    """
+    Determine the number of bands and rows per band minimizing the weighted probability of
+    false positives and false negatives for the given similarity threshold.
+
+    @return: a (bands, rows) tuple
+    """
+    def integrate(f, a, b, steps=100):
+        width = (b - a) / steps
+        return sum(f(a + (i + 0.5) * width) for i in range(steps)) * width
+
+    best, best_error = None, None
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // bands + 1):
+            candidate = lambda s: 1 - (1 - s ** rows) ** bands
+            fp = integrate(candidate, 0.0, threshold)
+            fn = integrate(lambda s: 1 - candidate(s), threshold, 1.0)
+            error = fp * false_positive_weight + fn * false_negative_weight
+            if best_error is None or error < best_error:
+                best, best_error = (bands, rows), error
+    return best
+
+
+def _hash(data):
+    return int.from_bytes(hashlib.md5(data).digest()[:8], "big")
+
+
+class MinHasher(object):
+    """Compute MinHash signatures of the word shingles of texts"""
+    def __init__(self, num_perm=128, shingle_size=5, seed=1):
+        rnd = random.Random(seed)
+        self.permutations = [(rnd.randrange(1, MERSENNE_PRIME), rnd.randrange(0, MERSENNE_PRIME))
+                             for _ in range(num_perm)]
+        self.shingle_size = shingle_size
+
+    def get_shingles(self, text):
+        """Returns the set of hashed word n-grams of the (lowercased) text"""
+        words = WORD_RE.findall(text.lower())
+        n = min(self.shingle_size, len(words))
+        return {_hash(" ".join(words[i:i + n]).encode()) for i in range(len(words) - n + 1)} if n else set()
+
+    def get_signature(self, text):
+        """Returns the signature as a list of ints, or None if the text contains no words"""
+        shingles = self.get_shingles(text)
+        if not shingles:
+            return None
+        return [min((a * h + b) % MERSENNE_PRIME for h in shingles) for a, b in self.permutations]
+
+
+def get_band_keys(signature, bands, rows):
+    """Returns a key for each band of the signature"""
+    band = struct.Struct(">H{}Q".format(rows))
+    return [hashlib.md5(band.pack(i, *signature[i * rows:(i + 1) * rows])).digest() for i in range(bands)]
+
+
+def _get_value(fields, field):
+    value = fields.get(field)
+    return value[0] if value is not None else value
+
+
+def get_exact_keys(fields, hits):
+    """Returns (key, id) pairs for the given (id, fields) hits"""
+    if fields == ["hash"]:
+        return [(bytes.fromhex(_get_value(f, "hash"))[:KEY_WIDTH], id) for id, f in hits]
+
+    result = []
+    for id, f in hits:
+        d = {field: _get_value(f, field) for field in fields}
+        result.append((hashlib.md5(json.dumps(d, sort_keys=True, default=str).encode()).digest(), id))
+    return result
+
+
+def get_near_keys(hasher, bands, rows, hits):
+    """Returns (id, packed signature, band keys) triples for the given (id, fields) hits"""
+    record = struct.Struct(">{}Q".format(len(hasher.permutations)))
+    result = []
+    for id, f in hits:
+        text = "\n".join(_get_value(f, field) or "" for field in NEAR_FIELDS)
+        signature = hasher.get_signature(text)
+        if signature is not None:
+            result.append((id, record.pack(*signature), get_band_keys(signature, bands, rows)))
+    return result
+
+
+def merge_groups(groups):
+    """Merge overlapping groups of ids (using union-find), and yield the merged groups as sorted lists"""
+    parents = {}
+
+    def find(id):
+        root = id
+        while parents[root] != root:
+            root = parents[root]
+        while parents[id] != root:
+            parents[id], id = root, parents[id]
+        return root
+
+    for ids in groups:
+        for id in ids:
+            parents.setdefault(id, id)
+        root = find(ids[0])
+        for id in ids[1:]:
+            other = find(id)
+            if other != root:
+                root, other = min(root, other), max(root, other)
+                parents[other] = root
+
+    merged = {}
+    for id in parents:
+        merged.setdefault(find(id), []).append(id)
+    for ids in merged.values():
+        yield sorted(ids)
+
+
+class Deduplicator(object):
+    def __init__(self, fields=FIELDS, near=False, threshold=0.9, num_perm=128, shingle_size=5,
+                 slice_size=DEFAULT_SLICE_SIZE, threads=4, processes=None, max_records=DEFAULT_MAX_RECORDS):
+        """
+        @param fields: fields compared in exact mode. If all FIELDS are used, the article hash is compared.
+        @param near: find near duplicates (comparing title and text) instead of exact duplicates
+        @param threshold: (estimated) Jaccard similarity above which articles are near duplicates
+        @param num_perm: number of permutations of MinHash signatures
+        @param shingle_size: number of words per shingle
+        @param slice_size: number of articles scanned per elastic request
+        @param threads: number of concurrent scans
+        @param processes: number of processes computing keys. Defaults to the number of cpus in
+                          near mode, and to 0 (computing keys in the calling process) in exact mode.
+        @param max_records: number of keys kept in memory before spilling to disk
+        """
+        self.near = near
+        self.slice_size = slice_size
+        self.threads = threads
+        self.max_records = max_records
+        self.threshold = threshold
+        self.num_perm = num_perm
+
+        if near:
+            self.fields = NEAR_FIELDS
+            bands, rows = get_lsh_parameters(threshold, num_perm, FALSE_POSITIVE_WEIGHT, FALSE_NEGATIVE_WEIGHT)
+            self.get_keys = functools.partial(get_near_keys, MinHasher(num_perm, shingle_size), bands, rows)
+            self.processes = multiprocessing.cpu_count() if processes is None else processes
+        else:
+            self.fields = ["hash"] if set(fields) == set(FIELDS) else sorted(fields)
+            self.get_keys = functools.partial(get_exact_keys, self.fields)
+            self.processes = processes or 0
+
+    def _scan(self, article_ids):
+        query = {"query": {"constant_score": {"filter": amcates.build_filter(ids=article_ids)}}}
+        return [(int(hit["_id"]), hit.get("fields", {}))
+                for hit in amcates.ES().scan(query=query, fields=self.fields)]
+
+    def get_duplicates(self, article_ids, monitor=NullMonitor()):
+        """
+        Find duplicates amongst the given articles.
+
+        @param article_ids: sequence of ints
+        @return: a list of groups of duplicate articles, each a sorted list of ids
+        """
+        nslices = -(-len(article_ids) // self.slice_size)
+        monitor = monitor.submonitor(total=nslices + 1)
+        slices = splitlist(article_ids, itemsperbatch=self.slice_size)
+
+        sorter = ExternalSorter(max_records=self.max_records)
+        signatures = SignatureStore(self.num_perm) if self.near else None
+        threads = ThreadPool(self.threads)
+        pool = None
+        if self.processes and not multiprocessing.current_process().daemon:
+            pool = Pool(self.processes)
+
+        try:
+            hits = bounded_imap(threads, self._scan, slices, max_pending=2 * self.threads)
+            keys = bounded_imap(pool, self.get_keys, hits, max_pending=2 * (self.processes or 1))
+            for i, batch in enumerate(keys):
+                if self.near:
+                    # Sort band keys with the position of the signature, which is mapped to an id later
+                    for id, signature, band_keys in batch:
+                        position = signatures.add(id, signature)
+                        for key in band_keys:
+                            sorter.add(key, position)
+                else:
+                    for key, id in batch:
+                        sorter.add(key, id)
+                monitor.update(1, "Scanned slice {}/{}".format(i + 1, nslices))
+
+            monitor.update(1, "Grouping duplicates..")
+            groups = sorter.get_groups()
+            if not self.near:
+                return list(groups)
+
+            pairs = (pair for positions in groups for pair in get_similar_pairs(positions, signatures, self.threshold))
+            pairs = ([signatures.ids[p] for p in pair] for pair in pairs)
+            return list(merge_groups(pairs))
+        finally:
+            threads.terminate()
+            if pool is not None:
+                pool.terminate()
+            sorter.close()
+            if signatures is not None:
+                signatures.close()
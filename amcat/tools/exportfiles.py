@@ -0,0 +1,80 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+"""
+Files holding the results of (large) exports.
+
+Exports are written by celery workers and downloaded through the web server, so files are
+stored in settings.EXPORT_DIR, which should be shared between hosts running either. Files
+are referred to by name rather than path, so hosts may mount the directory in different
+places. Files older than settings.EXPORT_MAX_AGE are removed whenever a new file is created.
+"""
+import logging
+import os
+import tempfile
+import time
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+
+def _get_directory():
+    os.makedirs(settings.EXPORT_DIR, exist_ok=True)
+    return settings.EXPORT_DIR
+
+
+def create_export_file(prefix="export-", suffix=""):
+    """
+    Create an empty export file, removing expired ones
+
+    @return: (name, path) of the new file
+    """
+    remove_expired_files()
+    fd, path = tempfile.mkstemp(dir=_get_directory(), prefix=prefix, suffix=suffix)
+    os.close(fd)
+    return os.path.basename(path), path
+
+
+def get_export_path(name):
+    """
+    Returns the path of the export file with the given name
+
+    @raises FileNotFoundError: if the file does not exist (anymore)
+    """
+    if os.path.basename(name) != name:
+        raise ValueError("Invalid export file name: {name!r}".format(**locals()))
+    path = os.path.join(settings.EXPORT_DIR, name)
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    return path
+
+
+def remove_expired_files(max_age=None):
+    """Remove export files older than max_age seconds (defaults to settings.EXPORT_MAX_AGE)"""
+    max_age = settings.EXPORT_MAX_AGE if max_age is None else max_age
+    directory = _get_directory()
+    now = time.time()
+    for entry in os.scandir(directory):
+        try:
+            if entry.is_file() and now - entry.stat().st_mtime > max_age:
+                log.info("Removing expired export {}".format(entry.name))
+                os.remove(entry.path)
+        except FileNotFoundError:
+            # Removed concurrently
+            pass
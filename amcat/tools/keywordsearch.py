@@ -33,6 +33,7 @@ from amcat.models import Label, ArticleSet, CodingJob, Code
 from amcat.tools.aggregate_es import aggregate, TermCategory
 from amcat.tools.amcates import ES
 from amcat.tools.caching import cached
+from amcat.tools.codebookcache import CodebookCache
 from amcat.tools.toolkit import strip_accents
 from amcat.tools import queryparser
 
@@ -133,9 +134,6 @@ class SelectionSearch:
         label_lan = self.data.codebook_label_language
         replacement_lan = self.data.codebook_replacement_language
 
-        if codebook:
-            codebook.cache_labels()
-
         queries = map(str.strip, self.data.query.split("\n"))
         #filter empty lines
         queries = filter(lambda x: x, queries)
@@ -164,13 +162,20 @@ class SelectionSearch:
     def get_statistics(self):
         return self.es.statistics(self.get_query(), self.get_filters())
 
-    def get_aggregate(self, categories, flat=True, objects=True):
+    def get_aggregate(self, categories, flat=True, objects=True, dense=False):
+        """
+        @param dense: return a (sorted) DenseAggregation instead of a sorted list of rows
+        """
         # If we're aggregating on terms, we don't want a global filter
         query = None
         if not any(isinstance(c, TermCategory) for c in categories):
             query = self.get_query()
 
-        aggr = aggregate(query, self.get_filters(), categories, flat=flat, objects=objects)
+        if dense:
+            aggr = aggregate(query, self.get_filters(), categories, objects=objects, dense=True)
+            return aggr.sorted(key=to_sortable_tuple)
+
+        aggr = aggregate(query, self.get_filters(), categories, flat=flat, objects=objects, lazy=True)
         return sorted(aggr, key=to_sortable_tuple)
 
     def get_nested_aggregate(self, categories):
@@ -180,8 +185,10 @@ class SelectionSearch:
         return ES().query_ids(self.get_query(), self.get_filters())
 
     def _get_article_ids_per_query(self):
-        for q in self.get_queries():
-            yield q, list(ES().query_ids(q.query, self.get_filters()))
+        queries = self.get_queries()
+        article_ids = ES().multi_query_ids([q.query for q in queries], self.get_filters())
+        for q, ids in zip(queries, article_ids):
+            yield q, list(ids)
 
     def get_article_ids_per_query(self):
         return dict(self._get_article_ids_per_query())
@@ -298,26 +305,39 @@ def _clean(s):
     return s.strip()
 
 
-def _resolve_recursive(codebook, tree_item, rlanguage):
-    this = codebook.get_code(tree_item.code_id).get_label(rlanguage)
-
-    if this is not None:
-        yield this
+def _get_replacement(tree, code_id, recursive, rlanguage):
+    """
+    Return the label of the given code in the replacement language, or the labels of
+    the code and its descendants joined by OR if recursive.
 
-    for t in tree_item.children:
-        for child in _resolve_recursive(codebook, t, rlanguage):
-            yield child
+    @type tree: amcat.tools.codebookcache.CodebookTree
+    @raises Label.DoesNotExist: if any of these codes has no label in rlanguage
+    """
+    code_ids = tree.get_descendant_ids(code_id) if recursive else [code_id]
+    labels = [tree.get_label(c, rlanguage) for c in code_ids]
+    if None in labels:
+        raise Label.DoesNotExist()
+    return " OR ".join(labels)
 
 
 def resolve_reference(reference, recursive, queries, codebook=None, labels=None, rlanguage=None):
+    """
+    @type codebook: amcat.tools.codebookcache.CodebookTree
+    @param labels: {label: code_id} of the codes in codebook
+    """
     # Case 1: reference is numeric, so it refers to a Code
     if reference.isnumeric():
-        code = codebook.get_code(int(reference))
-        if recursive:
-            tree = codebook.get_tree(roots=[code])
-            tree = list(_resolve_recursive(codebook, tree[0], rlanguage))
-            return " OR ".join(tree)
-        return code.get_label(rlanguage)
+        if codebook is None or int(reference) not in codebook:
+            raise QueryValidationError(
+                "No code with id '{reference}' found in codebook".format(**locals()), code="invalid"
+            )
+        try:
+            return _get_replacement(codebook, int(reference), recursive, rlanguage)
+        except Label.DoesNotExist:
+            raise QueryValidationError(
+                "Code with id '{reference}' has no label in replacement-language."
+                .format(**locals()), code="invalid"
+            )
 
     # Case 2: reference refers to labeled subquery
     if reference in queries:
@@ -329,16 +349,8 @@ def resolve_reference(reference, recursive, queries, codebook=None, labels=None,
 
     # Case 3: reference refers to code in codebook, refered to by its label
     try:
-        log.debug("Finding {reference} in {rlanguage} in {labels}, rec={recursive}".format(**locals()))
-        code = labels[reference]
-
-        if recursive:
-            tree = codebook.get_tree(roots=[code])
-            log.warn("Tree: {tree}".format(**locals()))
-            tree = list(_resolve_recursive(codebook, tree[0], rlanguage))
-            return " OR ".join(tree)
-        else:
-            return code.get_label(rlanguage)
+        log.debug("Finding {reference} in {rlanguage}, rec={recursive}".format(**locals()))
+        return _get_replacement(codebook, labels[reference], recursive, rlanguage)
     except Label.DoesNotExist:
         raise QueryValidationError(
             "Code with label '{reference}' has no label in replacement-language."
@@ -346,7 +358,7 @@ def resolve_reference(reference, recursive, queries, codebook=None, labels=None,
         )
     except KeyError:
         raise QueryValidationError(
-            "No code with label '{reference}' found in {codebook}"
+            "No code with label '{reference}' found in codebook"
             .format(**locals()), code="invalid"
         )
     except TypeError as e:
@@ -383,13 +395,11 @@ def resolve_query(query, queries, codebook=None, labels=None, rlanguage=None):
 
     return query
 
-def try_get_label(code, label_language):
-    try:
-        return code.get_label(label_language)
-    except Label.DoesNotExist:
-        return None
-
 def resolve_queries(queries, codebook=None, label_language=None, replacement_language=None):
+    """
+    Resolve the references in the given queries, see resolve_query. The hierarchy and labels
+    of codebook are taken from the shared codebook cache (see amcat.tools.codebookcache).
+    """
     log.warn("Resolving queries {queries}, {codebook}:{label_language} -> {replacement_language}".format(**locals()))
 
     _queries = {}
@@ -409,7 +419,9 @@ def resolve_queries(queries, codebook=None, label_language=None, replacement_lan
     labels = None
 
     if codebook is not None:
-        labels = {label: c for label, c in ((try_get_label(c, label_language), c) for c in codebook.get_codes()) if label is not None}
+        codebook = CodebookCache().get(codebook.id)
+        labels = ((codebook.get_label(c, label_language), c) for c in codebook.get_code_ids())
+        labels = {label: c for label, c in labels if label is not None}
 
     for query in queries:
         yield resolve_query(query, _queries, codebook, labels, replacement_language)
@@ -18,6 +18,7 @@
 ###########################################################################
 
 import logging
+import time
 
 from typing import Optional
 
@@ -25,8 +26,17 @@ log = logging.getLogger(__name__)
 
 LOG_FORMAT = "[{name}{percent:0.1f}%] {self.message}"
 
+# Default maximum number of times per second listeners are notified of progress
+MAX_UPDATES_PER_SECOND = 2
+
+
 class ProgressMonitor(object):
-    def __init__(self, total=100, message="In progress", name=None, log=True):
+    def __init__(self, total=100, message="In progress", name=None, log=True, max_rate=MAX_UPDATES_PER_SECOND):
+        """
+        @param max_rate: maximum number of updates per second passed on to the log and listeners,
+                         or None to pass on all updates. Updates in between are coalesced: only
+                         the latest state is passed on. Completion is always passed on.
+        """
         self.total = total
         self.message = message
         self.worked = 0
@@ -35,6 +45,11 @@ class ProgressMonitor(object):
         self.name = name
         self.sub_monitors = set()
         self.progress = 0
+        self.interval = 1 / max_rate if max_rate else 0
+        # Sum of progress * weight of the sub monitors, maintained by the sub monitors
+        self._subprogress = 0
+        self._last_update = None
+        self._pending = False
 
     # Backwards compat.:
     @property
@@ -42,9 +57,7 @@ class ProgressMonitor(object):
         return self.progress * 100
 
     def get_progress(self):
-        my_progress = self.worked / self.total
-        subprogress = sum(s.progress * s.weight for s in self.sub_monitors) / self.total
-        return my_progress + subprogress
+        return (self.worked + self._subprogress) / self.total
 
     def update(self, units: int=1, message: Optional[str]=None):
         self.worked += units
@@ -53,13 +66,30 @@ class ProgressMonitor(object):
             self.message = message
         self.do_update()
 
-    def do_update(self):
+    def do_update(self, force=False):
+        """
+        Pass the current state on to the log and listeners, unless the previous update was
+        passed on less than self.interval seconds ago (and we are not done yet).
+        """
+        now = time.monotonic()
+        if not (force or self._last_update is None or now - self._last_update >= self.interval
+                or round(self.progress, 9) >= 1):
+            self._pending = True
+            return
+
+        self._pending = False
+        self._last_update = now
         if self.log:
             name = "{}: ".format(self.name) if self.name is not None else ""
             log.info(LOG_FORMAT.format(self=self, name=name, percent=self.progress*100))
         for listener in self.listeners:
             listener(self)
 
+    def flush(self):
+        """Pass on the latest state, if it was held back by do_update"""
+        if self._pending:
+            self.do_update(force=True)
+
     def add_listener(self, func):
         self.listeners.add(func)
 
@@ -76,10 +106,14 @@ class SubMonitor(ProgressMonitor):
     def __init__(self, super_monitor, weight: int=1, log=False, *args, **kargs):
         self.super_monitor = super_monitor
         self.weight = weight
+        # Throttling is left to the super monitor
+        kargs.setdefault("max_rate", None)
         super(SubMonitor, self).__init__(*args, log=False, **kargs)
 
     def update(self, units=1, message=None):
+        old_progress = self.progress
         super(SubMonitor, self).update(units, message)
+        self.super_monitor._subprogress += (self.progress - old_progress) * self.weight
 
         if self.worked > self.total:
             raise ValueError("Steps worked ({}) exceeds total ({}). Did you set the numer of steps correctly?".format(self.worked, self.total))
@@ -87,6 +121,10 @@ class SubMonitor(ProgressMonitor):
         if self.worked == self.total:
             # We're done. We can deregister ourselves from supermonitor.
             self.super_monitor.sub_monitors.remove(self)
+            self.super_monitor._subprogress -= self.progress * self.weight
+            if not self.super_monitor.sub_monitors:
+                # Prevent accumulation of rounding errors
+                self.super_monitor._subprogress = 0
             self.super_monitor.update(self.weight, message)
         else:
             # We're not done; inform super monitor of progress
@@ -0,0 +1,261 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+"""
+Result cache for query actions.
+
+Values are (compressed) byte strings addressed by the cache key of a query action. Small
+values are stored in Redis, large values are spilled to disk. Redis keeps the bookkeeping:
+
+ - {prefix}.entry.{key}: hash with the value (or path and host), size, timestamp, articlesets
+   and codingjobs
+ - {prefix}.lru: sorted set of keys, scored by time of last access
+ - {prefix}.sizes: hash of key -> size, used for the byte budget
+ - {prefix}.articleset.{id}: set of keys of results depending on articleset id
+ - {prefix}.codingjob.{id}: set of keys of results depending on codingjob id
+ - {prefix}.stats: hash with hits, misses, sets, evictions, invalidations and bytes
+ - {prefix}.orphans.{host}: set of paths of values deleted by other hosts, which could not
+   remove the file themselves. That host removes them before it spills a value.
+
+If the total size exceeds the byte budget, least recently used values are evicted. Results
+are invalidated when articles are added to or removed from one of their articlesets, or when
+codings of one of their codingjobs are saved.
+
+Spilled values can only be read by other hosts if the directory is shared between them (see
+the query_cache section of amcat.ini). Otherwise, other hosts treat them as a miss, but leave
+them to the host that stored them. If another host deletes such a value, its file is removed
+by the host that stored it.
+"""
+import datetime
+import logging
+import os
+import socket
+import tempfile
+import time
+
+import django_redis
+from django import db
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+STATS = ("hits", "misses", "sets", "evictions", "invalidations", "bytes")
+
+
+def _get_prefix():
+    db_name = db.connections.databases['default']['NAME']
+    return "{}.query-cache".format(db_name)
+
+
+class QueryCache(object):
+    def __init__(self, max_bytes=None, spill_bytes=None, directory=None, max_age=None):
+        """
+        @param max_bytes: total size of all values after which values are evicted
+        @param spill_bytes: values larger than this are stored on disk
+        @param directory: directory to store large values in
+        @param max_age: number of seconds after which values are discarded
+        """
+        self.max_bytes = settings.QUERY_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.spill_bytes = settings.QUERY_CACHE_SPILL_BYTES if spill_bytes is None else spill_bytes
+        self.directory = settings.QUERY_CACHE_DIR if directory is None else directory
+        self.max_age = settings.QUERY_CACHE_MAX_AGE if max_age is None else max_age
+        self.prefix = _get_prefix()
+
+    @property
+    def redis(self):
+        return django_redis.get_redis_connection()  # type: redis.client.StrictRedis
+
+    def _key(self, *parts):
+        return ".".join(map(str, (self.prefix,) + parts))
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """
+        Get the value stored under key, or None if no (valid) value exists.
+        """
+        entry = self.redis.hgetall(self._key("entry", key))
+        value = None
+        valid = bool(entry) and time.time() - float(entry[b"timestamp"]) <= self.max_age
+
+        if valid:
+            if b"path" in entry:
+                try:
+                    with open(entry[b"path"].decode(), "rb") as f:
+                        value = f.read()
+                except FileNotFoundError:
+                    host = entry.get(b"host")
+                    if host is not None and host.decode() != socket.gethostname():
+                        # Spilled by another host to a directory not shared with us
+                        log.info("Value for {} is stored on another host".format(key))
+                    else:
+                        log.warning("Value for {} not found on disk".format(key))
+                        valid = False
+            else:
+                value = entry[b"value"]
+
+        if value is None:
+            if entry and not valid:
+                self.delete(key)
+            self.redis.hincrby(self._key("stats"), "misses", 1)
+            return None
+
+        pipe = self.redis.pipeline()
+        pipe.zadd(self._key("lru"), time.time(), key)
+        pipe.hincrby(self._key("stats"), "hits", 1)
+        pipe.execute()
+        return value
+
+    def get_timestamp(self, key):
+        """Returns the datetime at which key was set, or None if it does not exist"""
+        timestamp = self.redis.hget(self._key("entry", key), "timestamp")
+        return None if timestamp is None else datetime.datetime.fromtimestamp(float(timestamp))
+
+    def set(self, key, value, articlesets=(), codingjobs=()):
+        """
+        Store value under key.
+
+        @param value: bytes
+        @param articlesets: ids of the articlesets this value should be invalidated on
+        @param codingjobs: ids of the codingjobs this value should be invalidated on
+        """
+        self.delete(key)
+
+        if len(value) > self.max_bytes:
+            log.info("Not caching {}: {} bytes exceeds budget".format(key, len(value)))
+            return
+
+        articlesets = set(map(int, articlesets))
+        codingjobs = set(map(int, codingjobs))
+        now = time.time()
+        entry = {
+            "size": len(value),
+            "timestamp": now,
+            "articlesets": ",".join(map(str, sorted(articlesets))),
+            "codingjobs": ",".join(map(str, sorted(codingjobs)))
+        }
+
+        if len(value) > self.spill_bytes:
+            entry["path"] = self._write(key, value)
+            entry["host"] = socket.gethostname()
+        else:
+            entry["value"] = value
+
+        pipe = self.redis.pipeline()
+        pipe.hmset(self._key("entry", key), entry)
+        pipe.zadd(self._key("lru"), now, key)
+        pipe.hset(self._key("sizes"), key, len(value))
+        for aset in articlesets:
+            pipe.sadd(self._key("articleset", aset), key)
+        for job in codingjobs:
+            pipe.sadd(self._key("codingjob", job), key)
+        pipe.hincrby(self._key("stats"), "sets", 1)
+        pipe.hincrby(self._key("stats"), "bytes", len(value))
+        pipe.execute()
+
+        self._evict()
+
+    def _write(self, key, value):
+        self._remove_orphans()
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(value)
+        path = self._get_path(key)
+        os.replace(tmp, path)
+        return path
+
+    def _remove_orphans(self):
+        """Remove the files of our values deleted by other hosts"""
+        pipe = self.redis.pipeline()
+        pipe.smembers(self._key("orphans", socket.gethostname()))
+        pipe.delete(self._key("orphans", socket.gethostname()))
+        paths, _ = pipe.execute()
+        for path in paths:
+            try:
+                os.remove(path.decode())
+            except FileNotFoundError:
+                pass
+
+    def delete(self, key):
+        """Remove key from the cache. Returns whether key existed."""
+        entry_key = self._key("entry", key)
+        path, host, articlesets, codingjobs = self.redis.hmget(entry_key, "path", "host", "articlesets", "codingjobs")
+        size = self.redis.hget(self._key("sizes"), key)
+
+        pipe = self.redis.pipeline()
+        pipe.delete(entry_key)
+        pipe.zrem(self._key("lru"), key)
+        pipe.hdel(self._key("sizes"), key)
+        for aset in filter(None, (articlesets or b"").decode().split(",")):
+            pipe.srem(self._key("articleset", aset), key)
+        for job in filter(None, (codingjobs or b"").decode().split(",")):
+            pipe.srem(self._key("codingjob", job), key)
+        if size is not None:
+            pipe.hincrby(self._key("stats"), "bytes", -int(size))
+        pipe.execute()
+
+        if path is not None:
+            try:
+                os.remove(path.decode())
+            except FileNotFoundError:
+                if host is not None and host.decode() != socket.gethostname():
+                    # Spilled by another host to a directory not shared with us, leave it to that host
+                    self.redis.sadd(self._key("orphans", host.decode()), path)
+
+        return size is not None
+
+    def _evict(self):
+        """Evict least recently used values until the total size is within budget"""
+        while int(self.redis.hget(self._key("stats"), "bytes") or 0) > self.max_bytes:
+            lru = self.redis.zrange(self._key("lru"), 0, 0)
+            if not lru:
+                break
+            key = lru[0].decode()
+            log.info("Evicting {} from query cache".format(key))
+            if not self.delete(key):
+                # Inconsistent bookkeeping (e.g. concurrent delete); make sure we make progress
+                self.redis.zrem(self._key("lru"), key)
+            self.redis.hincrby(self._key("stats"), "evictions", 1)
+
+    def invalidate_articlesets(self, articleset_ids):
+        """Remove all values depending on any of the given articlesets"""
+        self._invalidate("articleset", articleset_ids)
+
+    def invalidate_codingjobs(self, codingjob_ids):
+        """Remove all values depending on any of the given codingjobs"""
+        self._invalidate("codingjob", codingjob_ids)
+
+    def _invalidate(self, kind, ids):
+        for id in ids:
+            keys = self.redis.smembers(self._key(kind, id))
+            for key in keys:
+                self.delete(key.decode())
+            self.redis.delete(self._key(kind, id))
+            if keys:
+                self.redis.hincrby(self._key("stats"), "invalidations", len(keys))
+
+    def get_stats(self):
+        """
+        @return: dictionary with hits, misses, sets, evictions, invalidations, bytes and entries
+        """
+        stats = {k.decode(): int(v) for k, v in self.redis.hgetall(self._key("stats")).items()}
+        stats = {k: stats.get(k, 0) for k in STATS}
+        stats["entries"] = self.redis.zcard(self._key("lru"))
+        return stats
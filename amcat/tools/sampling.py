@@ -0,0 +1,269 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+"""
+Random sampling of articlesets.
+
+Three methods are available:
+
+ - database: stream the ids of the set from a server-side cursor. Absolute samples are drawn
+   with reservoir sampling (Algorithm L), so memory only depends on the sample size; fractions
+   are drawn from the (compact) array of all ids, so no separate count is needed.
+ - elastic: order the articles of the set by a seeded random_score and take the top hits.
+ - stratified: sample from each date interval or property value (e.g. medium) in proportion
+   to its number of articles, using aggregation counts to allocate the sample.
+
+Unlike ORDER BY random(), none of these sort the set in postgres.
+"""
+import itertools
+import logging
+import math
+import random
+import uuid
+from array import array
+
+from django.db import connection, transaction
+
+from amcat.tools.amcates import ES
+
+log = logging.getLogger(__name__)
+
+METHODS = ("database", "elastic", "stratified")
+INTERVALS = ("year", "quarter", "month", "week", "day")
+
+ARTICLE_IDS_SQL = "SELECT article_id FROM articlesets_articles WHERE articleset_id = %s"
+
+# Number of ids transferred per round trip
+CHUNK_SIZE = 10000
+
+
+def get_sample_size(sample, n):
+    """
+    @param sample: absolute number (int) or fraction (float) of articles
+    @param n: number of articles in the population
+    @return: number of articles to sample
+    """
+    if isinstance(sample, int):
+        return min(sample, n)
+    return min(int(round(n * sample)), n)
+
+
+def _uniform(rnd):
+    """Returns a random number in the open interval (0, 1)"""
+    while True:
+        u = rnd.random()
+        if u > 0:
+            return u
+
+
+_END = object()
+
+
+def reservoir_sample(iterable, k, rnd=random):
+    """
+    Draw k items uniformly from iterable in a single pass using Algorithm L (Li, 1994), which
+    skips over items instead of drawing a random number for each of them.
+
+    @param rnd: random.Random instance (or the random module)
+    @return: a list of min(k, len(iterable)) items, in no particular order
+    """
+    iterator = iter(iterable)
+    reservoir = list(itertools.islice(iterator, k))
+    if len(reservoir) < k or k == 0:
+        return reservoir
+
+    w = math.exp(math.log(_uniform(rnd)) / k)
+    while True:
+        skip = int(math.log(_uniform(rnd)) / math.log(1 - w))
+        item = next(itertools.islice(iterator, skip, None), _END)
+        if item is _END:
+            return reservoir
+        reservoir[rnd.randrange(k)] = item
+        w *= math.exp(math.log(_uniform(rnd)) / k)
+
+
+def allocate(counts, size):
+    """
+    Divide size over strata in proportion to their counts (largest remainder method).
+
+    @param counts: {stratum: number of articles}
+    @return: {stratum: sample size}, with sizes summing to min(size, sum(counts))
+    """
+    total = sum(counts.values())
+    size = min(size, total)
+    if not size:
+        return {stratum: 0 for stratum in counts}
+
+    quotas = {stratum: n * size / total for stratum, n in counts.items()}
+    result = {stratum: int(q) for stratum, q in quotas.items()}
+    remainders = sorted(counts, key=lambda s: (quotas[s] - result[s], counts[s]), reverse=True)
+    for stratum in remainders[:size - sum(result.values())]:
+        result[stratum] += 1
+    return result
+
+
+def _get_seed(seed):
+    if seed is None:
+        seed = random.randrange(2 ** 31)
+        log.info("Sampling with random seed {seed}".format(**locals()))
+    return seed
+
+
+def _iter_article_ids(articleset_id):
+    """Yield the article ids of the given set using a server-side (named) cursor"""
+    with transaction.atomic():
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(name="sample_{}".format(uuid.uuid4().hex))
+        cursor.itersize = CHUNK_SIZE
+        try:
+            cursor.execute(ARTICLE_IDS_SQL, [articleset_id])
+            for (article_id,) in cursor:
+                yield article_id
+        finally:
+            cursor.close()
+
+
+def sample_database(articleset_id, sample, seed=None):
+    """
+    Sample article ids from the given set using the database
+
+    @param sample: absolute number (int) or fraction (float) of articles
+    @return: list of article ids
+    """
+    rnd = random.Random(_get_seed(seed))
+    if isinstance(sample, int):
+        return reservoir_sample(_iter_article_ids(articleset_id), sample, rnd)
+
+    ids = array("q", _iter_article_ids(articleset_id))
+    size = get_sample_size(sample, len(ids))
+    log.info("Sampling {size} of {n} articles".format(n=len(ids), **locals()))
+    return [ids[i] for i in rnd.sample(range(len(ids)), size)]
+
+
+def _get_random_ids(filters, size, seed):
+    """Returns the ids of size random articles matching the given filter clauses"""
+    if not size:
+        return []
+    body = {"query": {"function_score": {
+        "query": {"filtered": {"filter": {"bool": {"must": filters}}}},
+        "random_score": {"seed": seed},
+        "boost_mode": "replace"
+    }}}
+    hits = ES().scroll(body, size=min(size, CHUNK_SIZE), fields="")
+    try:
+        return [int(hit["_id"]) for hit in itertools.islice(hits, size)]
+    finally:
+        # Clear the scroll if we stopped early
+        hits.close()
+
+
+def sample_elastic(articleset_id, sample, seed=None):
+    """
+    Sample article ids from the given set using a seeded random score in elastic
+
+    @param sample: absolute number (int) or fraction (float) of articles
+    @return: list of article ids
+    """
+    seed = _get_seed(seed)
+    if not isinstance(sample, int):
+        n = ES().count(filters={"sets": articleset_id})
+        sample = get_sample_size(sample, n)
+        log.info("Sampling {sample} of {n} articles".format(**locals()))
+    return _get_random_ids([{"term": {"sets": articleset_id}}], sample, seed)
+
+
+def _get_property_field(name):
+    # Untyped string properties are analyzed; use their not analyzed 'raw' version instead
+    mapping = ES().get_mapping().get(name, {})
+    if "raw" in mapping.get("fields", {}):
+        return "{}.raw".format(name)
+    return name
+
+
+def get_strata(articleset_id, stratify_by="date", interval="month"):
+    """
+    Determine the strata of the given set and their sizes
+
+    @param stratify_by: 'date', or the name of an article property such as 'medium'
+    @param interval: date interval, if stratifying by date
+    @return: a list of (filter clause, number of articles) tuples
+    """
+    filters = {"sets": articleset_id}
+
+    if stratify_by == "date":
+        aggregation = {"date_histogram": {"field": "date", "interval": interval, "min_doc_count": 1}}
+        buckets = ES().search_aggregate(aggregation, filters=filters)["buckets"]
+        keys = [b["key"] for b in buckets] + [None]
+        strata = []
+        for bucket, end in zip(buckets, keys[1:]):
+            date_range = {"gte": bucket["key"]} if end is None else {"gte": bucket["key"], "lt": end}
+            strata.append(({"range": {"date": date_range}}, bucket["doc_count"]))
+        return strata
+
+    field = _get_property_field(stratify_by)
+    aggregation = {"terms": {"field": field, "size": 0}}
+    buckets = ES().search_aggregate(aggregation, filters=filters)["buckets"]
+    strata = [({"term": {field: b["key"]}}, b["doc_count"]) for b in buckets]
+
+    missing = ES().search_aggregate({"missing": {"field": field}}, filters=filters)["doc_count"]
+    if missing:
+        strata.append(({"missing": {"field": field}}, missing))
+    return strata
+
+
+def sample_stratified(articleset_id, sample, stratify_by="date", interval="month", seed=None):
+    """
+    Sample article ids from the given set, taking from each stratum a number of articles
+    proportional to its size.
+
+    @param sample: absolute number (int) or fraction (float) of articles
+    @param stratify_by: 'date', or the name of an article property such as 'medium'
+    @param interval: date interval, if stratifying by date
+    @return: list of article ids
+    """
+    seed = _get_seed(seed)
+    strata = get_strata(articleset_id, stratify_by, interval)
+    counts = {i: n for i, (_, n) in enumerate(strata)}
+    n = sum(counts.values())
+    size = get_sample_size(sample, n)
+    log.info("Sampling {size} of {n} articles from {k} strata".format(k=len(strata), **locals()))
+
+    result = []
+    for i, stratum_size in allocate(counts, size).items():
+        clause = strata[i][0]
+        result += _get_random_ids([{"term": {"sets": articleset_id}}, clause], stratum_size, seed)
+    return result
+
+
+def sample_articleset(articleset_id, sample, method="database", seed=None, **options):
+    """
+    Sample article ids from the given set
+
+    @param sample: absolute number (int) or fraction (float) of articles
+    @param method: one of METHODS
+    @param seed: seed for the random generator, results are reproducible for the same seed
+    @param options: stratify_by and interval, for stratified sampling
+    @return: list of article ids
+    """
+    if method == "database":
+        return sample_database(articleset_id, sample, seed)
+    if method == "elastic":
+        return sample_elastic(articleset_id, sample, seed)
+    if method == "stratified":
+        return sample_stratified(articleset_id, sample, seed=seed, **options)
+    raise ValueError("Unknown sampling method: {method!r}".format(**locals()))
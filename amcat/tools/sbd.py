@@ -19,14 +19,32 @@
 
 """
 Simple regex-based sentence boundary detection
+
+Articles can be split one at a time (get_or_create_sentences) or in bulk
+(create_sentences_bulk), which splits articles on a process pool and stores the
+sentences using COPY. The articles of new codingjobs can be split in a background
+task (split_codingjob_sentences), so coders do not wait for articles to be split.
 """
 
 import functools
 import collections
+import io
+import json
+import logging
+import multiprocessing
 import re
 
-from amcat.models import Article
+from django.db import connection, transaction, IntegrityError
+from django.http import HttpResponse
+
+from amcat.models import Article, CodedArticle
 from amcat.models.sentence import Sentence
+from amcat.models.task import TaskHandler
+from amcat.tools.amcates_bulk import bounded_imap
+from amcat.tools.progress import NullMonitor, ProgressMonitor
+from amcat.tools.toolkit import splitlist
+
+log = logging.getLogger(__name__)
 
 abbrevs = ["ir", "mr", "dr", "dhr", "ing", "drs", "mrs", "sen", "sens", "gov", "st",
            "jr", "rev", "vs", "gen", "adm", "sr", "lt", "sept"]
@@ -34,6 +52,20 @@ months = ["Jan", "Feb", "Mar", "Apr", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov",
 
 
 PARAGRAPH_RE = re.compile(r"\n\s*\n[\s\n]*")
+WHITELINES_RE = re.compile("\n\n+")
+WHITESPACE_RE = re.compile(r"\s+")
+
+# Number of articles fetched, split and stored at once by create_sentences_bulk
+BULK_BATCH_SIZE = 1000
+
+UNSPLIT_ARTICLES_SQL = """
+SELECT a.article_id, a.title, a.text
+FROM articles a
+WHERE a.article_id = ANY(%s)
+AND NOT EXISTS (SELECT 1 FROM sentences s WHERE s.article_id = a.article_id)
+"""
+
+COPY_SENTENCES_SQL = "COPY sentences (article_id, parnr, sentnr, sentence) FROM STDIN"
 
 
 @functools.lru_cache()
@@ -64,18 +96,36 @@ def get_or_create_sentences(article):
     return article.sentences.all()
 
 
-def _get_paragraphs(article: Article):
+def _get_paragraphs(title, text):
     # Title
-    yield article.title
+    yield title
 
     # Text splitted on white lines
-    yield from iter(PARAGRAPH_RE.split(article.text.strip()))
+    yield from iter(PARAGRAPH_RE.split(text.strip()))
+
+
+def split_article(row):
+    """
+    Split an article into sentences. This function is run on worker processes by
+    create_sentences_bulk, so it should not touch the database.
+
+    @param row: an (article_id, title, text) tuple
+    @return: a list of (article_id, parnr, sentnr, sentence) tuples
+    """
+    article_id, title, text = row
+    return [(article_id, parnr + 1, sentnr + 1, sent)
+            for parnr, par in enumerate(_get_paragraphs(title, text))
+            for sentnr, sent in enumerate(split(par))]
+
+
+def split_articles(rows):
+    """Split a batch of (article_id, title, text) rows, see split_article"""
+    return [sentence for row in rows for sentence in split_article(row)]
 
 
 def _create_sentences(article: Article):
-    for parnr, par in enumerate(_get_paragraphs(article)):
-        for sentnr, sent in enumerate(split(par)):
-            yield Sentence(parnr=parnr + 1, sentnr=sentnr + 1, article=article, sentence=sent)
+    for _, parnr, sentnr, sent in split_article((article.id, article.title, article.text)):
+        yield Sentence(parnr=parnr, sentnr=sentnr, article=article, sentence=sent)
 
 
 def create_sentences(article):
@@ -90,15 +140,141 @@ def create_sentences(article):
     return sents
 
 
+def _copy_escape(value):
+    """Escape a value for the COPY text format"""
+    value = str(value)
+    for char, escaped in (("\\", "\\\\"), ("\t", "\\t"), ("\n", "\\n"), ("\r", "\\r")):
+        value = value.replace(char, escaped)
+    return value
+
+
+def _copy_sentences(sentences):
+    """Insert (article_id, parnr, sentnr, sentence) tuples using COPY"""
+    if not sentences:
+        return
+    data = io.StringIO()
+    for sentence in sentences:
+        data.write("\t".join(map(_copy_escape, sentence)))
+        data.write("\n")
+    data.seek(0)
+    with connection.cursor() as cursor:
+        cursor.cursor.copy_expert(COPY_SENTENCES_SQL, data)
+
+
+def _get_unsplit_articles(article_ids, batch_size):
+    for batch in splitlist(article_ids, itemsperbatch=batch_size):
+        with connection.cursor() as cursor:
+            cursor.execute(UNSPLIT_ARTICLES_SQL, [list(batch)])
+            yield cursor.fetchall()
+
+
+def create_sentences_bulk(article_ids, processes=None, batch_size=BULK_BATCH_SIZE, monitor=NullMonitor()):
+    """
+    Split the given articles into sentences and store them, skipping articles which
+    already have sentences. Articles are split in batches on a pool of processes, while
+    the calling process fetches articles and stores sentences.
+
+    @param processes: number of processes splitting articles. Defaults to the number of
+                      cpus; use 0 to split articles in the calling process.
+    @return: the number of sentences created
+    """
+    article_ids = list(article_ids)
+    processes = multiprocessing.cpu_count() if processes is None else processes
+    nbatches = -(-len(article_ids) // batch_size)
+    monitor = monitor.submonitor(total=max(nbatches, 1))
+
+    # Compile regular expression before forking, so workers inherit it
+    get_split_regex()
+
+    pool = None
+    if processes and nbatches > 1 and not multiprocessing.current_process().daemon:
+        pool = multiprocessing.Pool(processes)
+
+    n = 0
+    try:
+        batches = _get_unsplit_articles(article_ids, batch_size)
+        for i, sentences in enumerate(bounded_imap(pool, split_articles, batches, max_pending=2 * (processes or 1))):
+            try:
+                with transaction.atomic():
+                    _copy_sentences(sentences)
+            except IntegrityError:
+                # Some articles were split concurrently, skip those and insert the rest
+                log.warning("Articles in batch {} already split, skipping those".format(i + 1))
+                split_ids = Sentence.objects.filter(article_id__in={s[0] for s in sentences})
+                split_ids = set(split_ids.values_list("article_id", flat=True).distinct())
+                sentences = [s for s in sentences if s[0] not in split_ids]
+                Sentence.objects.bulk_create(Sentence(article_id=aid, parnr=parnr, sentnr=sentnr, sentence=sent)
+                                             for aid, parnr, sentnr, sent in sentences)
+            n += len(sentences)
+            monitor.update(1, "Split batch {}/{}".format(i + 1, nbatches))
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    if not nbatches:
+        monitor.update(1, "No articles to split")
+    return n
+
+
+def split_codingjob_articles(codingjob_ids, monitor=NullMonitor()):
+    """
+    Split all articles of the given codingjobs into sentences.
+
+    @return: the number of sentences created
+    """
+    article_ids = CodedArticle.objects.filter(codingjob_id__in=codingjob_ids)
+    article_ids = article_ids.values_list("article_id", flat=True).distinct()
+    return create_sentences_bulk(article_ids, monitor=monitor)
+
+
+class SplitSentencesHandler(TaskHandler):
+    """Handler for tasks splitting the articles of codingjobs, see split_codingjob_sentences"""
+    def run_task(self):
+        from navigator.views.scriptview import CeleryProgressUpdater
+        monitor = ProgressMonitor()
+        monitor.add_listener(CeleryProgressUpdater(str(self.task.uuid)).update)
+        try:
+            return split_codingjob_articles(self.task.arguments["codingjobs"], monitor=monitor)
+        finally:
+            # Pass on progress held back by the throttle
+            monitor.flush()
+
+    def get_redirect(self):
+        """Splitting runs in the background of creating codingjobs, there is nothing to redirect to"""
+        return None
+
+    def get_response(self):
+        """Return the number of sentences created as a json response"""
+        return HttpResponse(json.dumps({"sentences": self.get_result()}), content_type="application/json")
+
+
+def split_codingjob_sentences(codingjob_ids, user, project):
+    """
+    Queue a task splitting the articles of the given codingjobs into sentences, after the
+    current transaction commits. If the task cannot be queued, sentences are still created
+    when coders open articles.
+    """
+    codingjob_ids = list(codingjob_ids)
+
+    def queue():
+        try:
+            SplitSentencesHandler.call(target_class=create_sentences_bulk, user=user, project=project,
+                                       arguments={"codingjobs": codingjob_ids})
+        except Exception:
+            log.exception("Could not queue splitting codingjobs {}".format(codingjob_ids))
+
+    transaction.on_commit(queue)
+
+
 def split(text):
     """
     Split the text into sentences and yield the sentence strings
     """
-    text = re.sub("\n\n+", "\n\n", text)
+    text = WHITELINES_RE.sub("\n\n", text)
     text = text.replace(".'", "'.")
 
     sentences = get_split_regex().split(text)
     sentences = (s.strip() for s in sentences)
     sentences = (s for s in sentences if s)
-    sentences = (re.sub("\s+", " ", s) for s in sentences)
+    sentences = (WHITESPACE_RE.sub(" ", s) for s in sentences)
     return sentences
@@ -130,6 +130,15 @@ class XLSX(TableExporter):
     extension = "xlsx"
 
     def to_bytes(self, table, **kargs):
+        buffer = io.BytesIO()
+        self.to_file(table, buffer)
+        return buffer.getvalue()
+
+    def to_file(self, table, file):
+        """
+        Write the table to file, which can be a filename or a (binary) file object. Rows
+        are written to the worksheet as they are generated by the table.
+        """
         wb = Workbook(optimized_write=True)
         ws = wb.create_sheet()
 
@@ -143,11 +152,9 @@ class XLSX(TableExporter):
         writer = ExcelWriter(wb)
 
         # Need to do a little bit more work here, since the openpyxl library only
-        # supports writing to a filename, while we need a buffer here..
-        buffer = io.BytesIO()
-        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        # supports writing to a filename, while we might get a buffer here..
+        with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED) as zf:
             writer.write_data(zf)
-        return buffer.getvalue()
 
 
 HTML_FILENAME = os.path.join(os.path.dirname(__file__), "templates/articles.html")
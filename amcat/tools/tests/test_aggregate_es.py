@@ -177,3 +177,22 @@ class TestAggregateES(amcattest.AmCATTestCase):
             ("aap", 2),
             ("noot", 2)
         })
+
+    @amcattest.use_elastic
+    def test_dense(self):
+        self.set_up()
+
+        term1 = SearchQuery("aap")
+        term2 = SearchQuery("lamp")
+        categories = [IntervalCategory("day", fill_zeros=False), TermCategory([term1, term2])]
+
+        filters = {"sets": list(ArticleSet.objects.all().values_list("id", flat=True))}
+        dense = aggregate(filters=filters, categories=categories, dense=True)
+
+        self.assertEqual(dense.axes, [["2010-01-01", "2010-01-02"], [term1, term2]])
+        self.assertEqual(list(dense.counts), [2, 0, 0, 1])
+        self.assertEqual(dense[1, 1], 1)
+
+        # Rows are zero filled, both when iterating over dense and in lazy mode
+        self.assertEqual(set(dense.rows()), set(aggregate(filters=filters, categories=categories, lazy=True)))
+        self.assertEqual(len(list(dense.rows())), 4)
@@ -27,7 +27,7 @@ from django.test import TransactionTestCase
 from amcat.models import Coding
 from amcat.tools import amcattest, aggregate_orm
 from amcat.tools.aggregate_orm import CountArticlesValue, TermCategory, ArticleSetCategory, \
-    IntervalCategory
+    IntervalCategory, CountCodingsValue, CountCodingValuesValue
 from amcat.tools.aggregate_orm import SchemafieldCategory, AverageValue
 from amcat.tools.sbd import get_or_create_sentences
 
@@ -185,6 +185,20 @@ class TestAggregateORM(TransactionTestCase):
         self.assertEqual(result, set())
 
 
+    def test_statement_size(self):
+        # Neither codings nor terms should be inlined in the sql
+        codings = Coding.objects.filter(coded_article__codingjob=self.job)
+        terms = {"a": list(range(10000))}
+        aggr = aggregate_orm.ORMAggregate(codings, terms=terms, flat=True, threaded=False)
+        statements = list(aggr._get_aggregate_sql([TermCategory()], CountArticlesValue()))
+
+        for _, statement in statements:
+            sql = statement if isinstance(statement, str) else statement[0]
+            self.assertLess(len(sql), 2000)
+
+        (query,) = [statement for collect, statement in statements if collect]
+        self.assertEqual(list(query[1]), [self.job.id])
+
     def test_incorrect_inputs(self):
         # You need at least one value
         self.assertRaises(ValueError, self._get_aggr().get_aggregate, categories=ArticleSetCategory())
@@ -318,6 +332,34 @@ class TestAggregateORM(TransactionTestCase):
         result = set(aggr.get_aggregate([SchemafieldCategory(self.codef)], [CountArticlesValue()]))
         self.assertEqual(result, {(self.code_A, 2), (self.code_B, 1), (self.code_A1, 1)})
 
+    def test_columns(self):
+        """Aggregating coding columns should yield the same results as aggregating in postgres"""
+        terms = {"a": [self.a1.id, self.a2.id, self.a3.id], "c": [self.a1.id, self.a4.id]}
+        aggregations = [
+            ([SchemafieldCategory(self.codef)], [CountArticlesValue(), AverageValue(self.intf)]),
+            ([SchemafieldCategory(self.codef)], [AverageValue(self.intf), AverageValue(self.qualf)]),
+            ([SchemafieldCategory(self.codef, prefix="A")], [AverageValue(self.sintf, prefix="B")]),
+            ([SchemafieldCategory(self.scodef, prefix="A")], [AverageValue(self.intf, prefix="B")]),
+            ([ArticleFieldCategory.from_field_name("date", interval="month"), ArticleSetCategory()], [CountCodingsValue(), CountCodingValuesValue()]),
+            ([ArticleFieldCategory.from_field_name("date", interval="week")], [CountArticlesValue()]),
+            ([TermCategory()], [CountArticlesValue()]),
+        ]
+
+        for categories, values in aggregations:
+            aggr = self._get_aggr(terms=terms)
+            expected = set(aggr.get_aggregate(categories, values))
+
+            aggr = self._get_aggr(terms=terms, use_columns=True)
+            self.assertTrue(aggr._use_columns(categories, values))
+            self.assertEqual(set(aggr.get_aggregate(categories, values)), expected)
+
+        # Article properties are not part of the columns, so these should fall back to postgres
+        aggr = self._get_aggr(flat=True, use_columns=True)
+        category = ArticleFieldCategory.from_field_name("medium")
+        self.assertFalse(aggr._use_columns([category], [CountArticlesValue()]))
+        self.assertEqual(set(aggr.get_aggregate([category], [CountArticlesValue()])),
+                         {('Telegraaf', 1), ('AD', 1), ('NRC', 2)})
+
     def test_no_codings(self):
         aggr = aggregate_orm.ORMAggregate(Coding.objects.none(), threaded=False)
         self.assertEqual(set(aggr.get_aggregate(values=[CountArticlesValue()])), set())
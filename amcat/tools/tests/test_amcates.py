@@ -141,6 +141,21 @@ class TestAmcatES(amcattest.AmCATTestCase):
         r = ES().query_all(filters=dict(sets=s.id), size=10)
         self.assertEqual(len(list(r)), len(arts))
 
+    @amcattest.use_elastic
+    def test_multi_query(self):
+        s1, s2, a, b, c, d, e = self.setup()
+        queries = ["noot", "bla", "nothing", "wim AND zus"]
+
+        scores = ES().multi_query(queries, filters={"sets": s1.id})
+        self.assertEqual([set(s) for s in scores], [{a.id, b.id, d.id}, {c.id}, set(), {b.id, c.id, d.id}])
+        self.assertEqual(scores[1][c.id], 3)
+
+        ids = ES().multi_query_ids(queries, filters={"sets": s1.id})
+        self.assertEqual(ids, [{a.id, b.id, d.id}, {c.id}, set(), {b.id, c.id, d.id}])
+
+        self.assertEqual(ES().multi_query_ids(["aap"], filters={"sets": [s1.id, s2.id]}), [{a.id, e.id}])
+        self.assertEqual(ES().multi_query([]), [])
+
     @amcattest.use_elastic
     def test_highlight_article(self):
         s1, s2, a, b, c, d, e = self.setup()
@@ -0,0 +1,82 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+import collections
+from unittest import mock
+
+from amcat.tools import amcattest, amcates_bulk
+from amcat.tools.amcates import ES, ElasticSearchError
+from amcat.tools.amcates_bulk import BulkIndexer
+
+
+class FlakyIndexer(BulkIndexer):
+    """Indexer which fails odd documents with the given status the first time they are sent"""
+    def __init__(self, status, *args, **kargs):
+        super(FlakyIndexer, self).__init__(*args, **kargs)
+        self.status = status
+        self.sent = collections.Counter()
+
+    def _check_properties(self, properties):
+        pass
+
+    def _bulk(self, documents):
+        items = []
+        for aid in documents:
+            self.sent[aid] += 1
+            if aid % 2 and self.sent[aid] == 1:
+                items.append({"index": {"_id": str(aid), "status": self.status, "error": "Failed"}})
+            else:
+                items.append({"index": {"_id": str(aid), "status": 201}})
+        return {"errors": any("error" in item["index"] for item in items), "items": items}
+
+
+class TestBulkIndexer(amcattest.AmCATTestCase):
+    def setUp(self):
+        super(TestBulkIndexer, self).setUp()
+        patcher = mock.patch.object(amcates_bulk, "RETRY_BACKOFF", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retry(self):
+        dicts = [{"id": i, "title": "test"} for i in range(10)]
+
+        # Transient errors are retried per document
+        indexer = FlakyIndexer(429, ES(), batch_size=3, processes=0)
+        indexer.index_documents(dicts)
+        self.assertEqual(indexer.sent, {i: (2 if i % 2 else 1) for i in range(10)})
+
+        # Other errors are reported after all batches are sent
+        indexer = FlakyIndexer(400, ES(), batch_size=3, processes=0)
+        self.assertRaises(ElasticSearchError, indexer.index_documents, dicts)
+        self.assertEqual(indexer.sent, {i: 1 for i in range(10)})
+        self.assertEqual(set(indexer.errors), {1, 3, 5, 7, 9})
+
+    @amcattest.use_elastic
+    def test_add_articles(self):
+        s1, s2 = amcattest.create_test_set(), amcattest.create_test_set()
+        arts = [amcattest.create_test_article(properties={"bulktest": str(i)}) for i in range(5)]
+        s1.add_articles(arts, add_to_index=False)
+        s2.add_articles(arts[:2], add_to_index=False)
+
+        ES().add_articles([a.id for a in arts], batch_size=2, processes=0)
+        ES().refresh()
+
+        self.assertEqual(set(ES().query_ids(filters={"sets": s1.id})), {a.id for a in arts})
+        self.assertEqual(set(ES().query_ids(filters={"sets": s2.id})), {a.id for a in arts[:2]})
+        for a in arts:
+            self.assertEqual(ES().get(a.id)["hash"], a.hash)
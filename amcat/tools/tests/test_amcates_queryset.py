@@ -22,6 +22,7 @@ from django.http import QueryDict
 
 from amcat.models import Article, ArticleSet
 from amcat.tools import amcates
+from amcat.tools import amcates_queryset
 from amcat.tools import amcattest
 from amcat.tools.amcates_queryset import ESQuerySet, merge_highlighted, get_filter_clauses, \
     _get_filter_clauses_from_querydict, get_filter_clauses_from_querydict
@@ -167,6 +168,44 @@ class TestAmcatesQuerySet(amcattest.AmCATTestCase):
         self.assertEqual(2, len(self.qs.filter(id__in=[self.a1.id, self.a2.id])))
         self.assertEqual(2, len(self.qs.filter(id__in=[self.a1.id, self.a2.id, -1])))
 
+    @amcattest.use_elastic
+    def test_slicing(self):
+        self.set_up()
+        qs = self.qs.order_by("date")
+
+        self.assertEqual(self.a2.id, qs[0].id)
+        self.assertEqual(self.a1.id, qs[1].id)
+        self.assertRaises(IndexError, lambda: qs[2])
+
+        self.assertEqual([self.a1.id], [a.id for a in qs[1:]])
+        self.assertEqual([self.a2.id], [a.id for a in qs[:1]])
+        self.assertEqual([self.a2.id], [a.id for a in qs[::2]])
+        self.assertEqual([], qs[2:10])
+
+        # Slicing a slice
+        self.assertEqual([self.a1.id], [a.id for a in qs._slice(1, None)[0:5]])
+        self.assertEqual(1, len(qs._slice(1, None)))
+        self.assertEqual(0, len(qs._slice(0, 0)))
+
+    @amcattest.use_elastic
+    def test_scroll(self):
+        self.set_up()
+        max_result_window, scroll_size = amcates_queryset.MAX_RESULT_WINDOW, amcates_queryset.SCROLL_SIZE
+        amcates_queryset.MAX_RESULT_WINDOW, amcates_queryset.SCROLL_SIZE = 1, 1
+
+        try:
+            qs = self.qs.order_by("date")
+            self.assertEqual([self.a2.id, self.a1.id], list(qs.values_list("id", flat=True)))
+            self.assertEqual([self.a1.id], [a.id for a in qs[1:]])
+            self.assertEqual([self.a2.id], [a.id for a in qs[0:1]])
+
+            highlighted = list(qs.only("title").highlight("gloria"))
+            self.assertEqual(2, len(highlighted))
+            self.assertEqual("Man leeft nog steeds in de <mark0>gloria</mark0>", highlighted[1].title)
+        finally:
+            amcates_queryset.MAX_RESULT_WINDOW = max_result_window
+            amcates_queryset.SCROLL_SIZE = scroll_size
+
     @amcattest.use_elastic
     def test_query(self):
         self.set_up()
@@ -104,3 +104,23 @@ class TestAssociation(amcattest.AmCATTestCase):
             (self.het, '-', '1.0'),
         })
 
+
+    @amcattest.use_elastic
+    def test_interval(self):
+        aset = amcattest.create_test_set()
+        amcattest.create_test_article(text="de het", date="2010-03-01", articleset=aset)
+        amcattest.create_test_article(text="de", date="2010-05-01", articleset=aset)
+        amcattest.create_test_article(text="de", date="2011-01-01", articleset=aset)
+        amcates.ES().refresh()
+
+        de, het = SearchQuery.from_string("de"), SearchQuery.from_string("het")
+        for weighted in (False, True):
+            ass = Association([de, het], {"sets": [aset.id]}, interval="year", weighted=weighted)
+            self.assertEqual(ass.get_intervals(), ["2010-01-01", "2011-01-01"])
+            probs = {(i, of, given): p for (i, p, of, given) in ass.get_conditional_probabilities()}
+            # Weighted, "de" counts for 1 - 0.5 ** 1 = 0.5 in "de het"
+            self.assertEqual(probs["2010-01-01", het, de], 0.5 if weighted else 1.0)
+            self.assertEqual(probs["2011-01-01", de, de], 1.0)
+            self.assertNotIn(("2011-01-01", de, het), probs)
+            if not weighted:
+                self.assertEqual(probs["2010-01-01", de, het], 0.5)
@@ -1,6 +1,6 @@
 from amcat.tools import amcattest
 from amcat.tools.caching import cached, invalidates, cached_named, invalidates_named, reset, \
-    set_cache, get_object, clear_cache, get_objects
+    set_cache, get_object, clear_cache, get_objects, LRUCache
 
 
 class TestCaching(amcattest.AmCATTestCase):
@@ -149,4 +149,15 @@ class TestCaching(amcattest.AmCATTestCase):
             ps = list(get_objects(Project, pids))
 
         with self.checkMaxQueries(0, "Get multiple cached projects one by one"):
-            ps = [get_objects(Project, pid) for pid in pids]
\ No newline at end of file
+            ps = [get_objects(Project, pid) for pid in pids]
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache["a"], cache["b"] = 1, 2
+        self.assertEqual(cache["a"], 1)
+        cache["c"] = 3
+        self.assertEqual(set(cache), {"a", "c"})
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        cache["d"] = 4
+        self.assertEqual(set(cache), {"c", "d"})
@@ -54,6 +54,14 @@ class TestClusterMap(AmCATTestCase):
         ])
 
 
+    def test_many_queries(self):
+        # 2^40 combinations, but only two clusters
+        queries = {SearchQuery("q{:02}".format(i)): [1, 2] if i else [1] for i in range(40)}
+        headers, rows = get_clustermap_table(queries)
+
+        self.assertEqual(41, len(headers))
+        self.assertEqual(rows, [(1,) * 40 + (1,), (0,) + (1,) * 39 + (1,)])
+
     def test_get_cluster_queries(self):
         queries = {
             SearchQuery("a"): [1, 2, 3],
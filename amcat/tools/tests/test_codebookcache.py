@@ -0,0 +1,89 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+from amcat.models import Language
+from amcat.tools import amcattest, codebookcache
+from amcat.tools.codebookcache import CodebookCache, CodebookTree
+
+
+class TestCodebookCache(amcattest.AmCATTestCase):
+    def setUp(self):
+        super(TestCodebookCache, self).setUp()
+        self.language = Language.objects.get(pk=1)
+        self.codebook = amcattest.create_test_codebook()
+        self.a = amcattest.create_test_code(label="A", extra_label="a", codebook=self.codebook)
+        self.a1 = amcattest.create_test_code(label="A1", codebook=self.codebook, parent=self.a)
+        self.a1x = amcattest.create_test_code(label="A1x", codebook=self.codebook, parent=self.a1)
+        self.b = amcattest.create_test_code(label="B", codebook=self.codebook)
+        self.codebook.add_code(amcattest.create_test_code(label="hidden"), parent=self.b, hide=True)
+
+    def test_tree(self):
+        tree = CodebookTree.from_db(self.codebook.id)
+        self.assertEqual(len(tree), 5)
+        self.assertEqual(tree.get_label(self.a.id), "A")
+        self.assertEqual(tree.get_label(self.a.id, self.language), "a")
+        self.assertIsNone(tree.get_label(self.a1.id, self.language))
+        self.assertEqual(tree.get_root_ids(), [self.a.id, self.b.id])
+        self.assertEqual(list(tree.get_descendant_ids(self.a.id)), [self.a.id, self.a1.id, self.a1x.id])
+        self.assertEqual(list(tree.get_ancestor_ids(self.a1x.id)), [self.a1x.id, self.a1.id, self.a.id])
+        self.assertEqual(tree.get_aggregation_mapping(), {"A1": "A", "hidden": "B"})
+        self.assertEqual(len(tree.get_code_ids()), 4)
+
+        # Results should match those of Codebook
+        self.assertEqual(dict(tree.get_hierarchy_ids()), dict(self.codebook._get_hierarchy_ids()))
+        self.codebook.cache()
+        self.assertEqual(tree.get_aggregation_mapping(), self.codebook.get_aggregation_mapping())
+
+        tree2 = CodebookTree.from_bytes(tree.to_bytes())
+        self.assertEqual(tree2.get_hierarchy_ids(), tree.get_hierarchy_ids())
+        self.assertEqual(tree2.get_label(self.a.id, self.language), "a")
+
+    def test_get(self):
+        cache = CodebookCache()
+        tree = cache.get(self.codebook.id)
+        with self.checkMaxQueries(0, "Get cached tree"):
+            self.assertIs(cache.get(self.codebook.id), tree)
+
+        # Trees are shared through Redis as well
+        codebookcache._local_trees.clear()
+        with self.checkMaxQueries(0, "Get tree from Redis"):
+            self.assertEqual(cache.get(self.codebook.id).get_hierarchy_ids(), tree.get_hierarchy_ids())
+
+    def test_invalidate(self):
+        cache = CodebookCache()
+        c = amcattest.create_test_code(label="C")
+        self.assertNotIn(c.id, cache.get(self.codebook.id))
+
+        self.codebook.add_code(c, parent=self.b)
+        self.assertIn(c.id, cache.get(self.codebook.id))
+
+        self.a1.add_label(self.language, "a1")
+        self.assertEqual(cache.get(self.codebook.id).get_label(self.a1.id, self.language), "a1")
+
+        self.a.label = "A!"
+        self.a.save()
+        self.assertEqual(cache.get(self.codebook.id).get_label(self.a.id), "A!")
+
+        self.codebook.delete_codebookcode(self.codebook.get_codebookcode(c))
+        self.assertNotIn(c.id, cache.get(self.codebook.id))
+
+        # Other codebooks are not invalidated
+        other = amcattest.create_test_codebook()
+        tree = cache.get(other.id)
+        self.a.add_label(self.language, "a!")
+        self.assertIs(cache.get(other.id), tree)
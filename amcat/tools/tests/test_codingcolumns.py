@@ -0,0 +1,136 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+import datetime
+import uuid
+from unittest import mock
+
+from amcat.tools import amcattest, codingcolumns
+from amcat.tools.codingcolumns import CodingColumnCache, CodingColumns
+
+
+class TestCodingColumns(amcattest.AmCATTestCase):
+    def setUp(self):
+        super(TestCodingColumns, self).setUp()
+        # Use a private prefix, so we do not interfere with other (cached) tests
+        prefix = "test-{}.coding-columns".format(uuid.uuid4())
+        patcher = mock.patch.object(codingcolumns, "_get_prefix", return_value=prefix)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = CodingColumnCache()
+
+        self.schema, _, self.strf, self.intf, _, _, _ = amcattest.create_test_schema_with_fields(isarticleschema=True)
+        self.job = amcattest.create_test_job(narticles=3, articleschema=self.schema)
+        self.a1, self.a2, self.a3 = self.job.articleset.articles.all().order_by("id")
+        self.a1.date = datetime.datetime(2015, 1, 2, 3, 4, 5)
+        self.a1.save()
+
+        self.c1 = amcattest.create_test_coding(codingjob=self.job, article=self.a1)
+        self.c1.update_values({self.strf: "bla", self.intf: 3})
+        self.c2 = amcattest.create_test_coding(codingjob=self.job, article=self.a2)
+
+    def _get_rows(self):
+        return {(r.article, r.coding, r.field, r.intval, r.strval) for r in self.cache.get([self.job.id])[self.job.id]}
+
+    def test_get(self):
+        columns = self.cache.get([self.job.id])[self.job.id]
+        self.assertEqual(len(columns), 3)
+        self.assertEqual(self._get_rows(), {
+            (self.a1.id, self.c1.id, self.strf.id, None, "bla"),
+            (self.a1.id, self.c1.id, self.intf.id, 3, None),
+            (self.a2.id, self.c2.id, None, None, None),
+        })
+        self.assertEqual({r.date for r in columns if r.article == self.a1.id}, {self.a1.date})
+
+        # Stored columns should be equal to built ones
+        self.assertEqual(list(self.cache.get([self.job.id])[self.job.id]), list(columns))
+
+    def test_stale(self):
+        self._get_rows()
+
+        # Changes not made by replace_codings should be detected
+        self.c1.update_values({self.intf: 4})
+        self.assertEqual(self._get_rows(), {
+            (self.a1.id, self.c1.id, self.intf.id, 4, None),
+            (self.a2.id, self.c2.id, None, None, None),
+        })
+
+    def test_update(self):
+        self._get_rows()
+        ca = self.job.get_coded_article(self.a3)
+        ca.replace_codings([{"values": [{"codingschemafield_id": self.intf.id, "intval": 7}]}])
+
+        # on_commit hooks do not fire in a test case, so call update explicitly
+        self.cache.update(ca)
+
+        # The stored version should match the counter, so the job does not need a rebuild
+        version = self.cache.redis.hget(self.cache._key(self.job.id), "version")
+        self.assertEqual(int(version), self.cache._get_versions([self.job.id])[self.job.id])
+
+        coding_id = ca.codings.get().id
+        with self.checkMaxQueries(0):
+            self.assertIn((self.a3.id, coding_id, self.intf.id, 7, None), self._get_rows())
+
+    def test_update_removed(self):
+        ca = self.job.get_coded_article(self.a3)
+        codings = [{"sentence_id": None, "start": i, "end": i + 1,
+                    "values": [{"codingschemafield_id": self.intf.id, "intval": i}]} for i in (1, 2)]
+        ca.update_codings(codings)
+        self.cache.update(ca)
+        rows = self.cache.get([self.job.id])[self.job.id]
+        self.assertEqual({r.intval for r in rows if r.article == self.a3.id}, {1, 2})
+
+        # Removing the coding with the highest id should still update the stored columns
+        ca.update_codings(codings[:1])
+        self.cache.update(ca)
+        with self.checkMaxQueries(0):
+            rows = self.cache.get([self.job.id])[self.job.id]
+        self.assertEqual({r.intval for r in rows if r.article == self.a3.id}, {1})
+
+    def test_get_coded_articles(self):
+        ca1, ca2 = self.job.get_coded_article(self.a1), self.job.get_coded_article(self.a2)
+        rows = {(r.article, r.coding, r.field) for r in self.cache.get_coded_articles(self.job.id, [ca2.id])}
+        self.assertEqual(rows, {(self.a2.id, self.c2.id, None)})
+
+        # Stored columns are used if they are current
+        self.cache.get([self.job.id])
+        with self.checkMaxQueries(0):
+            columns = self.cache.get_coded_articles(self.job.id, [ca2.id, ca1.id])
+        self.assertEqual(list(columns), list(self.cache.get([self.job.id])[self.job.id]))
+
+        # ..but not if they are stale
+        self.c2.delete()
+        self.assertEqual(len(self.cache.get_coded_articles(self.job.id, [ca2.id])), 0)
+
+    def test_codings(self):
+        columns = self.cache.get([self.job.id])[self.job.id]
+        ca = self.job.get_coded_article(self.a1)
+        with self.checkMaxQueries(0):
+            codings = list(columns.filter([ca.id]).get_codings())
+            values = {v.field_id: (v.intval, v.strval) for v in codings[0].values.all()}
+        self.assertEqual(codings, [self.c1])
+        self.assertEqual(values, {self.strf.id: (None, "bla"), self.intf.id: (3, None)})
+
+    def test_coded_article_ids(self):
+        columns = self.cache.get([self.job.id])[self.job.id]
+        ca1, ca2 = self.job.get_coded_article(self.a1), self.job.get_coded_article(self.a2)
+        self.assertEqual(columns.get_coded_article_ids(), {ca1.id, ca2.id})
+        self.assertEqual(columns.get_coded_article_ids(article_ids={self.a2.id}), {ca2.id})
+        self.assertEqual(columns.get_coded_article_ids(field_id=self.intf.id, intvals={3}), {ca1.id})
+        self.assertEqual(columns.get_coded_article_ids(field_id=self.intf.id, intvals={4}), set())
+        self.assertEqual(len(CodingColumns.concatenate([columns, columns])), 2 * len(columns))
@@ -0,0 +1,103 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+import random
+import struct
+
+from amcat.tools import amcattest
+from amcat.tools.amcates import ES
+from amcat.tools.deduplicate import ExternalSorter, MinHasher, Deduplicator, merge_groups, get_lsh_parameters, \
+    get_band_keys, get_similar_pairs, SignatureStore
+
+TEXT = ("The cabinet decided today to raise taxes for all citizens of the country, "
+        "according to a statement released by the ministry of finance this morning.")
+
+
+class TestDeduplicate(amcattest.AmCATTestCase):
+    def test_external_sorter(self):
+        records = [(bytes([random.randrange(5)]) * 16, i) for i in range(100)]
+        sorter = ExternalSorter(max_records=7)
+        for key, id in records:
+            sorter.add(key, id)
+
+        self.assertEqual(list(sorter), sorted(records))
+
+        expected = {}
+        for key, id in records:
+            expected.setdefault(key, []).append(id)
+        expected = sorted(ids for ids in expected.values() if len(ids) > 1)
+        self.assertEqual(sorted(sorter.get_groups()), expected)
+        sorter.close()
+
+    def test_merge_groups(self):
+        groups = [[3, 5], [5, 9], [1, 2], [2, 7], [11, 12]]
+        self.assertEqual(sorted(merge_groups(groups)), [[1, 2, 7], [3, 5, 9], [11, 12]])
+
+    def test_similar_pairs(self):
+        a = list(range(8))
+        b = a[:2] + [100] * 6  # shares the first band of a, but is not similar
+        c = a[:7] + [99]
+        self.assertEqual(get_band_keys(a, 4, 2)[0], get_band_keys(b, 4, 2)[0])
+
+        signatures = SignatureStore(8)
+        record = struct.Struct(">8Q")
+        for id, signature in enumerate([a, b, c, a]):
+            signatures.add(id + 10, record.pack(*signature))
+        self.assertEqual(signatures.get(1), tuple(b))
+
+        # Candidates below the threshold are dropped, similar candidates are compared only once
+        self.assertEqual(list(get_similar_pairs([0, 1, 2, 3], signatures, 0.8)), [[2, 0], [3, 2]])
+        self.assertEqual(list(get_similar_pairs([0, 1], signatures, 0.8)), [])
+        signatures.close()
+
+    def test_minhash(self):
+        hasher = MinHasher()
+        similar = hasher.get_signature("By our correspondent. " + TEXT)
+        other = hasher.get_signature("Something completely different about the football results of yesterday.")
+        signature = hasher.get_signature(TEXT)
+
+        similarity = lambda a, b: sum(x == y for x, y in zip(a, b)) / len(a)
+        self.assertGreater(similarity(signature, similar), 0.6)
+        self.assertLess(similarity(signature, other), 0.1)
+        self.assertIsNone(hasher.get_signature(" ... "))
+
+        bands, rows = get_lsh_parameters(0.9, 128)
+        self.assertLessEqual(bands * rows, 128)
+
+    @amcattest.use_elastic
+    def test_deduplicator(self):
+        aset = amcattest.create_test_set()
+        a = amcattest.create_test_article(articleset=aset, title="Taxes", text=TEXT, properties={"byline": "A"})
+        b = amcattest.create_test_article(articleset=aset, title="Taxes", text=TEXT, properties={"byline": "B"})
+        c = amcattest.create_test_article(articleset=aset, title="Taxes", text="By our correspondent. " + TEXT)
+        d = amcattest.create_test_article(articleset=aset, title="Football", text="Ajax won again.")
+        ES().refresh()
+        ids = sorted([a.id, b.id, c.id, d.id])
+
+        # Exact duplicates ignoring byline
+        fields = ["text", "title"]
+        groups = Deduplicator(fields=fields, slice_size=2, processes=0).get_duplicates(ids)
+        self.assertEqual(groups, [sorted([a.id, b.id])])
+
+        # Near duplicates
+        groups = Deduplicator(near=True, threshold=0.5, slice_size=2, processes=0).get_duplicates(ids)
+        self.assertEqual(groups, [sorted([a.id, b.id, c.id])])
+
+        # At 0.85, c shares a band with a and b, but its estimated similarity (0.8) is below the threshold
+        groups = Deduplicator(near=True, threshold=0.85, slice_size=2, processes=0).get_duplicates(ids)
+        self.assertEqual(groups, [sorted([a.id, b.id])])
@@ -0,0 +1,53 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+import os
+import shutil
+import tempfile
+import time
+
+from django.test import override_settings
+
+from amcat.tools import amcattest
+from amcat.tools.exportfiles import create_export_file, get_export_path, remove_expired_files
+
+
+class TestExportFiles(amcattest.AmCATTestCase):
+    def setUp(self):
+        super(TestExportFiles, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.settings = override_settings(EXPORT_DIR=self.directory, EXPORT_MAX_AGE=3600)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.directory)
+        super(TestExportFiles, self).tearDown()
+
+    def test_files(self):
+        name, path = create_export_file(suffix=".csv")
+        self.assertTrue(name.endswith(".csv"))
+        self.assertEqual(get_export_path(name), path)
+        self.assertRaises(ValueError, get_export_path, "../" + name)
+
+        # Expired files are removed
+        old, _ = create_export_file()
+        os.utime(get_export_path(old), (time.time() - 7200,) * 2)
+        remove_expired_files()
+        self.assertRaises(FileNotFoundError, get_export_path, old)
+        self.assertEqual(get_export_path(name), path)
@@ -67,3 +67,35 @@ class TestProgressMonitor(unittest.TestCase):
         sm2.update()
         self.assertAlmostEqual(monitor.get_progress(), 2/5 + 1/2 * 3 * 1/5)
 
+
+    def test_throttle(self):
+        states = []
+        monitor = ProgressMonitor(total=10, max_rate=0.001, log=False)
+        monitor.add_listener(lambda m: states.append((m.worked, m.message)))
+
+        # The first update is passed on, later updates are coalesced
+        monitor.update(1, "a")
+        monitor.update(1, "b")
+        monitor.update(1)
+        self.assertEqual(states, [(1, "a")])
+
+        monitor.flush()
+        self.assertEqual(states, [(1, "a"), (3, "b")])
+        monitor.flush()
+        self.assertEqual(len(states), 2)
+
+        # Completion is always passed on, also from sub monitors
+        sm = monitor.submonitor(7, weight=7)
+        sm.update(6)
+        self.assertEqual(len(states), 2)
+        sm.update(1, "done")
+        self.assertEqual(states[-1], (10, "done"))
+        self.assertAlmostEqual(monitor.progress, 1)
+
+        # Without a maximum rate, all updates are passed on
+        states = []
+        monitor = ProgressMonitor(total=10, max_rate=None, log=False)
+        monitor.add_listener(lambda m: states.append(m.worked))
+        for i in range(3):
+            monitor.update()
+        self.assertEqual(states, [1, 2, 3])
@@ -0,0 +1,119 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+import os
+import shutil
+import socket
+import tempfile
+import uuid
+from unittest import mock
+
+from amcat.tools import amcattest, querycache
+from amcat.tools.querycache import QueryCache
+
+
+class TestQueryCache(amcattest.AmCATTestCase):
+    def setUp(self):
+        super(TestQueryCache, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.cache = QueryCache(max_bytes=100, spill_bytes=10, directory=self.directory, max_age=3600)
+        # Use a private prefix, so we do not interfere with other (cached) tests
+        self.cache.prefix = "test-{}.query-cache".format(uuid.uuid4())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestQueryCache, self).tearDown()
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", b"abc")
+        self.assertEqual(self.cache.get("a"), b"abc")
+        self.assertIsNotNone(self.cache.get_timestamp("a"))
+
+        # Large values are spilled to disk
+        self.cache.set("b", b"x" * 20)
+        self.assertEqual(os.listdir(self.directory), ["b"])
+        self.assertEqual(self.cache.get("b"), b"x" * 20)
+
+        self.cache.delete("b")
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(os.listdir(self.directory), [])
+
+        stats = self.cache.get_stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["sets"]), (2, 2, 2))
+        self.assertEqual((stats["bytes"], stats["entries"]), (3, 1))
+
+    def test_evict(self):
+        self.cache.set("a", b"a" * 40)
+        self.cache.set("b", b"b" * 40)
+        self.cache.get("a")
+
+        # b is least recently used, so it should be evicted
+        self.cache.set("c", b"c" * 40)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNotNone(self.cache.get("a"))
+        self.assertIsNotNone(self.cache.get("c"))
+        self.assertEqual(self.cache.get_stats()["evictions"], 1)
+
+        # Values exceeding the budget are not stored at all
+        self.cache.set("d", b"d" * 101)
+        self.assertIsNone(self.cache.get("d"))
+
+    def test_invalidate(self):
+        self.cache.set("a", b"a", articlesets=[1, 2])
+        self.cache.set("b", b"b", articlesets=[2])
+        self.cache.set("c", b"c", articlesets=[3])
+
+        self.cache.invalidate_articlesets([2])
+        self.assertIsNone(self.cache.get("a"))
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("c"), b"c")
+        self.assertEqual(self.cache.get_stats()["invalidations"], 2)
+
+        self.cache.set("d", b"d", articlesets=[3], codingjobs=[4])
+        self.cache.invalidate_codingjobs([4])
+        self.assertIsNone(self.cache.get("d"))
+        self.assertEqual(self.cache.get("c"), b"c")
+
+    def test_other_host(self):
+        self.cache.set("a", b"a" * 20)
+        os.remove(os.path.join(self.directory, "a"))
+
+        # Values spilled by other hosts are a miss, but are not removed
+        self.cache.redis.hset(self.cache._key("entry", "a"), "host", "other-host")
+        self.assertIsNone(self.cache.get("a"))
+        self.assertIsNotNone(self.cache.get_timestamp("a"))
+
+        # Our own values which are gone from disk are removed
+        self.cache.redis.hset(self.cache._key("entry", "a"), "host", socket.gethostname())
+        self.assertIsNone(self.cache.get("a"))
+        self.assertIsNone(self.cache.get_timestamp("a"))
+
+    def test_other_host_delete(self):
+        self.cache.set("a", b"a" * 20)
+
+        # Another host, which cannot see our directory, deletes the value
+        with mock.patch.object(querycache.socket, "gethostname", return_value="other-host"), \
+                mock.patch.object(querycache.os, "remove", side_effect=FileNotFoundError):
+            self.assertTrue(self.cache.delete("a"))
+        self.assertIsNone(self.cache.get_timestamp("a"))
+        self.assertEqual(os.listdir(self.directory), ["a"])
+
+        # The file is removed when we spill the next value
+        self.cache.set("b", b"b" * 20)
+        self.assertEqual(os.listdir(self.directory), ["b"])
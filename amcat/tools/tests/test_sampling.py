@@ -0,0 +1,91 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+import collections
+import datetime
+import random
+
+from amcat.scripts.actions.sample_articleset import SampleSet
+from amcat.tools import amcattest
+from amcat.tools.amcates import ES
+from amcat.tools.sampling import reservoir_sample, allocate, sample_articleset, get_strata
+
+
+class TestSampling(amcattest.AmCATTestCase):
+    def test_reservoir_sample(self):
+        sample = reservoir_sample(range(1000), 10, random.Random(1))
+        self.assertEqual(len(set(sample)), 10)
+        self.assertEqual(sample, reservoir_sample(range(1000), 10, random.Random(1)))
+        self.assertEqual(sorted(reservoir_sample(range(5), 10)), list(range(5)))
+        self.assertEqual(reservoir_sample(range(5), 0), [])
+
+        # All items should be about equally likely
+        counts = collections.Counter()
+        for seed in range(2000):
+            counts.update(reservoir_sample(range(10), 3, random.Random(seed)))
+        self.assertEqual(set(counts), set(range(10)))
+        self.assertGreater(min(counts.values()), 500)
+        self.assertLess(max(counts.values()), 700)
+
+    def test_allocate(self):
+        self.assertEqual(allocate({"a": 5, "b": 3, "c": 2}, 5), {"a": 3, "b": 1, "c": 1})
+        self.assertEqual(allocate({"a": 5, "b": 3, "c": 2}, 20), {"a": 5, "b": 3, "c": 2})
+        self.assertEqual(allocate({"a": 0}, 3), {"a": 0})
+
+    @amcattest.use_elastic
+    def test_sample_articleset(self):
+        s = amcattest.create_test_set(articles=10)
+        ES().refresh()
+        ids = set(s.get_article_ids())
+
+        for method in ("database", "elastic", "stratified"):
+            sample = sample_articleset(s.id, 4, method=method, seed=42)
+            self.assertEqual(len(set(sample)), 4, method)
+            self.assertLessEqual(set(sample), ids, method)
+            self.assertEqual(sample, sample_articleset(s.id, 4, method=method, seed=42), method)
+            self.assertEqual(len(sample_articleset(s.id, 0.5, method=method)), 5, method)
+            self.assertEqual(set(sample_articleset(s.id, 20, method=method)), ids, method)
+
+    @amcattest.use_elastic
+    def test_stratified(self):
+        s = amcattest.create_test_set()
+        for i in range(8):
+            date = datetime.datetime(2016, 1 if i < 6 else 2, 1 + i)
+            medium = "a" if i % 2 else "b c"
+            s.add_articles([amcattest.create_test_article(date=date, properties={"medium": medium})])
+        ES().refresh()
+
+        self.assertEqual(sorted(n for _, n in get_strata(s.id, "date", "month")), [2, 6])
+        self.assertEqual(sorted(n for _, n in get_strata(s.id, "medium")), [4, 4])
+
+        sample = sample_articleset(s.id, 4, method="stratified", stratify_by="date")
+        dates = collections.Counter(a.date.month for a in s.articles.filter(pk__in=sample))
+        self.assertEqual(dates, {1: 3, 2: 1})
+
+        sample = sample_articleset(s.id, 0.5, method="stratified", stratify_by="medium")
+        media = collections.Counter(a.properties["medium"] for a in s.articles.filter(pk__in=sample))
+        self.assertEqual(media, {"a": 2, "b c": 2})
+
+    @amcattest.use_elastic
+    def test_script(self):
+        s = amcattest.create_test_set(articles=10)
+        ES().refresh()
+        result = SampleSet(articleset=s.id, sample="30%", target_articleset_name="sample",
+                           target_project=s.project.id, method="elastic").run()
+        self.assertEqual(result.articles.count(), 3)
+        self.assertLessEqual(set(result.get_article_ids()), set(s.get_article_ids()))
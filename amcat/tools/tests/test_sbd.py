@@ -1,6 +1,13 @@
-from amcat.models import Sentence
+import json
+from unittest import mock
+from uuid import uuid4
+
+from amcat.models import Sentence, Task
 from amcat.tools import amcattest
-from amcat.tools.sbd import split, create_sentences
+from amcat.tools.classtools import get_qualified_name
+from amcat.tools.sbd import split, create_sentences, create_sentences_bulk, get_or_create_sentences, \
+    split_codingjob_articles, SplitSentencesHandler
+from api.rest.viewsets import TaskSerializer
 
 
 class TestSBD(amcattest.AmCATTestCase):
@@ -23,4 +30,50 @@ class TestSBD(amcattest.AmCATTestCase):
         self.assertEqual(sents, {(1, 1, hl),
                                  (2, 1, "A sentence"),
                                  (3, 1, "Another sentence"),
-                                 (3, 2, "And yet a third")})
\ No newline at end of file
+                                 (3, 2, "And yet a third")})
+
+    def test_create_sentences_bulk(self):
+        text = "A sentence.\n\nAnother sentence. And\ta \\ third"
+        articles = [amcattest.create_test_article(title="Title {}".format(i), text=text) for i in range(5)]
+        get_or_create_sentences(articles[0])
+
+        # Already split articles are skipped
+        n = create_sentences_bulk([a.id for a in articles], processes=0, batch_size=2)
+        self.assertEqual(n, 16)
+
+        for a in articles:
+            sents = set((s.parnr, s.sentnr, s.sentence) for s in a.sentences.all())
+            self.assertEqual(sents, {(1, 1, a.title),
+                                     (2, 1, "A sentence"),
+                                     (3, 1, "Another sentence"),
+                                     (3, 2, "And a \\ third")})
+
+        self.assertEqual(create_sentences_bulk([a.id for a in articles]), 0)
+
+    def test_split_codingjob_articles(self):
+        job = amcattest.create_test_job(narticles=3)
+        other = amcattest.create_test_article()
+        split_codingjob_articles([job.id])
+
+        for a in job.articleset.articles.all():
+            self.assertTrue(a.sentences.exists())
+        self.assertFalse(other.sentences.exists())
+
+    def test_split_sentences_task(self):
+        """Can a finished splitting task be serialised and viewed?"""
+        job = amcattest.create_test_job()
+        task = Task.objects.create(uuid=uuid4(), handler_class_name=get_qualified_name(SplitSentencesHandler),
+                                   class_name=get_qualified_name(create_sentences_bulk),
+                                   arguments={"codingjobs": [job.id]}, project=job.project)
+        result = mock.Mock(status="SUCCESS", result=3)
+        result.ready.return_value = True
+        result.failed.return_value = False
+
+        with mock.patch.object(Task, "get_async_result", return_value=result):
+            data = TaskSerializer(task).data
+            self.assertTrue(data["ready"])
+            self.assertIsNone(data["redirect_url"])
+            self.assertIsNone(data["redirect_message"])
+
+            response = task.get_handler().get_response()
+            self.assertEqual(json.loads(response.content.decode()), {"sentences": 3})
@@ -18,7 +18,9 @@
 ###########################################################################
 from operator import itemgetter
 from unittest import TestCase
-from amcat.tools.tree import Tree
+import collections
+
+from amcat.tools.tree import Tree, HierarchyIndex
 
 
 class TestTree(TestCase):
@@ -49,3 +51,34 @@ class TestTree(TestCase):
         self.assertEqual(set(t.obj for t in tree.get_level(1)), {"child1", "child2"})
         self.assertEqual(set(t.obj for t in tree.get_level(2)), {"child3", "child4"})
         self.assertEqual(set(t.obj for t in tree.get_level(5)), set())
+
+
+class TestHierarchyIndex(TestCase):
+    def setUp(self):
+        # 1 - 2 - 3, 1 - 4, 5; 6 and 7 form a cycle; 9 is a parent without parent
+        self.index = HierarchyIndex(collections.OrderedDict([
+            (1, None), (2, 1), (3, 2), (4, 1), (5, None), (6, 7), (7, 6), (8, 9)
+        ]))
+
+    def test_order(self):
+        self.assertEqual(list(self.index.ids), [1, 2, 3, 4, 5, 9, 8])
+        self.assertEqual(self.index.get_root_ids(), [1, 5, 9])
+        self.assertEqual(list(self.index.get_subtree_ids(1)), [1, 2, 3, 4])
+        self.assertEqual(list(self.index.get_subtree_ids(3)), [3])
+
+    def test_ancestors(self):
+        self.assertTrue(self.index.is_descendant(3, 1))
+        self.assertTrue(self.index.is_descendant(3, 3))
+        self.assertFalse(self.index.is_descendant(1, 3))
+        self.assertFalse(self.index.is_descendant(5, 1))
+        self.assertEqual(list(self.index.get_ancestor_ids(3)), [3, 2, 1])
+        self.assertEqual(self.index.get_depth(3), 2)
+        self.assertEqual(self.index.get_parent_id(2), 1)
+        self.assertIsNone(self.index.get_parent_id(1))
+        self.assertEqual([self.index.get_ancestor_id(3, d) for d in range(3)], [1, 2, 3])
+        self.assertRaises(ValueError, self.index.get_ancestor_id, 1, 1)
+
+    def test_cycle(self):
+        self.assertNotIn(6, self.index)
+        self.assertRaises(ValueError, self.index.get_depth, 6)
+        self.assertRaises(KeyError, self.index.get_depth, 10)
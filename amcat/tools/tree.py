@@ -16,6 +16,9 @@
 # You should have received a copy of the GNU Affero General Public        #
 # License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
+import collections
+import itertools
+from array import array
 
 
 class Tree(object):
@@ -52,3 +55,122 @@ class Tree(object):
     def __eq__(self, other):
         return self.parent == other.parent and self.obj == other.obj and self.children == other.children
 
+
+def get_root_ids(hierarchy):
+    """
+    Returns the roots of the given {child: parent} hierarchy: children without parent and
+    parents which are not a child themselves, ordered by first occurrence in hierarchy.
+    """
+    roots = {child for child, parent in hierarchy.items() if parent is None}
+    roots |= set(hierarchy.values()) - set(hierarchy) - {None}
+    order = {}
+    for node in itertools.chain(hierarchy.keys(), hierarchy.values()):
+        order.setdefault(node, len(order))
+    return sorted(roots, key=order.get)
+
+
+class HierarchyIndex(object):
+    """
+    Precomputed index of a {child: parent} hierarchy of integer ids, answering descendant
+    and ancestor queries without walking the hierarchy.
+
+    Nodes are numbered in depth first (pre-)order, with roots and children in order of the
+    hierarchy. The subtree of the node at position p consists of the nodes at positions
+    p..ends[p] (nested set intervals), so is-descendant is O(1) and subtrees are slices.
+    Ancestors at a given depth are found in O(log depth) using a table of 2^k-th ancestors.
+
+    Nodes which are part of a cycle are not reachable from any root; queries involving
+    them raise a ValueError.
+    """
+    def __init__(self, hierarchy):
+        """
+        @param hierarchy: ordered mapping of {child: parent}, where parent is None for roots
+        """
+        children = collections.defaultdict(list)
+        for child, parent in hierarchy.items():
+            if parent is not None:
+                children[parent].append(child)
+
+        self.ids, self.parents, self.depths = array("q"), array("l"), array("l")
+        self.positions = {}
+
+        todo = [(root, -1, 0) for root in reversed(get_root_ids(hierarchy))]
+        while todo:
+            node, parent, depth = todo.pop()
+            position = len(self.ids)
+            self.positions[node] = position
+            self.ids.append(node)
+            self.parents.append(parent)
+            self.depths.append(depth)
+            todo.extend((child, position, depth + 1) for child in reversed(children[node]))
+
+        # Subtree sizes, computed bottom-up (children always follow their parent)
+        sizes = array("l", [1]) * len(self.ids)
+        for position in reversed(range(len(self.ids))):
+            if self.parents[position] != -1:
+                sizes[self.parents[position]] += sizes[position]
+        self.ends = array("l", (p + size for p, size in enumerate(sizes)))
+
+        # ancestors[k][p] is the 2^k-th ancestor of p, or -1
+        self.ancestors = [self.parents]
+        for _ in range(max(self.depths, default=0).bit_length() - 1):
+            previous = self.ancestors[-1]
+            self.ancestors.append(array("l", (-1 if a == -1 else previous[a] for a in previous)))
+
+        self.cyclic = (set(hierarchy) | set(hierarchy.values())) - set(self.positions) - {None}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, node):
+        return node in self.positions
+
+    def _get_position(self, node):
+        if node in self.cyclic:
+            raise ValueError("Cycle in hierarchy: {} is not reachable from a root".format(node))
+        return self.positions[node]
+
+    def get_root_ids(self):
+        return [node for node, depth in zip(self.ids, self.depths) if depth == 0]
+
+    def get_depth(self, node):
+        """Returns the depth of node (0 for roots)"""
+        return self.depths[self._get_position(node)]
+
+    def get_parent_id(self, node):
+        parent = self.parents[self._get_position(node)]
+        return None if parent == -1 else self.ids[parent]
+
+    def is_descendant(self, node, ancestor):
+        """Returns whether node is ancestor or one of its descendants"""
+        p = self._get_position(ancestor)
+        return p <= self._get_position(node) < self.ends[p]
+
+    def get_subtree_ids(self, node):
+        """Returns node and its descendants in depth first order"""
+        p = self._get_position(node)
+        return self.ids[p:self.ends[p]]
+
+    def get_ancestor_id(self, node, depth):
+        """
+        Returns the ancestor of node at the given depth (the root for depth 0)
+        @raises ValueError: if depth is larger than the depth of node
+        """
+        p = self._get_position(node)
+        distance = self.depths[p] - depth
+        if distance < 0:
+            raise ValueError("{} has no ancestor at depth {}".format(node, depth))
+        k = 0
+        while distance:
+            if distance & 1:
+                p = self.ancestors[k][p]
+            distance >>= 1
+            k += 1
+        return self.ids[p]
+
+    def get_ancestor_ids(self, node):
+        """Yields node and its ancestors, up to its root"""
+        p = self._get_position(node)
+        while p != -1:
+            yield self.ids[p]
+            p = self.parents[p]
@@ -95,6 +95,12 @@ define([
     self.API_URL = "/api/v4/";
     self.API_PAGE_SIZE = 999999;
 
+    // Number of articles after the selected one of which codings are prefetched
+    self.PREFETCH_SIZE = 10;
+
+    // Codings of coded articles fetched in advance, by coded article id
+    self.prefetched_codings = {};
+
     self.STATUS = {
         NOT_STARTED: 0,
         IN_PROGRESS: 1,
@@ -900,6 +906,7 @@ define([
             dataType: "text"
         }).done(function(data, textStatus, jqXHR){
             self.hide_loading();
+            delete self.prefetched_codings[self.state.coded_article_id];
 
             new PNotify({
                 "title" : "Done",
@@ -1108,7 +1115,7 @@ define([
 
         self.state.requests = [
             self.from_api(base_url),
-            self.from_api(base_url + "codings"),
+            self.get_codings_request(coded_article_id, base_url),
             self.from_api(base_url + "sentences")
         ];
 
@@ -1117,6 +1124,54 @@ define([
     };
 
 
+    /*
+     * Returns a request for the codings of the given coded article, using prefetched
+     * codings if available. Prefetched codings are only used once, as they are
+     * outdated as soon as the coder saves.
+     */
+    self.get_codings_request = function get_codings_request(coded_article_id, base_url){
+        var codings = self.prefetched_codings[coded_article_id];
+        delete self.prefetched_codings[coded_article_id];
+
+        if (codings === undefined){
+            return self.from_api(base_url + "codings");
+        }
+
+        // Mimic the response of from_api, as passed by $.when
+        return $.Deferred().resolve([{ results : codings }]).promise();
+    };
+
+    /*
+     * Fetch the codings of the given coded articles in a single request, and store
+     * them in self.prefetched_codings in the format of the codings api.
+     */
+    self.prefetch_codings = function prefetch_codings(coded_article_ids){
+        coded_article_ids = $.grep(coded_article_ids, function(coded_article_id){
+            return self.prefetched_codings[coded_article_id] === undefined;
+        });
+
+        if (coded_article_ids.length === 0) return;
+
+        $.getJSON("codings", { coded_articles : coded_article_ids.join(",") }).done(function(data){
+            var to_object = function(columns, values){
+                var obj = {};
+                $.each(columns, function(i, column){ obj[column] = values[i]; });
+                return obj;
+            };
+
+            $.each(data.codings, function(coded_article_id, codings){
+                self.prefetched_codings[coded_article_id] = $.map(codings, function(values){
+                    var coding = to_object(data.coding_columns, values);
+                    coding.coded_article = parseInt(coded_article_id);
+                    coding.values = $.map(coding.values, function(value){
+                        return to_object(data.value_columns, value);
+                    });
+                    return coding;
+                });
+            });
+        });
+    };
+
     /*
      * Get descendants. Needs to be bound to a code object. This call is
      * automatically cached, and stored in code.descendants.
@@ -1417,6 +1472,10 @@ define([
         self.datatable.parent().scrollTo(row, {offset: -50});
         self.get_article(coded_article_id);
         row.addClass("row_selected");
+
+        self.prefetch_codings($.map(row.nextAll().slice(0, self.PREFETCH_SIZE), function(next_row){
+            return parseInt($(next_row).children('td:first').text());
+        }));
     };
 
     self.window_resized = function window_resized(){
@@ -26,6 +26,7 @@ article_patterns = patterns('',
 
 codingjob_patterns = patterns('',
     url('^code$', codingjob.index, name="annotator-codingjob"),
+    url(r'^codings$', codingjob.codings, name="annotator-codings"),
     url(r'^codedarticle/(?P<coded_article_id>\d+)/', include(article_patterns)),
 )
 
@@ -28,10 +28,14 @@ from django.shortcuts import render
 from django.http import HttpResponseRedirect, HttpResponseBadRequest, HttpResponse
 from django.core.urlresolvers import reverse
 import itertools
-from amcat.models.authorisation import ROLE_PROJECT_ADMIN
+from amcat.models.authorisation import ROLE_PROJECT_ADMIN, ROLE_PROJECT_READER
 
 
 from amcat.models import CodingJob, Project, Article, CodingValue, Coding, CodedArticle
+from amcat.models.coding.codedarticle import BULK_CODING_COLUMNS, BULK_VALUE_COLUMNS
+
+# Maximum number of coded articles of which codings can be fetched at once
+MAX_BULK_CODED_ARTICLES = 100
 
 log = logging.getLogger(__name__)
 
@@ -72,10 +76,45 @@ def save(request, project_id, codingjob_id, coded_article_id):
     coded_article.status_id = codings["coded_article"]["status_id"]
     coded_article.comments = codings["coded_article"]["comments"]
     coded_article.save()
-    coded_article.replace_codings(codings["codings"])
+    changes = coded_article.update_codings(codings["codings"])
+    log.debug("Saved codings of {coded_article.id}: {changes}".format(**locals()))
 
     return HttpResponse(status=201)
 
+def codings(request, project_id, codingjob_id):
+    """
+    Returns the codings of multiple coded articles of a codingjob, as passed in the
+    comma separated coded_articles parameter. This allows the annotator to prefetch
+    the codings of the next articles. Codings are arrays, see CodedArticle.get_codings_bulk.
+    """
+    codingjob = CodingJob.objects.select_related("project").get(id=codingjob_id)
+
+    if codingjob.project_id != int(project_id):
+        raise PermissionDenied("Given codingjob ({codingjob}) does not belong to project ({codingjob.project})!".format(**locals()))
+
+    if codingjob.coder_id != request.user.id and not codingjob.project.has_role(request.user, ROLE_PROJECT_READER):
+        raise PermissionDenied("Only {request.user} or project readers can view this codingjob.".format(**locals()))
+
+    try:
+        coded_article_ids = [int(ca_id) for ca_id in request.GET.get("coded_articles", "").split(",") if ca_id]
+    except ValueError:
+        return HttpResponseBadRequest("coded_articles should be a comma separated list of ids")
+
+    if len(coded_article_ids) > MAX_BULK_CODED_ARTICLES:
+        return HttpResponseBadRequest("Cannot fetch more than {} coded articles at once".format(MAX_BULK_CODED_ARTICLES))
+
+    # Only return coded articles of this codingjob
+    coded_articles = codingjob.coded_articles.filter(id__in=coded_article_ids)
+    coded_article_ids = set(coded_articles.values_list("id", flat=True))
+    codings = CodedArticle.get_codings_bulk(sorted(coded_article_ids))
+
+    return HttpResponse(json.dumps({
+        "coding_columns": BULK_CODING_COLUMNS,
+        "value_columns": BULK_VALUE_COLUMNS,
+        "codings": codings
+    }), content_type="application/json")
+
+
 def redirect(request, codingjob_id):
     cj = CodingJob.objects.get(id=codingjob_id)
     return HttpResponseRedirect(reverse("annotator:annotator-codingjob", kwargs={
@@ -104,11 +104,13 @@ class LazyES(object):
                 return r
 
             result_dict = {r.id : add_hits_column(r) for r in result}
-            filters = {'ids': list(result_dict)}
 
-            for q in self.queries:
-                for hit in self.es.query_all(q.query, filters=filters, fields=[]):
-                    result_dict[hit.id].hits[q.label] = hit.score
+            if result_dict:
+                filters = {'ids': list(result_dict)}
+                scores = self.es.multi_query([q.query for q in self.queries], filters, size=len(result_dict))
+                for q, hits in zip(self.queries, scores):
+                    for aid, score in hits.items():
+                        result_dict[aid].hits[q.label] = score
 
         return result
 
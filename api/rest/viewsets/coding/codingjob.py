@@ -17,7 +17,7 @@
 # License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
 
-from django.db.models import Count, Q
+from django.db.models import Q
 from rest_framework import serializers
 from amcat.models.coding.codingjob import CodingJob
 from amcat.models.article import Article
@@ -26,7 +26,8 @@ from amcat.models.coding.codebook import Codebook
 from amcat.models.coding.codingrule import CodingRule
 from amcat.models.coding.codingschemafield import CodingSchemaField
 from rest_framework.viewsets import ReadOnlyModelViewSet
-from amcat.models.coding.codedarticle import STATUS_COMPLETE, STATUS_IRRELEVANT, CodedArticle, STATUS_INPROGRESS, STATUS_NOTSTARTED
+from amcat.models.coding.codedarticle import STATUS_COMPLETE, STATUS_IRRELEVANT, STATUS_INPROGRESS, STATUS_NOTSTARTED, \
+    CodingJobProgress
 from amcat.tools import sbd
 from amcat.tools.caching import cached
 from api.rest.mixins import DatatablesMixin
@@ -49,9 +50,8 @@ __all__ = ("CodingJobViewSetMixin", "CodingJobSerializer", "CodingJobViewSet",
 class CodingJobSerializer(AmCATModelSerializer):
     """
     This serializer for codingjob includes the amount of total jobs
-    and done jobs. Because it would be wholly inefficient to calculate
-    the values per codingjob, we ask the database to aggregate for us
-    in one query.
+    and done jobs. These are read from the (materialized) progress counters
+    of all codingjobs at once, see CodingJobProgress.
     """
     articles = serializers.SerializerMethodField('get_n_articles')
     complete = serializers.SerializerMethodField('get_n_done_jobs')
@@ -59,8 +59,8 @@ class CodingJobSerializer(AmCATModelSerializer):
     
     def __init__(self, *args, **kwargs):
         """Initializes the Serializer
-        @param use_caching: indicates whether the serializer should cache codingjobs' statistics
-                            Defaults to True.
+        @param use_caching: indicates whether the serializer should fetch the progress of all
+                            codingjobs at once. Defaults to True.
         """
         super(CodingJobSerializer, self).__init__(*args, **kwargs)
         
@@ -75,48 +75,26 @@ class CodingJobSerializer(AmCATModelSerializer):
 
         return CodingJob.objects.filter(id__in=view.filter_queryset(view.get_queryset()))
 
-    def _get_coded_articles(self):
-        return CodedArticle.objects.filter(codingjob__in=self._get_codingjobs())
-
-    @cached
-    def _get_n_done_jobs(self):
-        return dict(self._get_coded_articles().filter(status__id__in=STATUS_DONE)
-                    .values("codingjob").annotate(n=Count("codingjob"))
-                    .values_list("codingjob__id", "n"))
-
     @cached
-    def _get_n_todo_jobs(self):
-        return dict(self._get_coded_articles().filter(status__id__in=STATUS_TODO)
-                    .values("codingjob").annotate(n=Count("codingjob"))
-                    .values_list("codingjob__id", "n"))
-
-    @cached
-    def _get_n_articles(self):
-        return dict(self._get_codingjobs().annotate(n=Count("articleset__articles")).values_list("id", "n"))
-
-    def get_n_articles(self, obj):
-        if not obj: return 0
+    def _get_progress(self):
+        return CodingJobProgress.get(self._get_codingjobs())
 
+    def get_progress(self, obj):
         if not self.use_caching:
-            return obj.articleset.articles.count()
+            return CodingJobProgress.get(CodingJob.objects.filter(id=obj.id)).get(obj.id)
+        return self._get_progress().get(obj.id)
 
-        return self._get_n_articles().get(obj.id, 0)
+    def get_n_articles(self, obj):
+        progress = obj and self.get_progress(obj)
+        return progress.n_articles if progress else 0
 
     def get_n_done_jobs(self, obj):
-        if not obj: return 0
-        
-        if not self.use_caching:
-            return CodedArticle.objects.filter(codingjob=obj, status__id__in=STATUS_DONE).count()
-        
-        return self._get_n_done_jobs().get(obj.id, 0)
+        progress = obj and self.get_progress(obj)
+        return progress.n_done if progress else 0
 
     def get_n_todo_jobs(self, obj):
-        if not obj: return 0
-        
-        if not self.use_caching:
-            return CodedArticle.objects.filter(codingjob=obj, status__id__in=STATUS_TODO).count() 
-        
-        return self._get_n_todo_jobs().get(obj.id, 0)
+        progress = obj and self.get_progress(obj)
+        return progress.n_todo if progress else 0
 
     class Meta:
         model = CodingJob
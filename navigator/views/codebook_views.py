@@ -31,6 +31,7 @@ from amcat.models import Language, Project, Code, CodebookCode, Label
 from amcat.scripts.actions.export_codebook import ExportCodebook
 from amcat.scripts.actions.export_codebook_as_xml import ExportCodebookAsXML
 from amcat.scripts.actions.import_codebook import ImportCodebook
+from amcat.tools.codebookcache import CodebookCache
 from api.rest.datatable import Datatable
 from api.rest.resources import CodebookHierarchyResource
 from api.rest.viewsets import CodebookViewSet
@@ -337,8 +338,9 @@ class CodebookSaveLabelsView(CodebookFormActionView):
             for lbl in deleted_labels:
                 lbl.delete()
 
-            # Create new labels
+            # Create new labels (bulk_create does not send signals, so invalidate manually)
             Label.objects.bulk_create(created_labels)
+            CodebookCache().invalidate_codes([code.id])
 
             # Update existing labels
             for label in changed_labels:
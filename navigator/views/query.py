@@ -23,7 +23,6 @@ import logging
 from amcat.scripts.query import get_r_queryactions
 from amcat.scripts.query.queryaction import is_valid_cache_key
 from django import conf
-from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.db.models.query_utils import Q
 from django.http import HttpResponseBadRequest, HttpResponse
@@ -32,6 +31,7 @@ from django.views.generic.base import TemplateView, RedirectView, View
 from amcat.models import Query
 from amcat.scripts.forms import SelectionForm
 from amcat.tools import amcates
+from amcat.tools.querycache import QueryCache
 from api.rest.datatable import Datatable
 from api.rest.viewsets import QueryViewSet, FavouriteArticleSetViewSet, CodingJobViewSet
 from navigator.views.project_views import ProjectDetailsView
@@ -55,7 +55,7 @@ class ClearQueryCacheView(ProjectViewMixin, HierarchicalViewMixin, BreadCrumbMix
         if not is_valid_cache_key(cache_key):
             return HttpResponseBadRequest("Invalid cache key.")
 
-        cache.set(cache_key, None)
+        QueryCache().delete(cache_key)
         return HttpResponse("OK")
 
 class SavedQueryRedirectView(HierarchicalViewMixin, ProjectViewMixin, BreadCrumbMixin, RedirectView):
@@ -27,20 +27,31 @@ from django.core.urlresolvers import reverse
 from django.shortcuts import redirect
 from django.views.generic.edit import FormMixin, ProcessFormView
 from django.views.generic.base import TemplateResponseMixin
-from django.http import HttpResponse
+from django.http import HttpResponse, FileResponse
 from django import forms
 from django.db import models
 from django.http import QueryDict
 
 from amcat.tools.table import table3
+from amcat.tools.exportfiles import get_export_path
 from amcat.tools.progress import ProgressMonitor
 from amcat.models.task import TaskHandler, IN_PROGRESS
 from amcat.amcatcelery import app
 
 class CeleryProgressUpdater(object):
+    """
+    Listener storing the progress of a monitor in the celery result backend. Updates which do
+    not change the (rounded) percentage or the message are not written.
+    """
     def __init__(self, task_id):
         self.task_id = task_id
+        self.last_state = None
+
     def update(self, monitor):
+        state = (round(monitor.percent, 1), monitor.message)
+        if state == self.last_state:
+            return
+        self.last_state = state
         app.backend.store_result(
             self.task_id,
             {"completed": monitor.percent, "message": monitor.message},
@@ -94,7 +105,11 @@ class ScriptHandler(TaskHandler):
         script.progress_monitor = ProgressMonitor()
         script.progress_monitor.add_listener(CeleryProgressUpdater(str(self.task.uuid)).update)
         script.task = self.task
-        result = script.run()
+        try:
+            result = script.run()
+        finally:
+            # Pass on progress held back by the throttle
+            script.progress_monitor.flush()
         if isinstance(result, models.Model):
             result = result.pk
         return result
@@ -108,8 +123,17 @@ class ScriptHandler(TaskHandler):
         """Default: instantiate the script and ask it to provide response"""
         result = self.task._get_raw_result()
         if isinstance(result, dict) and result.get('type') == 'download':
-            data = base64.b64decode(result['data'])
-            response = HttpResponse(data, content_type=result['content_type'], status=200)
+            if result.get('encoding') == 'file':
+                # Large results are written to a (shared) export file by the script, stream them from there
+                try:
+                    path = get_export_path(result['name'])
+                except FileNotFoundError:
+                    return HttpResponse("This export has expired, please run it again", status=410,
+                                        content_type="text/plain")
+                response = FileResponse(open(path, 'rb'), content_type=result['content_type'], status=200)
+            else:
+                data = base64.b64decode(result['data'])
+                response = HttpResponse(data, content_type=result['content_type'], status=200)
             response['Content-Disposition'] = 'attachment; filename="{filename}"'.format(**result)
             return response
         else:
@@ -18,6 +18,7 @@
 ###########################################################################
 import os
 import datetime
+import tempfile
 
 from settings.tools import get_amcat_config, get_cookie_secret
 
@@ -77,6 +78,19 @@ CACHE_BUST_TOKEN = datetime.datetime.now().isoformat()
 if not DEBUG:
     CACHE_BUST_TOKEN = amcat_config["cache"].get("bust_token")
 
+# Query action result cache (see amcat.tools.querycache)
+QUERY_CACHE_MAX_BYTES = amcat_config["query_cache"].getint("max_bytes")
+QUERY_CACHE_SPILL_BYTES = amcat_config["query_cache"].getint("spill_bytes")
+QUERY_CACHE_DIR = amcat_config["query_cache"].get("directory") or os.path.join(tempfile.gettempdir(), "amcat-query-cache")
+QUERY_CACHE_MAX_AGE = amcat_config["query_cache"].getint("max_age")
+
+# Export files (see amcat.tools.exportfiles)
+EXPORT_DIR = amcat_config["exports"].get("directory") or os.path.join(tempfile.gettempdir(), "amcat-exports")
+EXPORT_MAX_AGE = amcat_config["exports"].getint("max_age")
+
+# Split the articles of new codingjobs into sentences in a background task (see amcat.tools.sbd)
+CODINGJOB_SPLIT_SENTENCES = amcat_config["codingjobs"].getboolean("split_sentences")
+
 
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name